@@ -25,21 +25,53 @@ import os
 import sys
 import logging
 import socketserver
+import asyncio
 import configparser
-from glob import glob
+from bisect import bisect_left
 from shutil import disk_usage
-from numpy import copy, array, uint8, argsort, all, bitwise_and
+from numpy import copy, array, uint8, argsort, all, bitwise_and, unique,\
+                  zeros, diff, outer, add, column_stack,\
+                  frombuffer, copyto, int16, left_shift, right_shift, subtract,\
+                  full, array_equal, dtype, float32, int64, linspace, memmap,\
+                  ndarray
 from simplejpeg import encode_jpeg_yuv_planes
-from time import strftime, sleep, time
+from time import strftime, sleep, time, perf_counter, thread_time, monotonic
+from math import ceil, log2
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from http import HTTPStatus
 from threading import Condition, Thread
-from picamera2 import Picamera2, MappedArray
-from picamera2.encoders import H264Encoder, Quality
-from picamera2.outputs import PyavOutput,CircularOutput2
+from collections import deque, OrderedDict
+from itertools import islice
 from datetime import datetime
 from PIL import Image
-from io import BytesIO
-from libcamera import Transform
+from queue import Queue
+from urllib.parse import urlsplit, parse_qs, unquote, quote
+from email.utils import formatdate, parsedate_to_datetime
+import re
+from threading import Lock
+from numpy.random import default_rng
+import argparse
+import json
+import hashlib
+import platform
+import subprocess
+import struct
+import mmap
+import multiprocessing
+
+try:
+    from picamera2 import Picamera2, MappedArray
+    from picamera2.encoders import H264Encoder, Quality
+    from picamera2.outputs import PyavOutput,Output,FfmpegOutput
+    from libcamera import Transform
+except ImportError:
+    # Not on a Raspberry Pi, only the --replay frame source is available
+    Picamera2 = None
+    Output = object
+
+# Startup times, logged and on /metrics, are measured from here, once the
+# imports have loaded
+STARTED = monotonic()
 
 # Set HTML string 'variables' for use in the configurable web page
 stop_start = "Manual_Recording_START"
@@ -60,6 +92,37 @@ delete_button_colour = DELETE_PASSIVE
 
 focus_button="" # Pre-define before use
 
+# Command line options, for running without a camera and for benchmarking.
+# With no options Ropey-Cam runs the attached camera as normal.
+parser = argparse.ArgumentParser(description = "Ropey-Cam streaming and motion triggered recording")
+parser.add_argument('--benchmark-motion', nargs = '+', metavar = 'FILE',
+                    help = "compare the motion engines and detectors on recorded clips or .yuv frame dumps")
+parser.add_argument('--load-test', nargs = '+', metavar = 'ARG',
+                    help = "HOST[:PORT] CLIENTS [SECONDS] load test of a running Ropey-Cam's stream")
+parser.add_argument('--replay', metavar = 'SOURCE',
+                    help = "replace the camera with a .yuv lo-res frame dump, a video file or 'synthetic'")
+parser.add_argument('--fast', action = 'store_true',
+                    help = "replay as fast as possible instead of at the configured FPS")
+parser.add_argument('--main', action = 'store_true',
+                    help = "replay also produces full size main frames every frame, not only when recording")
+parser.add_argument('--throughput', type = int, metavar = 'SECONDS',
+                    help = "run for SECONDS with one simulated viewer, print each stage's frames per second, then exit")
+parser.add_argument('--find-motion', nargs = 4, type = float, metavar = ('X1', 'Y1', 'X2', 'Y2'),
+                    help = "list the recordings with motion in a part of the frame, given as fractions of its"
+                           " width and height, e.g. 0 0 0.5 0.5 for the top left quarter")
+parser.add_argument('--benchmark-stages', nargs = '*', metavar = 'FILE',
+                    help = "time each processing stage at every stream size, on synthetic frames or recorded clips,"
+                           " and add the results to benchmark_history.jsonl")
+args = parser.parse_args()
+
+# File arguments are relative to where the script was started from
+if args.benchmark_motion:
+    args.benchmark_motion = [os.path.abspath(path) for path in args.benchmark_motion]
+if args.benchmark_stages:
+    args.benchmark_stages = [os.path.abspath(path) for path in args.benchmark_stages]
+if args.replay and args.replay != 'synthetic':
+    args.replay = os.path.abspath(args.replay)
+
 # Ensure the current working directory is the one containing the script
 # and create a Videos sub-directory, if necessary
 full_path=os.path.realpath(__file__)
@@ -105,27 +168,100 @@ if ASPECT_RATIO == 1.333 and VIDEO_WIDTH > 1600:
 VIDEO_HEIGHT = int(2* ((VIDEO_WIDTH/ASPECT_RATIO) // 2))
 STREAM_HEIGHT = int(2 * ((STREAM_WIDTH/ASPECT_RATIO) // 2))
 
-# Frame to frame change limit for motion detection
-trigger_level = config.getint('ropey','trigger_level', fallback = 400)
-
-# Save a copy of the trigger_level. Use in re-enabling motion detection.
-reset_trigger = trigger_level
+# Frame to frame change limit for motion detection. The default for every
+# camera, each Camera keeps its own trigger_level and a copy to re-enable with
+TRIGGER_LEVEL = config.getint('ropey','trigger_level', fallback = 400)
+
+# Engine used to turn the motion mask into a motion score.
+# 'components' - a single connected components pass, overlapping boxes counted once
+# 'contours' - the original findContours / boundingRect loop
+MOTION_ENGINE = config.get('ropey', 'motion_engine', fallback = 'contours')
+
+# Detector that produces the motion mask. 'difference' compares each frame with
+# the previous one, 'background' with a running average background, learnt at
+# background_learning_rate per analysed frame (rounded to a power of two).
+MOTION_DETECTOR = config.get('ropey', 'motion_detector', fallback = 'difference')
+BACKGROUND_LEARNING_RATE = config.getfloat('ropey', 'background_learning_rate', fallback = 0.03)
+BACKGROUND_THRESHOLD = config.getint('ropey', 'background_threshold', fallback = 25)
+
+if MOTION_DETECTOR not in ('difference', 'background'):
+    print(f"Unknown motion_detector '{MOTION_DETECTOR}' in {config_file}, using 'difference'.")
+    MOTION_DETECTOR = 'difference'
+    config.set('ropey', 'motion_detector', MOTION_DETECTOR)
+
+# Fixed point learning rate, background += (frame - background) >> BACKGROUND_SHIFT
+BACKGROUND_SHIFT = min(7, max(1, round(-log2(min(max(BACKGROUND_LEARNING_RATE, 0.008), 0.5)))))
+
+# Detection can run on a 1/2 or 1/4 size copy of the luma plane (motion_scale 2 or 4),
+# re-running at full resolution only when the coarse score comes within
+# motion_escalation_band (a fraction of trigger_level) of the trigger level.
+# Scores are always reported in full resolution units.
+MOTION_SCALE = config.getint('ropey', 'motion_scale', fallback = 1)
+MOTION_ESCALATION_BAND = config.getfloat('ropey', 'motion_escalation_band', fallback = 0.25)
+
+if MOTION_SCALE not in (1, 2, 4):
+    print(f"motion_scale must be 1, 2 or 4, not {MOTION_SCALE}. Using 1.")
+    MOTION_SCALE = 1
+    config.set('ropey', 'motion_scale', str(MOTION_SCALE))
+
+COARSE_SIZE = (STREAM_WIDTH // MOTION_SCALE, STREAM_HEIGHT // MOTION_SCALE)
+COARSE_THRESH = max(1, 20 // (MOTION_SCALE * MOTION_SCALE))
+COARSE_UNITS = array([MOTION_SCALE] * 4 + [MOTION_SCALE * MOTION_SCALE])
+
+# Adaptive detection rate. After quiet_seconds with no motion and no recording,
+# only every Nth frame is analysed, up to max_detection_stride. If motion_cpu_budget
+# (fraction of one core) is set, N is the smallest stride that fits the budget.
+ADAPTIVE_DETECTION = config.getboolean('ropey', 'adaptive_detection', fallback = False)
+MAX_DETECTION_STRIDE = max(1, config.getint('ropey', 'max_detection_stride', fallback = 5))
+QUIET_SECONDS = config.getint('ropey', 'quiet_seconds', fallback = 10)
+MOTION_CPU_BUDGET = config.getfloat('ropey', 'motion_cpu_budget', fallback = 0.0)
+
+# Run each camera's motion analysis in a worker process of its own, reading the
+# lo-res frames from shared memory, so it has a core and a GIL to itself
+MOTION_PROCESS = config.getboolean('ropey', 'motion_process', fallback = False)
 
 # Mode parameter that controls key sensor parameters
 SENSOR_MODE = config.getint('ropey','sensor_mode', fallback = 1)
 
+# The attached sensor's model, modes and autofocus support are kept in
+# SENSOR_CACHE after they are first read, so restarts skip probing the sensor.
+# Delete the file to probe again, it is also redone if another sensor is attached.
+SENSOR_CACHE = 'sensor_cache.json'
+
+# At startup, frames are used once the auto exposure and white balance have
+# settled, exposure x gain and the colour gains steady to within SETTLE_TOLERANCE
+# for SETTLE_FRAMES frames, or after camera_settle_timeout seconds at most
+CAMERA_SETTLE_TIMEOUT = config.getfloat('ropey', 'camera_settle_timeout', fallback = 5.0)
+SETTLE_FRAMES = 5
+SETTLE_TOLERANCE = 0.02
+
 # Conservatively 15fps for pre Pi3 models, 25 or 30fps for later models.
 FRAMES_PER_SECOND = config.getint('ropey','frames_per_second', fallback = 20)
 
 # Length of time (seconds) inside circular ring buffer
 BUFFER_SECONDS = config.getint('ropey','buffer_seconds', fallback =3)
 
+# RAM budget (MB) of the pre-roll buffer, 0 for no limit. Older frames spill to
+# preroll_spill_file, a memory mapped ring of preroll_spill_mb on tmpfs or disk,
+# or without one are dropped, so the pre-roll may be shorter than buffer_seconds
+PREROLL_RAM_MB = config.getfloat('ropey', 'preroll_ram_mb', fallback = 0)
+PREROLL_SPILL_FILE = config.get('ropey', 'preroll_spill_file', fallback = '')
+PREROLL_SPILL_MB = config.getfloat('ropey', 'preroll_spill_mb', fallback = 64)
+
 # Number of consecutive frames with motion to trigger recording
 AFTER_FRAMES = config.getint('ropey','after_frames', fallback = 5)
 
 # Post-motion additional recording time (seconds)
 POST_ROLL = config.getint('ropey','post_roll', fallback = 3)
 
+# Continuous DVR recording in place of motion triggered clips. The H.264
+# stream is written to consecutive segments of dvr_segment_minutes, and motion
+# only adds an entry to the camera's event index, Videos/events.jsonl
+DVR = config.getboolean('ropey', 'dvr', fallback = False)
+DVR_SEGMENT_SECONDS = max(10, round(config.getfloat('ropey', 'dvr_segment_minutes', fallback = 5) * 60))
+DVR_EVENTS = 'events.jsonl'
+DVR_EVENTS_PER_PAGE = 100
+
 # Transform controls
 HFLIP = config.getboolean('ropey','hflip', fallback = False)
 VFLIP = config.getboolean('ropey','vflip', fallback = False)
@@ -136,12 +272,56 @@ no_checked_hflip = "" if HFLIP else "checked"
 yes_checked_vflip = "checked" if VFLIP else ""
 no_checked_vflip = "" if VFLIP else "checked"
 
-# Video file counter, to retain consecutive file numbering after restarts
-video_count = config.getint('ropey','video_count', fallback = 0)
-
 # Limit before file deletion is activated
 MAX_DISK_USAGE = config.getfloat('ropey','max_disk_usage', fallback = 0.8)
 
+# Once over the limit, the oldest recordings are deleted in one batch until
+# usage is this far below it, rather than one pair after every recording
+STORAGE_HYSTERESIS = config.getfloat('ropey', 'storage_hysteresis', fallback = 0.05)
+if not 0 <= STORAGE_HYSTERESIS < MAX_DISK_USAGE:
+    print(f"storage_hysteresis of {STORAGE_HYSTERESIS} in {config_file} is out of range, using 0.05.")
+    STORAGE_HYSTERESIS = min(0.05, MAX_DISK_USAGE / 2)
+    config.set('ropey', 'storage_hysteresis', str(STORAGE_HYSTERESIS))
+
+# Recordings browser. Each download is limited to download_rate KB per second,
+# (0 for no limit), so downloads over WiFi leave room for the live stream.
+DOWNLOAD_RATE = config.getint('ropey', 'download_rate', fallback = 2048) * 1024
+DOWNLOAD_CHUNK = 256 * 1024  # Bytes per sendfile() call
+RECORDINGS_PER_PAGE = 20
+
+# Optional HLS live view. ffmpeg copies the H.264 stream already being encoded
+# for recordings into short fragmented MP4 segments, kept in RAM, (/dev/shm),
+# and listed in a playlist at /live/live.m3u8 . No extra encoding is done.
+LIVE_HLS = config.getboolean('ropey', 'live_hls', fallback = False)
+LIVE_HLS_DIR = config.get('ropey', 'live_hls_dir', fallback = '/dev/shm/ropey-live')
+HLS_SEGMENT_SECONDS = config.getint('ropey', 'hls_segment_seconds', fallback = 2)
+HLS_LIST_SIZE = 5  # Segments in the playlist, older ones are deleted
+# The hls.js player for browsers other than Safari, a pinned build installed
+# next to the script and served by the camera at /hls.min.js, so the live
+# view needs no internet access and runs no third party script
+HLS_JS_FILE = 'hls.min.js'
+
+# Activity heatmap, the motion in each tile of a grid over the stream frame,
+# per second for the last hour and per hour for the last 90 days, kept in a
+# fixed size memory mapped file and served at /heatmap.png and /heatmap.json
+HEATMAP = config.getboolean('ropey', 'heatmap', fallback = True)
+HEATMAP_FILE = config.get('ropey', 'heatmap_file', fallback = 'Videos/heatmap.dat')
+HEATMAP_GRID = (16, 9)  # Columns, rows of tiles
+HEATMAP_SECONDS = 3600
+HEATMAP_HOURS = 24 * 90
+
+# Content types of the files the web server sends
+FILE_TYPES = {'.mp4': 'video/mp4',
+              '.jpg': 'image/jpeg',
+              '.motion': 'application/octet-stream',
+              '.m3u8': 'application/vnd.apple.mpegurl',
+              '.m4s': 'video/iso.segment',
+              '.js': 'text/javascript'}
+
+# The files of one recording in the Videos directory, the video, the snapshot
+# of the trigger moment and its motion track
+RECORDING_EXTENSIONS = ('.mp4', '.jpg', '.motion')
+
 # Check if motion mask is specified
 apply_motion_mask = config.getboolean('ropey','apply_motion_mask', fallback = False)
 
@@ -153,6 +333,9 @@ if apply_motion_mask:
     # Convert the pgm image to a Numpy array
     mask_array = array(mask_image)
 
+    # And a decimated copy for the coarse detection pass
+    small_mask_array = cv2.resize(mask_array, COARSE_SIZE, interpolation = cv2.INTER_NEAREST)
+
     # More !! string variables for HTML radio checked buttons
     yes_checked_mask = "checked"
     no_checked_mask = ""
@@ -264,12 +447,12 @@ was_button_pressed = False
 should_reboot = False
 should_exit = False
 should_delete_files = False
-set_manual_recording = False
 should_shutdown = False
-is_recording = False
+
+# Fraction of trigger_level above which the scene is no longer 'quiet'
+QUIET_FRACTION = 0.5
 
 # Misc constants and variables
-total_motion = 0  # Total area of motion detected via frame differencing
 kernel = array((9,9), dtype=uint8)  # Used in detection function
 mask_name='' # Predefine for use later
 most_recent_page ='/index.html' # Prepare for guided page redirects
@@ -299,6 +482,1152 @@ STREAM_STAMP = (255, 0, 0)
 HIGH_Q = 90
 LOW_Q = 65
 
+# Number of preallocated lo-res frame buffers shared by the capture, mjpeg and
+# motion threads. The motion thread holds two, the mjpeg thread briefly one.
+LORES_POOL_SIZE = 6
+
+# Stream variant (fps, jpeg quality, scale down factor) sent to browsers that
+# don't ask for another one with e.g. stream.mjpg?fps=5&q=40&scale=2
+DEFAULT_STREAM_VARIANT = (FRAMES_PER_SECOND, LOW_Q, 1)
+
+# Encoded mjpeg frames queued per stream client. When a slow client's queue is
+# full the oldest frame is dropped, so it never holds up the encoder or other clients.
+STREAM_QUEUE_FRAMES = config.getint('ropey', 'stream_queue_frames', fallback = 2)
+
+# Web server. 'threading' uses one thread per browser connection, 'asyncio'
+# serves every connection, including the mjpeg streams, from one event loop.
+SERVER_MODE = config.get('ropey', 'server_mode', fallback = 'threading')
+if SERVER_MODE not in ('threading', 'asyncio'):
+    print(f"Unknown server_mode '{SERVER_MODE}' in {config_file}, using 'threading'.")
+    SERVER_MODE = 'threading'
+    config.set('ropey', 'server_mode', SERVER_MODE)
+
+# Latency measurement mode. Every mjpeg frame carries its sequence number and
+# its sensor, capture and encode times as multipart headers, for /latency.html
+LATENCY_MODE = config.getboolean('ropey', 'latency_mode', fallback = False)
+LATENCY_SAMPLES = 100  # Frames the /latency.html figures are averaged over
+
+# Camera buffers for the main and lo-res streams
+BUFFER_COUNT = config.getint('ropey', 'buffer_count', fallback = 10)
+
+
+def home_page():
+    # The streams of any other cameras, below the first camera's controls
+    other_cameras = "".join(f"""
+                <h3>{camera.title}</h3>
+                <img src="{camera.stream_path}" width="{STREAM_WIDTH}" height="{STREAM_HEIGHT}" />
+                <br>
+                  <a href="/recordings.html?camera={camera.name}">Recordings</a>
+                  <a href="/heatmap.png?camera={camera.name}">Activity Heatmap</a>
+                <p> </p>""" for camera in cameras[1:])
+
+    # HTML description of the dynamic home / streaming page
+    HOMEPAGE = """\
+        <!DOCTYPE html>
+          <html lang="en">
+            <head>
+              <meta charset="UTF-8">
+              <meta name="viewport" content="width=device-width, initial-scale=1.0">
+              <title>{ph0}</title>
+            </head>
+            <body>
+              <center>
+                <h2>{ph0} Live Streaming with motion-triggered Recording</h2>
+                <img src="stream.mjpg" width="{ph1}" height="{ph2}" />
+                <p> {ph3}  </p>
+                <form action="/" method="POST">
+                  <input type="submit" name="submit" value="{ph4}"style = "{ph6}">
+                  <input type="submit" name="submit" value="Inc_TriggerLevel">
+                  <input type="submit" name="submit" value="Dec_TriggerLevel">
+                  <input type="submit" name="submit" value="{ph5}" style = "{ph7}">
+                </form>
+                <p> </p>
+                  {ph50}
+                <p> </p>
+                <form action="/" method="POST">
+                  <input type="submit" name="submit" value="DELETE_ALL_FILES" style = "{ph11}">
+                  <input type="submit" name="submit" value="EXIT" style = "{ph8}">
+                  <input type="submit" name="submit" value="RESET" style = "background-color:lightgreen;">
+                  <input type="submit" name="submit" value="REBOOT" style ="{ph9}">
+                  <input type="submit" name="submit" value="SHUTDOWN" style= "{ph10}">
+                </form>
+                <br>
+                  <a href="/configuration.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Configuration  Entry  Page</a>
+                  <a href="/controls.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Camera Control Entry Page</a>
+                  <a href="/recordings.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Recordings</a>
+                  <a href="/heatmap.png" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Activity Heatmap</a>
+                <p> </p>
+                  {ph51}
+              </center>
+            </body>
+          </html>
+        """.format(ph0 = camera_title,
+                   ph1 = STREAM_WIDTH,
+                   ph2 = STREAM_HEIGHT,
+                   ph3 = message_1,
+                   ph4 = motion_button,
+                   ph5 = stop_start,
+                   ph6 = motion_button_colour,
+                   ph7 = record_button_colour,
+                   ph8 = exit_button_colour,
+                   ph9 = reboot_button_colour,
+                   ph10 = shutdown_button_colour,
+                   ph11 = delete_button_colour,
+                   ph50 = focus_button,
+                   ph51 = other_cameras)
+    return HOMEPAGE
+
+
+def configuration_page():
+    CONFPAGE = """\
+        <!DOCTYPE html>
+          <html lang="en">
+            <html>
+            <head><title>Configuration Entry</title></head>
+            <body>
+              <center>
+              <a href="/"style="border: 1px solid lightgrey; padding: 10px;background-color: lightgrey; text-decoration: none;">Back to Home / Streaming Page </a>
+                <h2>Ropey-Cam Configuration Entry Page</h2>
+                <p> </p>
+                <form action="/" method="POST">
+                  <label for "VIDEO_WIDTH">VIDEO WIDTH </label>
+                  <input type="number" id="VIDEO_WIDTH" name="VIDEO_WIDTH" placeholder = {ph12} min="1024"  max="1920"step="32" style ="margin-right: 12px"  >
+
+                  <label for "STREAM_WIDTH">STREAM WIDTH</label>
+                  <input type="number" id="STREAM_WIDTH" name="STREAM_WIDTH" placeholder = {ph13} min="384" max="1280"step="128" style ="margin-right: 12px">
+
+                  <label for "ASPECT_RATIO">ASPECT RATIO</label>
+                  <input type="number" id="ASPECT_RATIO" name="ASPECT_RATIO" placeholder = {ph14} min="1.333" max="2.221"step=".444">
+                  <p></p>
+                  <label for "FRAMES_PER_SECOND">FPS</label>
+                  <input type="number" id="FRAMES_PER_SECOND" name="FRAMES_PER_SECOND" placeholder = {ph15} min="10" max="30"step="5" style="margin-right: 20px">
+
+                  <label for "SENSOR_MODE">MODE</label>
+                  <input type="number" id="SENSOR_MODE" name="SENSOR_MODE" placeholder = {ph16} min="0" max={ph17} style="margin-right: 20px">
+
+                  <label for "HFLIP"> Sensor Hflip -> Off </label>
+                  <input type="radio" name="HFLIP" value = False {ph18} >
+
+                  <label for "HFLIP">On</label>
+                  <input type="radio" name="HFLIP" value = True {ph19} style="margin-right: 30px">
+
+                  <label for "VFLIP"> Sensor Vflip -> Off </label>
+                  <input type="radio" name="VFLIP" value = False {ph20} >
+
+                  <label for "VFLIP">On</label>
+                  <input type="radio" name="VFLIP" value = True {ph21} >
+                  <p></p>
+                  <label for "trigger_level">Trigger @</label>
+                  <input type="text" size = 4 id="trigger_level" name="trigger_level" placeholder = {ph22}>
+
+                  <label for "AFTER_FRAMES"># Frames</label>
+                  <input type="number" style = "width: 40px" id="AFTER_FRAMES" name="AFTER_FRAMES" placeholder = {ph23} min="0" max="50">
+
+                  <label for "BUFFER_SECONDS"> Buffer</label>
+                  <input type="number" style = "width: 40px" id="BUFFER_SECONDS" name="BUFFER_SECONDS" placeholder ={ph24} min ="1" max="30">
+
+                  <label for "POST_ROLL">Post Roll</label>
+                  <input type="number" style = "width: 40px" id="POST_ROLL" name = "POST_ROLL" placeholder = {ph25} min ="1" max="10">
+
+                  <label for "MAX_DISK_USAGE">Storage Limit</label>
+                  <input type="number" style = "width: 50px" id="MAX_DISK_USAGE" name = "MAX_DISK_USAGE" placeholder = {ph26} min ="0.1" max="0.975" step="0.025">
+                  <p></p>
+                  <label for "apply_motion_mask"> Motion Mask Off</label>
+                  <input type="radio" name="apply_motion_mask" value = False {ph27}>
+
+                  <label for "apply_motion_mask"> On</label>
+                  <input type="radio" name="apply_motion_mask" value = True {ph28} style = "margin-right: 50px">
+
+                  <label for "mask_name">Mask File Name.pgm</label>
+                  <input type="text" id="mask_name" name="mask_name" placeholder = {ph29}>
+                  <p></p>
+                  <label for "is_noir"> Is the camera module a No IR filter ('noir') version ? No</label>
+                  <input type="radio" name="is_noir" value = False {ph30} >
+
+                  <label for "is_noir"> Yes</label>
+                  <input type="radio" name="is_noir" value = True {ph31} style = "margin-right: 50px">
+                  <p></p>
+                  <label for "camera_title">Custom camera title (Alphanumerics and hyphens or underscores only, no spaces or special characters).</label>
+                  <input type="text" id="camera_title" name="camera_title" placeholder = {ph34}>
+                  <p></p>
+                  <input type="submit" value="Submit to apply changes to internal config file">
+                </form>
+                <p></p>
+                <h3>The submitted configuration change takes effect on restart/reboot</h3>
+                <form action="/" method="POST">
+                  <input type="submit" name="submit" value="EXIT" style ="{ph32}">
+                  <input type="submit" name="submit" value="REBOOT" style ="{ph33}">
+                </form>
+              </center>
+            </body>
+            </html>
+            """.format(ph12 = VIDEO_WIDTH,
+                       ph13 = STREAM_WIDTH,
+                       ph14 = ASPECT_RATIO,
+                       ph15 = FRAMES_PER_SECOND,
+                       ph16 = SENSOR_MODE,
+                       ph17 = str(max_mode),
+                       ph18 = no_checked_hflip,
+                       ph19 = yes_checked_hflip,
+                       ph20 = no_checked_vflip,
+                       ph21 = yes_checked_vflip,
+                       ph22 = cameras[0].trigger_level,
+                       ph23 = AFTER_FRAMES,
+                       ph24 = BUFFER_SECONDS,
+                       ph25 = POST_ROLL,
+                       ph26 = MAX_DISK_USAGE,
+                       ph27 = no_checked_mask,
+                       ph28 = yes_checked_mask,
+                       ph29 = mask_name,
+                       ph30 = no_checked_noir,
+                       ph31 = yes_checked_noir,
+                       ph32 = exit_button_colour,
+                       ph33 = reboot_button_colour,
+                       ph34 = camera_title
+                       )
+    return CONFPAGE
+
+
+def controls_page():
+    CONTROLPAGE = """\
+        <!DOCTYPE html>
+          <html lang="en">
+            <html>
+              <title>Camera Controls Entry</title>
+               </head>
+                    <body>
+                      <center>
+                      <a href="/" style="border: 1px solid lightgrey; padding: 10px;background-color: lightgrey; text-decoration: none;">Back to Home / Streaming Page </a>
+                        <h3>Ropey-Cam Camera Control Entry Page</h3>
+                        <p> </p>
+                        <form action="/" method = "POST">
+                            <label for "Brightness"> Brightness (-1.0 through (0.0)  to   +1.0)  </label>
+                            <input type = "number" id = "Brightness" name = "Brightness"  min ="-1.0" max="1.0" step="0.025" value ={ph40} >
+                          <p></p> 
+                            <label for "Contrast"> Contrast (0.0 through (1.0)  to  32.0)</label>
+                            <input type = "number" id = "Contrast" name = "Contrast" min ="0.0" max="32.0" step="0.025" value ={ph41} >
+                          <p></p>
+                            <label for "Saturation"> Saturation (0.0 through (1.0)  to  32.0)</label>
+                            <input type = "number" id = "Saturation" name = "Saturation" min ="0.0" max="32.0" step="0.025" value ={ph42} >
+                            <p></p>
+                          <p></p>
+                            <label for = "AeConstraintMode"> AeConstraintMode :</label>
+                              <select id = "AeConstraintMode" name ="AeConstraintMode">
+                                <option value=""></option>
+                                <option value = 0> Normal </option>
+                                <option value = 1> Highlight </option>
+                                <option value = 2> Shadows </option>
+                                <option value = 3> Custom </option>
+                              </select>
+                          <p></p>
+                            <label for = "AeEnable"> AeEnable :</label>
+                              <select id = "AeEnable" name = "AeEnable">
+                                <option value = ""></option>
+                                <option value = True > True </option>
+                                <option value = False > False </option>
+                              </select>
+                          <p></p>
+                            <label for ="ExposureTime"> ExposureTime (microseconds)</label>
+                            <input type = "number" id = "ExposureTime" name = "ExposureTime" placeholder = {ph43}>
+                          <p></p>
+                            <label for = "AnalogueGain">AnalogueGain</label>
+                            <input type = "number" id = "AnalogueGain" name = "AnalogueGain" placeholder = {ph44}> 
+                          <p></p>
+                            <label for = "AeExposureMode"> AeExposureMode :</label>
+                              <select id = "AeExposureMode" name="AeExposureMode">
+                                <option value = ""></option>
+                                <option value = 0> Normal </option>
+                                <option value = 1> Short </option>
+                                <option value = 2> Long </option>
+                                <option value = 3> Custom </option>
+                              </select>
+                          <p></p>
+                            <label for = "ExposureValue"> ExposureValue (-8.0 through (0.0)  to  8.0 ) </label>
+                            <input type = "number" id = "ExposureValue" name = "ExposureValue" min ="-8.0" max="8.0" step="0.05" value ={ph45} >
+                          <p></p>
+                            <label for = "AeMeteringMode"> AeMeteringMode :</label>
+                              <select id = "AeMeteringMode" name = "AeMeteringMode">
+                                <option value = ""></option>
+                                <option value = 0> CentreWeighted </option>
+                                <option value = 1> Spot </option>
+                                <option value = 2> Matrix </option>
+                                <option value = 3> Custom </option>
+                              </select>
+                          <p></p>
+                            <label for = "AwbMode"> AwbMode :</label>
+                              <select id = "AwbMode" name = "AwbMode">
+                                <option value = ""></option>
+                                <option value = 0> Auto </option>
+                                <option value = 1> Tungsten </option>
+                                <option value = 2 >Fluorescent </option>
+                                <option value = 3> Indoor </option>
+                                <option value = 4> Daylight </option>
+                                <option value = 5> Cloudy</option>
+                                <option value = 6> Custom </option>
+                              </select>
+                          <p></p>
+                            <label for ="AwbEnable"> AwbEnable :</label>
+                              <select id = "AwbEnable" name ="AwbEnable">
+                                <option value = ""> </option>
+                                <option value= True> True </option>
+                                <option value = False> False </option>
+                              </select>
+                          <p></p>
+                            <label for = "ColourGains"> ColourGains (Rg hyphen Bg) Rg-Bg</label>
+                            <input type = "text" id = "ColourGains" name = "ColourGains">
+                          <p></p>
+                          <label for ="AfMetering"> AfMetering :</label>
+                            <select id = "AfMetering" name ="AfMetering">
+                              <option value = ""> </option>
+                              <option value = 0 > Auto </option>
+                              <option value = 1 > Windows </option>
+                            </select>
+                          <p></p>
+                            <label for = "AFMode"> AfMode :</label>
+                              <select id = "AfMode" name="AfMode">
+                                <option value = ""></option>
+                                <option value = 0> Manual </option>
+                                <option value = 1> Auto </option>
+                                <option value = 2> Continuous </option>
+                              </select>
+                          <p></p>
+                            <label for "LensPosition"> LensPosition (0.0 through (1.0)  to   15.0)  </label>
+                            <input type = "number" id = "LensPosition" name = "LensPosition" placeholder = "1.0"  >
+                          <p></p>
+                            <label for = "AFRange"> AfRange :</label>
+                              <select id = "AfRange" name="AfRange">
+                                <option value = ""></option>
+                                <option value = 0> Normal </option>
+                                <option value = 1> Macro </option>
+                                <option value = 2> Full </option>
+                              </select>
+                          <p></p>
+                            <input type = "submit" value = "Submit to apply control changes to internal config file and immediately to camera">
+                        </form>
+                      </center>
+                     </body>
+                    </html>
+                    """.format(ph40 = controls["Brightness"],
+                               ph41 = controls["Contrast"],
+                               ph42 = controls["Saturation"],
+                               ph43 = exposuretime,
+                               ph44 = analoguegain,
+                               ph45 = controls["ExposureValue"])
+    return CONTROLPAGE
+
+
+def latency_page():
+    # Static page that watches the stream itself, to time the browser's part
+    LATENCYPAGE = """\
+        <!DOCTYPE html>
+          <html lang="en">
+            <head>
+              <meta charset="UTF-8">
+              <meta name="viewport" content="width=device-width, initial-scale=1.0">
+              <title>Latency</title>
+            </head>
+            <body>
+              <center>
+                <h2>Stream latency, milliseconds over the last frames</h2>
+                <p id="note"></p>
+                <table id="stages" border="1" cellpadding="4"></table>
+                <p id="settings"></p>
+                <canvas id="frame"></canvas>
+                <br>
+                  <a href="/index.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Home Page</a>
+              </center>
+              <script>
+                // Browser clock to camera clock offset, from the lowest round trip seen
+                let offset = null, bestTrip = Infinity, server = null;
+                const browser = [];
+                const canvas = document.getElementById('frame');
+
+                function row(name, values) {
+                  const mean = values.reduce((a, b) => a + b, 0) / values.length;
+                  return `<tr><td>${name}</td><td>${mean.toFixed(1)}</td><td>${Math.max(...values).toFixed(1)}</td></tr>`;
+                }
+
+                function render() {
+                  let html = '<tr><th>Stage</th><th>Mean</th><th>Max</th></tr>';
+                  if (server) {
+                    for (const stage of server.stages) {
+                      html += `<tr><td>${stage.name}</td><td>${stage.mean_ms}</td><td>${stage.max_ms}</td></tr>`;
+                    }
+                    document.getElementById('settings').textContent = Object.entries(server.settings)
+                      .map(([name, value]) => `${name} ${value}`).join(', ');
+                  }
+                  if (browser.length) {
+                    html += row('encode to browser receive', browser.map(b => b[0]));
+                    html += row('browser decode and draw', browser.map(b => b[1]));
+                    html += row('sensor to browser display', browser.map(b => b[2]));
+                  }
+                  document.getElementById('stages').innerHTML = html;
+                }
+
+                async function poll() {
+                  const start = performance.now();
+                  server = await (await fetch('/latency.json', {cache: 'no-store'})).json();
+                  const end = performance.now();
+                  if (end - start < bestTrip) {
+                    bestTrip = end - start;
+                    offset = server.now - (start + end) / 2000;
+                  }
+                  document.getElementById('note').textContent = server.latency_mode
+                    ? `Browser figures are within ${(bestTrip / 2).toFixed(1)} ms, half the fastest round trip to the camera.`
+                    : 'Set latency_mode = True in ropey.ini and restart to measure latency.';
+                  render();
+                }
+
+                function find(buffer, bytes, from) {
+                  outer: for (let i = from; i <= buffer.length - bytes.length; i++) {
+                    for (let j = 0; j < bytes.length; j++) {
+                      if (buffer[i + j] !== bytes[j]) continue outer;
+                    }
+                    return i;
+                  }
+                  return -1;
+                }
+
+                async function watch() {
+                  const reader = (await fetch('/stream.mjpg')).body.getReader();
+                  const blank = new TextEncoder().encode('\\r\\n\\r\\n');
+                  let buffer = new Uint8Array(0);
+                  while (true) {
+                    const {value, done} = await reader.read();
+                    if (done) return;
+                    const joined = new Uint8Array(buffer.length + value.length);
+                    joined.set(buffer);
+                    joined.set(value, buffer.length);
+                    buffer = joined;
+                    while (true) {
+                      const headerEnd = find(buffer, blank, 0);
+                      if (headerEnd < 0) break;
+                      const headers = {};
+                      for (const line of new TextDecoder().decode(buffer.subarray(0, headerEnd)).split('\\r\\n')) {
+                        const colon = line.indexOf(':');
+                        if (colon > 0) headers[line.slice(0, colon).toLowerCase()] = line.slice(colon + 1).trim();
+                      }
+                      const start = headerEnd + 4, end = start + parseInt(headers['content-length']);
+                      if (buffer.length < end + 2) break;
+                      const received = performance.now();
+                      const jpeg = buffer.slice(start, end);
+                      buffer = buffer.slice(end + 2);
+                      const bitmap = await createImageBitmap(new Blob([jpeg], {type: 'image/jpeg'}));
+                      canvas.width = bitmap.width;
+                      canvas.height = bitmap.height;
+                      canvas.getContext('2d').drawImage(bitmap, 0, 0);
+                      const drawn = performance.now();
+                      if (offset !== null && headers['x-encode-time']) {
+                        browser.push([1000 * (received / 1000 + offset - parseFloat(headers['x-encode-time'])),
+                                      drawn - received,
+                                      1000 * (drawn / 1000 + offset - parseFloat(headers['x-sensor-time']))]);
+                        if (browser.length > 100) browser.shift();
+                      }
+                    }
+                  }
+                }
+
+                poll();
+                setInterval(poll, 1000);
+                watch();
+              </script>
+            </body>
+          </html>
+        """
+    return LATENCYPAGE
+
+
+def recordings_page(path):
+    # Newest first, one page of a camera's recording catalog, e.g.
+    # /recordings.html?page=2 or /recordings.html?camera=cam1&page=2
+    camera = query_camera(path)
+    try:
+        page = max(1, int(parse_qs(urlsplit(path).query).get('page', ['1'])[0]))
+    except ValueError:
+        page = 1
+    entries, total = camera.recording_catalog.newest((page - 1) * RECORDINGS_PER_PAGE, RECORDINGS_PER_PAGE)
+    rows = ""
+    for entry in entries:
+        title = f"/{camera.directory}/{quote(entry['title'])}"
+        # A media fragment link starts the video at the moment of peak motion
+        peak = entry['peak']
+        if entry.get('peak_offset') is not None:
+            peak = f'<a href="{title}.mp4#t={entry["peak_offset"]}">{peak}</a>'
+        rows += f"""
+                  <tr>
+                    <td><a href="{title}.jpg"><img src="{title}.jpg" width="160" loading="lazy"></a></td>
+                    <td><a href="{title}.mp4">{entry['title']}</a></td>
+                    <td>{datetime.fromtimestamp(entry['start']):%d/%m/%Y %H:%M:%S}</td>
+                    <td>{entry['end'] - entry['start']:.0f} s</td>
+                    <td>{entry['size'] / 1e6:.1f} MB</td>
+                    <td>{peak}</td>
+                  </tr>"""
+    pages = max(1, ceil(total / RECORDINGS_PER_PAGE))
+    query = f"camera={camera.name}&" if camera.index else ""
+    newer = f'<a href="/recordings.html?{query}page={page - 1}">Newer</a>' if page > 1 else ""
+    older = f'<a href="/recordings.html?{query}page={page + 1}">Older</a>' if page < pages else ""
+    RECORDINGSPAGE = """\
+        <!DOCTYPE html>
+          <html lang="en">
+            <head>
+              <meta charset="UTF-8">
+              <meta name="viewport" content="width=device-width, initial-scale=1.0">
+              <title>{ph0}</title>
+            </head>
+            <body>
+              <center>
+                <h2>{ph0} Recordings</h2>
+                <p>{ph1} recordings, page {ph2} of {ph3}</p>
+                <table border="1" cellpadding="4">
+                  <tr><th>Snapshot</th><th>Video</th><th>Start</th><th>Length</th><th>Size</th><th>Peak motion</th></tr>{ph4}
+                </table>
+                <p>{ph5} &nbsp; {ph6}</p>
+                  <a href="/index.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Home Page</a>
+              </center>
+            </body>
+          </html>
+        """.format(ph0 = camera.title,
+                   ph1 = total,
+                   ph2 = page,
+                   ph3 = pages,
+                   ph4 = rows,
+                   ph5 = newer,
+                   ph6 = older)
+    return RECORDINGSPAGE
+
+
+def events_page(path):
+    """ /events.json, the newest ?count=N motion events, (DVR_EVENTS_PER_PAGE at
+        most, the default), of the first camera or ?camera=camN, each segment
+        with a url that plays the event in it, and the content type
+        """
+    camera = query_camera(path)
+    try:
+        count = min(max(1, int(parse_qs(urlsplit(path).query).get('count', [DVR_EVENTS_PER_PAGE])[0])),
+                    DVR_EVENTS_PER_PAGE)
+    except ValueError:
+        count = DVR_EVENTS_PER_PAGE
+    events = camera.event_index.newest(count)
+    for event in events:
+        event['segments'] = [{'title': title, 'start': start, 'end': end,
+                              'url': f"/{camera.directory}/{quote(title)}.mp4#t={start},{end}"}
+                             for title, start, end in event['segments']]
+    return json.dumps({'camera': camera.name, 'events': events}).encode('utf-8'), 'application/json'
+
+
+def recording_file(path):
+    """ The file path and os.stat() of a finished recording's .mp4, .jpg or
+        .motion from its /Videos/ or /Videos/camN/ url, or None. Only files in
+        a camera's catalog are ever served
+        """
+    directory, name = os.path.split(unquote(urlsplit(path).path)[len('/'):])
+    camera = next((camera for camera in cameras if camera.directory == directory), None)
+    title, extension = os.path.splitext(name)
+    if (camera is None or extension not in RECORDING_EXTENSIONS
+            or not camera.recording_catalog.finished(title)):
+        return None
+    file_path = os.path.join(directory, title + extension)
+    try:
+        return file_path, os.stat(file_path)
+    except OSError:
+        return None
+
+
+def etag_matches(if_none_match, etag):
+    """ Whether an If-None-Match header value lists etag """
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+def file_response(file_path, stat, headers):
+    """ The status, response headers and (offset, length) to send, for a GET of
+        a file with the request's If-None-Match, If-Modified-Since and Range
+        headers. headers has lower case names. Only single ranges are supported,
+        anything else gets the whole file
+        """
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt = True)
+    response = [('Content-Type', FILE_TYPES[os.path.splitext(file_path)[1]]),
+                ('ETag', etag), ('Last-Modified', last_modified), ('Accept-Ranges', 'bytes')]
+    if file_path.endswith('.m3u8'):
+        response.append(('Cache-Control', 'no-cache'))  # Rewritten every segment
+
+    if 'if-none-match' in headers:
+        if etag_matches(headers['if-none-match'], etag):
+            return 304, response, None
+    elif 'if-modified-since' in headers:
+        try:
+            if int(stat.st_mtime) <= parsedate_to_datetime(headers['if-modified-since']).timestamp():
+                return 304, response, None
+        except (TypeError, ValueError):
+            pass
+
+    size = stat.st_size
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', headers.get('range', '').strip())
+    if match and any(match.groups()) and headers.get('if-range', etag) in (etag, last_modified):
+        first, last = match.groups()
+        if not first:  # The last N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start > end:
+            return 416, [('Content-Range', f"bytes */{size}"), ('Content-Length', 0)], None
+        return 206, response + [('Content-Range', f"bytes {start}-{end}/{size}"),
+                                ('Content-Length', end - start + 1)], (start, end - start + 1)
+    return 200, response + [('Content-Length', size)], (0, size)
+
+
+def download_delay(sent, start, rate):
+    """ Seconds to wait, after sending sent bytes since start, to keep to rate
+        bytes per second. A rate of 0 is no limit
+        """
+    return sent / rate - (time() - start) if rate else 0
+
+
+def live_file(path):
+    """ The file path and os.stat() of a /live/ playlist or segment, or None """
+    name = urlsplit(path).path[len('/live/'):]
+    if not re.fullmatch(r'[\w-]+\.(m3u8|m4s|mp4)', name):
+        return None
+    file_path = os.path.join(LIVE_HLS_DIR, name)
+    try:
+        return file_path, os.stat(file_path)
+    except OSError:
+        return None
+
+
+def hls_js_file():
+    """ The file path and os.stat() of the installed hls.js player, or None """
+    try:
+        return HLS_JS_FILE, os.stat(HLS_JS_FILE)
+    except OSError:
+        return None
+
+
+def live_hls_output():
+    """ An FfmpegOutput for the H.264 encoder, which runs ffmpeg to copy the
+        stream, without re-encoding, into fMP4 HLS segments in LIVE_HLS_DIR
+        """
+    os.makedirs(LIVE_HLS_DIR, exist_ok = True)
+    for name in os.listdir(LIVE_HLS_DIR):
+        os.remove(os.path.join(LIVE_HLS_DIR, name))
+    return FfmpegOutput(f"-f hls -hls_time {HLS_SEGMENT_SECONDS} -hls_list_size {HLS_LIST_SIZE}"
+                        f" -hls_flags delete_segments+independent_segments"
+                        f" -hls_segment_type fmp4 -hls_fmp4_init_filename init.mp4"
+                        f" {os.path.join(LIVE_HLS_DIR, 'live.m3u8')}")
+
+
+def live_page():
+    # H.264 live view. Safari plays HLS itself, other browsers use hls.js
+    LIVEPAGE = """\
+        <!DOCTYPE html>
+          <html lang="en">
+            <head>
+              <meta charset="UTF-8">
+              <meta name="viewport" content="width=device-width, initial-scale=1.0">
+              <title>Live</title>
+            </head>
+            <body>
+              <center>
+                <h2>Live H.264 view</h2>
+                <video id="live" controls autoplay muted playsinline style="max-width: 100%;"></video>
+                <p id="note"></p>
+                  <a href="/index.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Home Page</a>
+              </center>
+              <script>
+                const video = document.getElementById('live');
+                const playlist = '/live/live.m3u8';
+                if (video.canPlayType('application/vnd.apple.mpegurl')) {
+                  video.src = playlist;
+                } else {
+                  const script = document.createElement('script');
+                  script.src = '/hls.min.js';
+                  script.onload = () => {
+                    const hls = new Hls({liveSyncDurationCount: 2});
+                    hls.loadSource(playlist);
+                    hls.attachMedia(video);
+                  };
+                  script.onerror = () => {
+                    document.getElementById('note').textContent =
+                      'This browser needs the hls.js player, which is not installed on the camera. See the H.264 live view notes.';
+                  };
+                  document.head.appendChild(script);
+                }
+                fetch(playlist).then(response => {
+                  if (!response.ok) document.getElementById('note').textContent =
+                    'No live stream. Set live_hls = True in ropey.ini and restart.';
+                });
+              </script>
+            </body>
+          </html>
+        """
+    return LIVEPAGE
+
+
+# The dynamic pages, rendered on request by either server mode
+PAGES = {'/index.html': home_page,
+         '/configuration.html': configuration_page,
+         '/controls.html': controls_page,
+         '/latency.html': latency_page,
+         '/live.html': live_page}
+
+
+class RenderCache:
+    """
+    The rendered pages and API documents, each kept with its ETag until the
+    state it was rendered from changes, so a repeat request costs a dictionary
+    lookup, and a poll from a client that already has it a 304 with no body.
+    The ETag is a hash of the content, so it stays valid across restarts.
+    """
+
+    def __init__(self):
+        self.entries = {}  # name : (key, content, etag)
+        self.lock = Lock()
+
+    def get(self, name, key, render):
+        """ (content, ETag) of name, rendered again only when key has changed """
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry[0] != key:
+            content = render()
+            entry = (key, content, f'"{hashlib.blake2b(content, digest_size = 8).hexdigest()}"')
+            with self.lock:
+                self.entries[name] = entry
+        return entry[1], entry[2]
+
+
+def state_changed():
+    """ Invalidates the cached pages and documents, after a button press or an
+        API change to the page globals, controls or cameras
+        """
+    global state_version
+    state_version += 1
+
+
+def render_page(path):
+    """ (content, ETag) of one of the PAGES """
+    return render_cache.get(path, state_version, lambda: PAGES[path]().encode('utf-8'))
+
+
+def conditional_response(content, etag, content_type, if_none_match):
+    """ The status, response headers and content to send for a cached page
+        or document, 304 with no content if the client already has it
+        """
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return 304, headers, b''
+    return 200, headers + [('Content-type', content_type), ('Content-Length', len(content))], content
+
+
+render_cache = RenderCache()
+state_version = 0
+
+
+def apply_post(data):
+    """ Applies the button presses and form entries POSTed from the pages
+        and returns the page to redirect the browser back to, and the exit
+        action, 'exit', 'reboot' or 'shutdown', confirmed by a second press,
+        or None. The caller sends the redirect and then calls exit_ropey().
+        The recording, motion and trigger buttons act on every camera
+        """
+    global message_1, stop_start, motion_button,lensposition,focus_button,\
+           should_delete_files,\
+           should_shutdown, should_exit, should_reboot,\
+           post_data,\
+           motion_button_colour, record_button_colour,\
+           exit_button_colour, reboot_button_colour,\
+           shutdown_button_colour, delete_button_colour,\
+           VIDEO_WIDTH,STREAM_WIDTH,FRAMES_PER_SECOND, most_recent_page,\
+           no_checked_noir, yes_checked_noir, no_checked_hflip,\
+           yes_checked_hflip, no_checked_vflip, yes_checked_vflip,\
+           no_checked_mask, yes_checked_mask
+
+    post_data = data
+
+    # If multi-parameter post data is submitted, split into items
+    if most_recent_page =="/configuration.html" and "&" in post_data  :
+        conf_items = post_data.split("&")
+        for items in conf_items:
+            name = items.split("=")[0]
+            value = items.split("=")[1]
+            # And populate config for later saving to ini file
+            if value != '':
+                config.set('ropey',name,value)
+
+                # Testing and setting the 'checked' status of th  4 sets of radio buttons
+                # to ensure they reflect the current status before returning to the page
+                if name == "is_noir" :
+                    yes_checked_noir = "checked" if value == "True" else ""
+                    no_checked_noir = "" if value == "True" else "checked"
+
+                if name == "HFLIP" :
+                    yes_checked_hflip = "checked" if value == "True" else ""
+                    no_checked_hflip = "" if value == "True" else "checked"
+
+                if name == "VFLIP" :
+                    yes_checked_vflip = "checked" if value == "True" else ""
+                    no_checked_vflip = "" if value == "True" else "checked"
+
+                if name == "apply_motion_mask" :
+
+                    yes_checked_mask = "checked" if value == "True" else ""
+                    no_checked_mask = "" if value == "true" else "checked"
+
+    elif most_recent_page =="/controls.html":
+        conf_items = post_data.split("&")
+        values = {}
+        for items in conf_items:
+            name = items.split("=")[0]
+            str_value = unquote(items.split("=")[1])
+            # Each entry is checked against CONTROL_LIMITS, and the valid ones
+            # populate config for later saving to ini file, and the controls
+            # dictionary, applied 'on the fly'
+            if str_value != '':
+                try:
+                    values[name] = control_value(name, str_value, form = True)
+                except ValueError as e:
+                    message_1 = f"Control not applied, {e}"
+        apply_controls(values)
+
+    else:
+        post_data = post_data.split("=")[1]  # Value from single button presses
+
+    if post_data == 'Manual_Recording_START':
+        message_1 = "Live streaming with Manual Recording ACTIVE"
+        stop_start = "Manual_Recording_STOP"
+        record_button_colour = ACTIVE
+        for camera in cameras:
+            camera.set_manual_recording = True
+
+    elif post_data == 'Manual_Recording_STOP':
+        message_1 = """Live Streaming with Manual Recording Stopped.
+         (Short delay to close recording ..
+          then wait for next action)."""
+        stop_start = "Manual_Recording_START"
+        record_button_colour = PASSIVE
+        for camera in cameras:
+            camera.set_manual_recording = False
+
+    elif post_data == 'DELETE_ALL_FILES':
+        message_1 = """Press DELETE_ALL_FILES again to delete
+         all files - or RESET to cancel"""
+        if should_delete_files:
+            for camera in cameras:
+                os.system(f"rm {camera.directory}/*.mp4 {camera.directory}/*.jpg {camera.directory}/*.motion")
+                camera.recording_catalog.clear()
+                if camera.event_index is not None:
+                    camera.event_index.clear()
+                camera.video_count = 0
+            should_delete_files = False
+            delete_button_colour = DELETE_PASSIVE
+            message_1 = "Video files deleted and video counter reset"
+        else:
+            should_delete_files = True
+            delete_button_colour = DELETE_ACTIVE
+
+    elif post_data =='RESET':
+        message_1 = """Reset EXIT, DELETE, REBOOT and SHUTDOWN to
+         initial default conditions i.e. Cancel the first press"""
+        should_reboot = False
+        should_delete_files = False
+        should_exit = False
+        should_shutdown = False
+        exit_button_colour = PASSIVE
+        reboot_button_colour = PASSIVE
+        shutdown_button_colour = PASSIVE
+        delete_button_colour = DELETE_PASSIVE
+
+    elif post_data == 'REBOOT':
+        message_1 = """ Press REBOOT again if you're sure - or RESET
+         to cancel. (Short delay while files are saved)."""
+        if should_reboot:
+            return most_recent_page, 'reboot'
+        should_reboot = True
+        reboot_button_colour = ACTIVE
+
+    elif post_data == 'SHUTDOWN':
+        message_1 = """Press SHUTDOWN again if you're sure - or
+        RESET to cancel. (Short delay while files are saved)."""
+        if should_shutdown:
+            return most_recent_page, 'shutdown'
+        should_shutdown = True
+        shutdown_button_colour = ACTIVE
+
+    elif post_data == 'EXIT':
+        message_1 = """ Press EXIT again if you're sure - or RESET
+         to cancel. (Short delay while files are saved)."""
+        if should_exit:
+            return most_recent_page, 'exit'
+        should_exit = True
+        exit_button_colour = ACTIVE
+
+    elif post_data == 'Motion_Detect_ON':
+        message_1 = "Live streaming with Motion Detection ACTIVE"
+        motion_button = "Motion_Detect_OFF"
+        motion_button_colour = ACTIVE
+        for camera in cameras:
+            camera.trigger_level = camera.reset_trigger
+
+    elif post_data == 'Motion_Detect_OFF':
+        message_1 = "Live streaming with Motion Detection INACTIVE"
+        motion_button = "Motion_Detect_ON"
+        motion_button_colour = PASSIVE
+        for camera in cameras:
+            camera.trigger_level = INF_TRIGGER_LEVEL
+
+    elif post_data == 'Inc_TriggerLevel':
+        message_1 = """Decreasing motion sensitivity by increasing
+         trigger level"""
+        for camera in cameras:
+            if camera.trigger_level < INF_TRIGGER_LEVEL:
+                camera.trigger_level += 10
+                camera.reset_trigger += 10
+            config.set(camera.section,'trigger_level',str(camera.trigger_level))
+
+    elif post_data == 'Dec_TriggerLevel':
+        message_1 = "Increasing motion sensitivity by decreasing trigger level"
+        for camera in cameras:
+            if camera.trigger_level > 10:
+                camera.trigger_level -= 10
+                camera.reset_trigger -= 10
+            config.set(camera.section,'trigger_level',str(camera.trigger_level))
+
+    elif post_data == 'Focus_Near':
+        if lensposition < 15:
+            lensposition = lensposition + 0.5
+            controls['LensPosition'] = lensposition
+            config.set('ropey','lensposition',str(lensposition))
+            message_1 = """Moving lens to focus closer. Approximate dioptre setting = """ + str(lensposition)
+
+    elif post_data == 'Focus_Far':
+        if lensposition > 0:
+            lensposition = lensposition - 0.5
+            controls['LensPosition'] = lensposition
+            config.set('ropey','lensposition',str(lensposition))
+            message_1 = """Moving lens to focus further away. Approximate dioptre setting = """ + str(lensposition)
+
+    elif post_data == 'Trigger_Auto_Focus_Cycle':
+        success = [camera.frame_source.autofocus_cycle() for camera in cameras]
+        message_1 = """Auto Focus cycle has been triggered"""
+
+    print("Control button pressed was {}".format(post_data))
+    print()
+    for camera in cameras:
+        camera.frame_source.set_controls(controls)
+    state_changed()
+    return most_recent_page, None
+
+
+# Types and limits of the camera controls, as on the controls page, for
+# checking the controls form and /api/controls. ColourGains is a pair
+CONTROL_LIMITS = {'Brightness': (float, -1.0, 1.0),
+                  'Contrast': (float, 0.0, 32.0),
+                  'Saturation': (float, 0.0, 32.0),
+                  'AeConstraintMode': (int, 0, 3),
+                  'AeEnable': (bool, False, True),
+                  'ExposureTime': (int, 1, 10000000),
+                  'AnalogueGain': (float, 1.0, 64.0),
+                  'AeExposureMode': (int, 0, 3),
+                  'ExposureValue': (float, -8.0, 8.0),
+                  'AeMeteringMode': (int, 0, 3),
+                  'AwbMode': (int, 0, 6),
+                  'AwbEnable': (bool, False, True),
+                  'ColourGains': (tuple, 0.0, 32.0),
+                  'AfMetering': (int, 0, 1),
+                  'AfMode': (int, 0, 2),
+                  'LensPosition': (float, 0.0, 15.0),
+                  'AfRange': (int, 0, 2)}
+TYPE_NAMES = {bool: "true or false", int: "a whole number", float: "a number",
+              tuple: "a pair of numbers", str: "a string"}
+
+
+def typed_value(name, value, kind, low=None, high=None):
+    """ value, checked to be kind and within low to high, otherwise raises
+        ValueError naming the setting
+        """
+    if kind is tuple:
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise ValueError(f"{name} must be {TYPE_NAMES[kind]}")
+        parts = value
+    else:
+        parts = [value]
+    for part in parts:
+        if kind in (bool, str):
+            valid = isinstance(part, kind)
+        else:
+            # JSON true and false are not numbers here, though Python's bool is an int
+            valid = isinstance(part, int if kind is int else (int, float)) and not isinstance(part, bool)
+        if not valid:
+            raise ValueError(f"{name} must be {TYPE_NAMES[kind]}")
+        if low is not None and not low <= part <= high:
+            raise ValueError(f"{name} must be from {low} to {high}")
+    if kind is tuple:
+        return tuple(float(part) for part in parts)
+    return float(value) if kind is float else value
+
+
+def control_value(name, value, form=False):
+    """ A camera control's checked value, from JSON, or from the controls
+        form's string, where it is True, False, a number or Rg-Bg
+        """
+    if name not in CONTROL_LIMITS:
+        raise ValueError(f"{name} is not a camera control")
+    kind, low, high = CONTROL_LIMITS[name]
+    if form:
+        try:
+            if kind is bool:
+                value = {'True': True, 'False': False}[value.strip()]
+            elif kind is tuple:
+                value = [float(part) for part in value.split('-')]
+            else:
+                value = kind(value)
+        except (KeyError, ValueError):
+            raise ValueError(f"{name} must be {TYPE_NAMES[kind]}") from None
+    return typed_value(name, value, kind, low, high)
+
+
+def apply_controls(values):
+    """ Applies checked camera control values to every camera, and to config
+        for saving to the ini file
+        """
+    for name, value in values.items():
+        if ("Af" in name or "Lens" in name) and not has_autofocus:
+            continue
+        if name == "ColourGains":
+            config.set('ropey', "redcolourgain", str(value[0]))
+            config.set('ropey', "bluecolourgain", str(value[1]))
+            config.set('ropey', name, f"{value[0]}-{value[1]}")
+        else:
+            config.set('ropey', name, str(value))
+        controls[name] = value
+
+        if name == "AeEnable" and value:
+            controls.pop("ExposureTime", None)
+            controls.pop("AnalogueGain", None)
+
+        if name == "AwbEnable" and value:
+            controls.pop("ColourGains", None)
+
+    for camera in cameras:
+        camera.frame_source.set_controls(controls)
+    state_changed()
+
+
+# The settings of a POST to /api/state, as (type, low, high)
+STATE_FIELDS = {'camera': (str,),
+                'manual_recording': (bool,),
+                'motion_detection': (bool,),
+                'trigger_level': (int, 10, INF_TRIGGER_LEVEL - 1)}
+JSON_TYPES = {bool: 'boolean', int: 'integer', float: 'number', tuple: 'pair'}
+
+
+def state_value(name, value):
+    if name not in STATE_FIELDS:
+        raise ValueError(f"{name} is not a state setting")
+    value = typed_value(name, value, *STATE_FIELDS[name])
+    if name == 'camera' and value not in [camera.name for camera in cameras]:
+        raise ValueError(f"There is no camera {value}")
+    return value
+
+
+def apply_state(values):
+    """ Applies checked /api/state settings to every camera, as the home page
+        buttons do, or only to the one named by 'camera'
+        """
+    global message_1, stop_start, record_button_colour, motion_button, motion_button_colour
+    targets = [camera for camera in cameras if camera.name == values.get('camera', camera.name)]
+    if 'trigger_level' in values:
+        for camera in targets:
+            camera.reset_trigger = values['trigger_level']
+            if camera.trigger_level < INF_TRIGGER_LEVEL:
+                camera.trigger_level = camera.reset_trigger
+            config.set(camera.section, 'trigger_level', str(camera.reset_trigger))
+    if 'motion_detection' in values:
+        for camera in targets:
+            camera.trigger_level = camera.reset_trigger if values['motion_detection'] else INF_TRIGGER_LEVEL
+    if 'manual_recording' in values:
+        for camera in targets:
+            camera.set_manual_recording = values['manual_recording']
+
+    # The home page buttons and message are for every camera
+    if 'camera' not in values:
+        if 'motion_detection' in values:
+            motion_button, motion_button_colour = (("Motion_Detect_OFF", ACTIVE) if values['motion_detection']
+                                                   else ("Motion_Detect_ON", PASSIVE))
+            message_1 = (f"Live streaming with Motion Detection"
+                         f" {'ACTIVE' if values['motion_detection'] else 'INACTIVE'}")
+        if 'manual_recording' in values:
+            stop_start, record_button_colour = (("Manual_Recording_STOP", ACTIVE) if values['manual_recording']
+                                                else ("Manual_Recording_START", PASSIVE))
+            message_1 = (f"Live streaming with Manual Recording"
+                         f" {'ACTIVE' if values['manual_recording'] else 'Stopped'}")
+    state_changed()
+
+
+def render_state():
+    def camera_state(camera):
+        newest, total = camera.recording_catalog.newest(0, 1)
+        return {'name': camera.name,
+                'title': camera.title,
+                'stream': camera.stream_path,
+                'recording': camera.is_recording,
+                'manual_recording': camera.set_manual_recording,
+                'motion_detection': camera.trigger_level < INF_TRIGGER_LEVEL,
+                'trigger_level': camera.reset_trigger,
+                'recordings': total,
+                'last_recording': newest[0]['title'] if newest else None}
+
+    return json.dumps({'message': " ".join(message_1.split()),
+                       'dvr': DVR,
+                       'cameras': [camera_state(camera) for camera in cameras]}).encode('utf-8')
+
+
+def state_document():
+    """ (content, ETag) of /api/state, the home page's state and each camera's,
+        rendered again only when some of it has changed. The motion score, which
+        changes every frame, is left to /metrics
+        """
+    key = (state_version,) + tuple((camera.is_recording, camera.set_manual_recording, camera.trigger_level,
+                                    camera.reset_trigger, camera.recordings_closed,
+                                    len(camera.recording_catalog.entries)) for camera in cameras)
+    return render_cache.get('/api/state', key, render_state)
+
+
+def render_controls():
+    # A value is null while the camera sets it, as ExposureTime with AeEnable
+    return json.dumps({name: {'value': controls.get(name), 'type': JSON_TYPES[kind], 'min': low, 'max': high}
+                       for name, (kind, low, high) in CONTROL_LIMITS.items()
+                       if has_autofocus or not ("Af" in name or "Lens" in name)}).encode('utf-8')
+
+
+def controls_document():
+    """ (content, ETag) of /api/controls, each camera control's value and limits """
+    return render_cache.get('/api/controls', state_version, render_controls)
+
+
+# The JSON API, GET for the document and POST a JSON object of settings
+API_DOCUMENTS = {'/api/state': state_document,
+                 '/api/controls': controls_document}
+
+
+def api_post(path, body):
+    """ Applies a JSON object of settings POSTed to /api/state or /api/controls,
+        every one checked before any is applied. Returns the status and the
+        document after the change, or the error
+        """
+    try:
+        values = json.loads(body)
+        if not isinstance(values, dict):
+            raise ValueError("Settings must be a JSON object")
+        if path == '/api/controls':
+            apply_controls({name: control_value(name, value) for name, value in values.items()})
+        else:
+            apply_state({name: state_value(name, value) for name, value in values.items()})
+    except ValueError as e:
+        return 400, json.dumps({'error': str(e)}).encode('utf-8')
+    print(f"API change to {path} : {body}")
+    print()
+    return 200, API_DOCUMENTS[path]()[0]
+
 
 class StreamingServer(socketserver.ThreadingMixIn, HTTPServer):
     """
@@ -326,562 +1655,1432 @@ class StreamingHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_POST(self):
-        global message_1, stop_start, motion_button,lensposition,focus_button,\
-               trigger_level,reset_trigger, should_delete_files,\
-               should_shutdown, should_exit, should_reboot, mjpeg_abort,\
-               video_count, set_manual_recording, post_data,\
-               motion_button_colour, record_button_colour,\
-               exit_button_colour, reboot_button_colour,\
-               shutdown_button_colour, delete_button_colour,\
-               VIDEO_WIDTH,STREAM_WIDTH,FRAMES_PER_SECOND, most_recent_page,\
-               no_checked_noir, yes_checked_noir, no_checked_hflip,\
-               yes_checked_hflip, no_checked_vflip, yes_checked_vflip,\
-               no_checked_mask, yes_checked_mask
-
         content_length = int(self.headers['Content-Length'])  # Get data length
         post_data = self.rfile.read(content_length).decode("utf-8")  # Get the data
-
-        # If multi-parameter post data is submitted, split into items
-        if most_recent_page =="/configuration.html" and "&" in post_data  :
-            conf_items = post_data.split("&")
-            for items in conf_items:
-                name = items.split("=")[0]
-                value = items.split("=")[1]
-                # And populate config for later saving to ini file
-                if value != '':
-                    config.set('ropey',name,value)
-
-                    # Testing and setting the 'checked' status of th  4 sets of radio buttons
-                    # to ensure they reflect the current status before returning to the page
-                    if name == "is_noir" :
-                        yes_checked_noir = "checked" if value == "True" else ""
-                        no_checked_noir = "" if value == "True" else "checked"
-
-                    if name == "HFLIP" :
-                        yes_checked_hflip = "checked" if value == "True" else ""
-                        no_checked_hflip = "" if value == "True" else "checked"
-
-                    if name == "VFLIP" :
-                        yes_checked_vflip = "checked" if value == "True" else ""
-                        no_checked_vflip = "" if value == "True" else "checked"
-
-                    if name == "apply_motion_mask" :
-
-                        yes_checked_mask = "checked" if value == "True" else ""
-                        no_checked_mask = "" if value == "true" else "checked"
-
-        elif most_recent_page =="/controls.html":
-            conf_items = post_data.split("&")
-            for items in conf_items:
-                name = items.split("=")[0]
-                str_value = items.split("=")[1]
-                # And populate config for later saving to ini file
-                # But also set a controls dictionary and apply it 'on the fly'
-                if str_value != '':
-                    if name == "ColourGains":
-                        Rg = float(str_value.split("-")[0])
-                        Bg = float(str_value.split("-")[1])
-                        value=(Rg,Bg)
-                        config.set('ropey',"redcolourgain",str(Rg))
-                        config.set('ropey',"bluecolourgain",str(Bg))
-                    else:
-                        value = eval(str_value)
-
-                    if ("Af" in name or "Lens" in name)  and not has_autofocus:
-                        continue
-                    config.set('ropey',name,str_value)
-                    controls[name] = value
-
-                    if name == "AeEnable" and value == True:
-                        controls.pop("ExposureTime", None)
-                        controls.pop("AnalogueGain",None)
-
-                    if name == "AwbEnable" and value == True:
-                        controls.pop("ColourGains", None)
-
-            picam2.set_controls(controls)
-
+        if urlsplit(self.path).path in API_DOCUMENTS:
+            status, content = api_post(urlsplit(self.path).path, post_data)
+            self.send_response(status)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
         else:
-            post_data = post_data.split("=")[1]  # Value from single button presses
-
-        if post_data == 'Manual_Recording_START':
-            message_1 = "Live streaming with Manual Recording ACTIVE"
-            stop_start = "Manual_Recording_STOP"
-            record_button_colour = ACTIVE
-            set_manual_recording = True
-
-        elif post_data == 'Manual_Recording_STOP':
-            message_1 = """Live Streaming with Manual Recording Stopped.
-             (Short delay to close recording ..
-              then wait for next action)."""
-            stop_start = "Manual_Recording_START"
-            record_button_colour = PASSIVE
-            set_manual_recording = False
-
-        elif post_data == 'DELETE_ALL_FILES':
-            message_1 = """Press DELETE_ALL_FILES again to delete
-             all files - or RESET to cancel"""
-            if should_delete_files:
-                os.system("rm Videos/*.mp4 Videos/*.jpg")
-                video_count = 0
-                should_delete_files = False
-                delete_button_colour = DELETE_PASSIVE
-                message_1 = "Video files deleted and video counter reset"
-            else:
-                should_delete_files = True
-                delete_button_colour = DELETE_ACTIVE
-
-        elif post_data =='RESET':
-            message_1 = """Reset EXIT, DELETE, REBOOT and SHUTDOWN to
-             initial default conditions i.e. Cancel the first press"""
-            should_reboot = False
-            should_delete_files = False
-            should_exit = False
-            should_shutdown = False
-            exit_button_colour = PASSIVE
-            reboot_button_colour = PASSIVE
-            shutdown_button_colour = PASSIVE
-            delete_button_colour = DELETE_PASSIVE
-
-        elif post_data == 'REBOOT':
-            message_1 = """ Press REBOOT again if you're sure - or RESET
-             to cancel. (Short delay while files are saved)."""
-            if should_reboot:
-                cleanup()
-                os.system("sudo reboot now")
-            should_reboot = True
-            reboot_button_colour = ACTIVE
-
-        elif post_data == 'SHUTDOWN':
-            message_1 = """Press SHUTDOWN again if you're sure - or
-            RESET to cancel. (Short delay while files are saved)."""
-            if should_shutdown:
-                cleanup()
-                os.system("sudo shutdown now")
-            should_shutdown = True
-            shutdown_button_colour = ACTIVE
-
-        elif post_data == 'EXIT':
-            message_1 = """ Press EXIT again if you're sure - or RESET
-             to cancel. (Short delay while files are saved)."""
-            if should_exit:
-                cleanup()
-                mjpeg_abort = True
-                sys.exit(0)
-            should_exit = True
-            exit_button_colour = ACTIVE
-
-        elif post_data == 'Motion_Detect_ON':
-            message_1 = "Live streaming with Motion Detection ACTIVE"
-            motion_button = "Motion_Detect_OFF"
-            motion_button_colour = ACTIVE
-            trigger_level = reset_trigger
-
-        elif post_data == 'Motion_Detect_OFF':
-            message_1 = "Live streaming with Motion Detection INACTIVE"
-            motion_button = "Motion_Detect_ON"
-            motion_button_colour = PASSIVE
-            trigger_level = INF_TRIGGER_LEVEL
-
-        elif post_data == 'Inc_TriggerLevel':
-            message_1 = """Decreasing motion sensitivity by increasing
-             trigger level"""
-            if trigger_level < INF_TRIGGER_LEVEL:
-                trigger_level += 10
-                reset_trigger += 10
-            config.set('ropey','trigger_level',str(trigger_level))
-
-        elif post_data == 'Dec_TriggerLevel':
-            message_1 = "Increasing motion sensitivity by decreasing trigger level"
-            if trigger_level > 10:
-                trigger_level -= 10
-                reset_trigger -= 10
-            config.set('ropey','trigger_level',str(trigger_level))
-
-        elif post_data == 'Focus_Near':
-            if lensposition < 15:
-                lensposition = lensposition + 0.5
-                controls['LensPosition'] = lensposition
-                config.set('ropey','lensposition',str(lensposition))
-                message_1 = """Moving lens to focus closer. Approximate dioptre setting = """ + str(lensposition)
-
-        elif post_data == 'Focus_Far':
-            if lensposition > 0:
-                lensposition = lensposition - 0.5
-                controls['LensPosition'] = lensposition
-                config.set('ropey','lensposition',str(lensposition))
-                message_1 = """Moving lens to focus further away. Approximate dioptre setting = """ + str(lensposition)
-
-        elif post_data == 'Trigger_Auto_Focus_Cycle':
-            success = picam2.autofocus_cycle()
-            message_1 = """Auto Focus cycle has been triggered"""
-
-        print("Control button pressed was {}".format(post_data))
-        print()
-        picam2.set_controls(controls)
-        self._redirect(most_recent_page)
+            location, action = apply_post(post_data)
+            self._redirect(location)
+            if action:
+                # After this request's connection is closed
+                Thread(target = exit_ropey, args = (action,)).start()
 
 
     def log_message(self, format, *args):
         return  # This re-definition suppresses the log_message output
 
-    def _send_response_headers(self, content):
+    def _send_response_headers(self, content, content_type='text/html'):
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', content_type)
         self.send_header('Content-Length', len(content))
         self.end_headers()
         self.wfile.write(content)
 
+    def _send_cached(self, content, etag, content_type):
+        status, headers, content = conditional_response(content, etag, content_type,
+                                                        self.headers.get('If-None-Match'))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_file(self, file_path, stat, rate=DOWNLOAD_RATE):
+        # The file goes straight from the page cache to the socket with sendfile(),
+        # which also leaves the GIL free for the other threads while it waits
+        status, headers, byte_range = file_response(file_path, stat,
+                                                    {name.lower(): value for name, value in self.headers.items()})
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if byte_range is None:
+            return
+        offset, length = byte_range
+        start = time()
+        sent = 0
+        try:
+            with open(file_path, 'rb') as f:
+                while sent < length:
+                    count = os.sendfile(self.connection.fileno(), f.fileno(), offset + sent,
+                                        min(DOWNLOAD_CHUNK, length - sent))
+                    if count == 0:
+                        break
+                    sent += count
+                    delay = download_delay(sent, start, rate)
+                    if delay > 0:
+                        sleep(delay)
+        except OSError:
+            pass  # Browsers drop the connection when seeking
+
     def do_GET(self):
         global most_recent_page
-        # HTML descriptions of dynamic home and configuration pages
-        HOMEPAGE = """\
-            <!DOCTYPE html>
-              <html lang="en">
-                <head>
-                  <meta charset="UTF-8">
-                  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                  <title>{ph0}</title>
-                </head>
-                <body>
-                  <center>
-                    <h2>{ph0} Live Streaming with motion-triggered Recording</h2>
-                    <img src="stream.mjpg" width="{ph1}" height="{ph2}" />
-                    <p> {ph3}  </p>
-                    <form action="/" method="POST">
-                      <input type="submit" name="submit" value="{ph4}"style = "{ph6}">
-                      <input type="submit" name="submit" value="Inc_TriggerLevel">
-                      <input type="submit" name="submit" value="Dec_TriggerLevel">
-                      <input type="submit" name="submit" value="{ph5}" style = "{ph7}">
-                    </form>
-                    <p> </p>
-                      {ph50}
-                    <p> </p>
-                    <form action="/" method="POST">
-                      <input type="submit" name="submit" value="DELETE_ALL_FILES" style = "{ph11}">
-                      <input type="submit" name="submit" value="EXIT" style = "{ph8}">
-                      <input type="submit" name="submit" value="RESET" style = "background-color:lightgreen;">
-                      <input type="submit" name="submit" value="REBOOT" style ="{ph9}">
-                      <input type="submit" name="submit" value="SHUTDOWN" style= "{ph10}">
-                    </form>
-                    <br>
-                      <a href="/configuration.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Configuration  Entry  Page</a>
-                      <a href="/controls.html" style="border: 1px solid lightgrey; padding: 6px;background-color: lightgrey; text-decoration: none;">Camera Control Entry Page</a>
-                  </center>
-                </body>
-              </html>
-            """.format(ph0 = camera_title,
-                       ph1 = STREAM_WIDTH,
-                       ph2 = STREAM_HEIGHT,
-                       ph3 = message_1,
-                       ph4 = motion_button,
-                       ph5 = stop_start,
-                       ph6 = motion_button_colour,
-                       ph7 = record_button_colour,
-                       ph8 = exit_button_colour,
-                       ph9 = reboot_button_colour,
-                       ph10 = shutdown_button_colour,
-                       ph11 = delete_button_colour,
-                       ph50 = focus_button)
-
-        CONFPAGE = """\
-            <!DOCTYPE html>
-              <html lang="en">
-                <html>
-                <head><title>Configuration Entry</title></head>
-                <body>
-                  <center>
-                  <a href="/"style="border: 1px solid lightgrey; padding: 10px;background-color: lightgrey; text-decoration: none;">Back to Home / Streaming Page </a>
-                    <h2>Ropey-Cam Configuration Entry Page</h2>
-                    <p> </p>
-                    <form action="/" method="POST">
-                      <label for "VIDEO_WIDTH">VIDEO WIDTH </label>
-                      <input type="number" id="VIDEO_WIDTH" name="VIDEO_WIDTH" placeholder = {ph12} min="1024"  max="1920"step="32" style ="margin-right: 12px"  >
-
-                      <label for "STREAM_WIDTH">STREAM WIDTH</label>
-                      <input type="number" id="STREAM_WIDTH" name="STREAM_WIDTH" placeholder = {ph13} min="384" max="1280"step="128" style ="margin-right: 12px">
-
-                      <label for "ASPECT_RATIO">ASPECT RATIO</label>
-                      <input type="number" id="ASPECT_RATIO" name="ASPECT_RATIO" placeholder = {ph14} min="1.333" max="2.221"step=".444">
-                      <p></p>
-                      <label for "FRAMES_PER_SECOND">FPS</label>
-                      <input type="number" id="FRAMES_PER_SECOND" name="FRAMES_PER_SECOND" placeholder = {ph15} min="10" max="30"step="5" style="margin-right: 20px">
-
-                      <label for "SENSOR_MODE">MODE</label>
-                      <input type="number" id="SENSOR_MODE" name="SENSOR_MODE" placeholder = {ph16} min="0" max={ph17} style="margin-right: 20px">
-
-                      <label for "HFLIP"> Sensor Hflip -> Off </label>
-                      <input type="radio" name="HFLIP" value = False {ph18} >
-
-                      <label for "HFLIP">On</label>
-                      <input type="radio" name="HFLIP" value = True {ph19} style="margin-right: 30px">
-
-                      <label for "VFLIP"> Sensor Vflip -> Off </label>
-                      <input type="radio" name="VFLIP" value = False {ph20} >
-
-                      <label for "VFLIP">On</label>
-                      <input type="radio" name="VFLIP" value = True {ph21} >
-                      <p></p>
-                      <label for "trigger_level">Trigger @</label>
-                      <input type="text" size = 4 id="trigger_level" name="trigger_level" placeholder = {ph22}>
-
-                      <label for "AFTER_FRAMES"># Frames</label>
-                      <input type="number" style = "width: 40px" id="AFTER_FRAMES" name="AFTER_FRAMES" placeholder = {ph23} min="0" max="50">
-
-                      <label for "BUFFER_SECONDS"> Buffer</label>
-                      <input type="number" style = "width: 40px" id="BUFFER_SECONDS" name="BUFFER_SECONDS" placeholder ={ph24} min ="1" max="10">
-
-                      <label for "POST_ROLL">Post Roll</label>
-                      <input type="number" style = "width: 40px" id="POST_ROLL" name = "POST_ROLL" placeholder = {ph25} min ="1" max="10">
-
-                      <label for "MAX_DISK_USAGE">Storage Limit</label>
-                      <input type="number" style = "width: 50px" id="MAX_DISK_USAGE" name = "MAX_DISK_USAGE" placeholder = {ph26} min ="0.1" max="0.975" step="0.025">
-                      <p></p>
-                      <label for "apply_motion_mask"> Motion Mask Off</label>
-                      <input type="radio" name="apply_motion_mask" value = False {ph27}>
-
-                      <label for "apply_motion_mask"> On</label>
-                      <input type="radio" name="apply_motion_mask" value = True {ph28} style = "margin-right: 50px">
-
-                      <label for "mask_name">Mask File Name.pgm</label>
-                      <input type="text" id="mask_name" name="mask_name" placeholder = {ph29}>
-                      <p></p>
-                      <label for "is_noir"> Is the camera module a No IR filter ('noir') version ? No</label>
-                      <input type="radio" name="is_noir" value = False {ph30} >
-
-                      <label for "is_noir"> Yes</label>
-                      <input type="radio" name="is_noir" value = True {ph31} style = "margin-right: 50px">
-                      <p></p>
-                      <label for "camera_title">Custom camera title (Alphanumerics and hyphens or underscores only, no spaces or special characters).</label>
-                      <input type="text" id="camera_title" name="camera_title" placeholder = {ph34}>
-                      <p></p>
-                      <input type="submit" value="Submit to apply changes to internal config file">
-                    </form>
-                    <p></p>
-                    <h3>The submitted configuration change takes effect on restart/reboot</h3>
-                    <form action="/" method="POST">
-                      <input type="submit" name="submit" value="EXIT" style ="{ph32}">
-                      <input type="submit" name="submit" value="REBOOT" style ="{ph33}">
-                    </form>
-                  </center>
-                </body>
-                </html>
-                """.format(ph12 = VIDEO_WIDTH,
-                           ph13 = STREAM_WIDTH,
-                           ph14 = ASPECT_RATIO,
-                           ph15 = FRAMES_PER_SECOND,
-                           ph16 = SENSOR_MODE,
-                           ph17 = str(max_mode),
-                           ph18 = no_checked_hflip,
-                           ph19 = yes_checked_hflip,
-                           ph20 = no_checked_vflip,
-                           ph21 = yes_checked_vflip,
-                           ph22 = trigger_level,
-                           ph23 = AFTER_FRAMES,
-                           ph24 = BUFFER_SECONDS,
-                           ph25 = POST_ROLL,
-                           ph26 = MAX_DISK_USAGE,
-                           ph27 = no_checked_mask,
-                           ph28 = yes_checked_mask,
-                           ph29 = mask_name,
-                           ph30 = no_checked_noir,
-                           ph31 = yes_checked_noir,
-                           ph32 = exit_button_colour,
-                           ph33 = reboot_button_colour,
-                           ph34 = camera_title
-                           )
-        CONTROLPAGE = """\
-            <!DOCTYPE html>
-              <html lang="en">
-                <html>
-                  <title>Camera Controls Entry</title>
-                   </head>
-                        <body>
-                          <center>
-                          <a href="/" style="border: 1px solid lightgrey; padding: 10px;background-color: lightgrey; text-decoration: none;">Back to Home / Streaming Page </a>
-                            <h3>Ropey-Cam Camera Control Entry Page</h3>
-                            <p> </p>
-                            <form action="/" method = "POST">
-                                <label for "Brightness"> Brightness (-1.0 through (0.0)  to   +1.0)  </label>
-                                <input type = "number" id = "Brightness" name = "Brightness"  min ="-1.0" max="1.0" step="0.025" value ={ph40} >
-                              <p></p> 
-                                <label for "Contrast"> Contrast (0.0 through (1.0)  to  32.0)</label>
-                                <input type = "number" id = "Contrast" name = "Contrast" min ="0.0" max="32.0" step="0.025" value ={ph41} >
-                              <p></p>
-                                <label for "Saturation"> Saturation (0.0 through (1.0)  to  32.0)</label>
-                                <input type = "number" id = "Saturation" name = "Saturation" min ="0.0" max="32.0" step="0.025" value ={ph42} >
-                                <p></p>
-                              <p></p>
-                                <label for = "AeConstraintMode"> AeConstraintMode :</label>
-                                  <select id = "AeConstraintMode" name ="AeConstraintMode">
-                                    <option value=""></option>
-                                    <option value = 0> Normal </option>
-                                    <option value = 1> Highlight </option>
-                                    <option value = 2> Shadows </option>
-                                    <option value = 3> Custom </option>
-                                  </select>
-                              <p></p>
-                                <label for = "AeEnable"> AeEnable :</label>
-                                  <select id = "AeEnable" name = "AeEnable">
-                                    <option value = ""></option>
-                                    <option value = True > True </option>
-                                    <option value = False > False </option>
-                                  </select>
-                              <p></p>
-                                <label for ="ExposureTime"> ExposureTime (microseconds)</label>
-                                <input type = "number" id = "ExposureTime" name = "ExposureTime" placeholder = {ph43}>
-                              <p></p>
-                                <label for = "AnalogueGain">AnalogueGain</label>
-                                <input type = "number" id = "AnalogueGain" name = "AnalogueGain" placeholder = {ph44}> 
-                              <p></p>
-                                <label for = "AeExposureMode"> AeExposureMode :</label>
-                                  <select id = "AeExposureMode" name="AeExposureMode">
-                                    <option value = ""></option>
-                                    <option value = 0> Normal </option>
-                                    <option value = 1> Short </option>
-                                    <option value = 2> Long </option>
-                                    <option value = 3> Custom </option>
-                                  </select>
-                              <p></p>
-                                <label for = "ExposureValue"> ExposureValue (-8.0 through (0.0)  to  8.0 ) </label>
-                                <input type = "number" id = "ExposureValue" name = "ExposureValue" min ="-8.0" max="8.0" step="0.05" value ={ph45} >
-                              <p></p>
-                                <label for = "AeMeteringMode"> AeMeteringMode :</label>
-                                  <select id = "AeMeteringMode" name = "AeMeteringMode">
-                                    <option value = ""></option>
-                                    <option value = 0> CentreWeighted </option>
-                                    <option value = 1> Spot </option>
-                                    <option value = 2> Matrix </option>
-                                    <option value = 3> Custom </option>
-                                  </select>
-                              <p></p>
-                                <label for = "AwbMode"> AwbMode :</label>
-                                  <select id = "AwbMode" name = "AwbMode">
-                                    <option value = ""></option>
-                                    <option value = 0> Auto </option>
-                                    <option value = 1> Tungsten </option>
-                                    <option value = 2 >Fluorescent </option>
-                                    <option value = 3> Indoor </option>
-                                    <option value = 4> Daylight </option>
-                                    <option value = 5> Cloudy</option>
-                                    <option value = 6> Custom </option>
-                                  </select>
-                              <p></p>
-                                <label for ="AwbEnable"> AwbEnable :</label>
-                                  <select id = "AwbEnable" name ="AwbEnable">
-                                    <option value = ""> </option>
-                                    <option value= True> True </option>
-                                    <option value = False> False </option>
-                                  </select>
-                              <p></p>
-                                <label for = "ColourGains"> ColourGains (Rg hyphen Bg) Rg-Bg</label>
-                                <input type = "text" id = "ColourGains" name = "ColourGains">
-                              <p></p>
-                              <label for ="AfMetering"> AfMetering :</label>
-                                <select id = "AfMetering" name ="AfMetering">
-                                  <option value = ""> </option>
-                                  <option value = 0 > Auto </option>
-                                  <option value = 1 > Windows </option>
-                                </select>
-                              <p></p>
-                                <label for = "AFMode"> AfMode :</label>
-                                  <select id = "AfMode" name="AfMode">
-                                    <option value = ""></option>
-                                    <option value = 0> Manual </option>
-                                    <option value = 1> Auto </option>
-                                    <option value = 2> Continuous </option>
-                                  </select>
-                              <p></p>
-                                <label for "LensPosition"> LensPosition (0.0 through (1.0)  to   15.0)  </label>
-                                <input type = "number" id = "LensPosition" name = "LensPosition" placeholder = "1.0"  >
-                              <p></p>
-                                <label for = "AFRange"> AfRange :</label>
-                                  <select id = "AfRange" name="AfRange">
-                                    <option value = ""></option>
-                                    <option value = 0> Normal </option>
-                                    <option value = 1> Macro </option>
-                                    <option value = 2> Full </option>
-                                  </select>
-                              <p></p>
-                                <input type = "submit" value = "Submit to apply control changes to internal config file and immediately to camera">
-                            </form>
-                          </center>
-                         </body>
-                        </html>
-                        """.format(ph40 = controls["Brightness"],
-                                   ph41 = controls["Contrast"],
-                                   ph42 = controls["Saturation"],
-                                   ph43 = exposuretime,
-                                   ph44 = analoguegain,
-                                   ph45 = controls["ExposureValue"])
 
         if self.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
 
-        elif self.path == '/index.html':
-            most_recent_page = '/index.html'
-            content = HOMEPAGE.encode('utf-8')
-            self._send_response_headers(content)
+        elif self.path in PAGES:
+            most_recent_page = self.path
+            self._send_cached(*render_page(self.path), 'text/html')
+
+        elif urlsplit(self.path).path in API_DOCUMENTS:
+            self._send_cached(*API_DOCUMENTS[urlsplit(self.path).path](), 'application/json')
+
+        elif self.path in DATA_PAGES:
+            page, content_type = DATA_PAGES[self.path]
+            self._send_response_headers(page().encode('utf-8'), content_type)
+
+        elif urlsplit(self.path).path == '/recordings.html':
+            self._send_response_headers(recordings_page(self.path).encode('utf-8'))
+
+        elif urlsplit(self.path).path in ('/heatmap.png', '/heatmap.json') and HEATMAP:
+            self._send_response_headers(*heatmap_page(self.path))
+
+        elif urlsplit(self.path).path == '/events.json' and DVR:
+            self._send_response_headers(*events_page(self.path))
 
-        elif self.path == '/configuration.html':
-            most_recent_page = '/configuration.html'
-            content = CONFPAGE.encode('utf-8')
-            self._send_response_headers(content)
+        elif self.path.startswith('/Videos/') and (found := recording_file(self.path)):
+            self._send_file(*found)
 
-        elif self.path == '/controls.html':
-            most_recent_page = '/controls.html'
-            content = CONTROLPAGE.encode('utf-8')
-            self._send_response_headers(content)
+        elif self.path.startswith('/live/') and (found := live_file(self.path)):
+            self._send_file(*found, rate = 0)
 
-        elif self.path == '/stream.mjpg':
+        elif urlsplit(self.path).path == '/hls.min.js' and (found := hls_js_file()):
+            self._send_file(*found, rate = 0)
+
+        elif urlsplit(self.path).path in stream_cameras:
+            broadcaster = stream_cameras[urlsplit(self.path).path].mjpeg_broadcaster
             self.send_response(200)
             self.send_header('Age', 0)
             self.send_header('Cache-Control', 'no-cache, private')
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+            subscriber = broadcaster.subscribe(self.client_address[0],
+                                               stream_variant(self.path))
             try:
                 while True:
-                    with mjpeg_condition:
-                        mjpeg_condition.wait()
-                        frame = mjpeg_frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
+                    self.wfile.write(broadcaster.get(subscriber))
+                    broadcaster.written(subscriber)
             except Exception as e:
                 pass
+            finally:
+                broadcaster.unsubscribe(subscriber)
 
         else:
             self.send_error(404)
             self.end_headers()
 
 
+class AsyncStreamingServer:
+    """
+    Single threaded alternative to StreamingServer, serving the same pages,
+    POST controls and mjpeg stream from one asyncio event loop.
+    Stream clients take their chunks from their camera's mjpeg broadcaster.
+    The encoder threads only wake the loop, via call_soon_threadsafe, and every write
+    waits on drain(), so a client's socket backpressure just lets its own
+    drop-oldest queue fill up.
+    POSTs run in a worker thread, as some buttons wait for recordings to close.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        # Events of stream clients waiting for a frame, by camera
+        self.waiting = {camera.name: set() for camera in cameras}
+
+    def frame_ready(self, camera):
+        for event in self.waiting[camera.name]:
+            event.set()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        for camera in cameras:
+            camera.mjpeg_broadcaster.add_listener(
+                lambda camera=camera: loop.call_soon_threadsafe(self.frame_ready, camera))
+        host, port = self.address
+        self.server = await asyncio.start_server(self.handle, host or None, port,
+                                                 reuse_address = True)
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            # Closed by an exit action. The loop keeps running the connected
+            # clients, and the encoder threads' wake ups, until the process exits
+            await loop.create_future()
+
+    async def send(self, writer, status, headers, content=b''):
+        head = [f"HTTP/1.0 {status} {HTTPStatus(status).phrase}"]
+        head += [f"{name}: {value}" for name, value in headers]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + content)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        global most_recent_page
+        address = writer.get_extra_info('peername')[0]
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[:2]
+
+            if method == 'POST':
+                content_length = int(headers.get('content-length', 0))
+                post_data = (await reader.readexactly(content_length)).decode("utf-8")
+                if urlsplit(path).path in API_DOCUMENTS:
+                    status, content = await asyncio.get_running_loop().run_in_executor(
+                        None, api_post, urlsplit(path).path, post_data)
+                    await self.send(writer, status, [('Content-type', 'application/json'),
+                                                     ('Content-Length', len(content))], content)
+                else:
+                    location, action = await asyncio.get_running_loop().run_in_executor(None, apply_post, post_data)
+                    await self.send(writer, 303, [('Content-type', 'text/html'), ('Location', location)])
+                    if action:
+                        Thread(target = exit_ropey, args = (action,)).start()
+                        self.server.close()
+
+            elif path == '/':
+                await self.send(writer, 301, [('Location', '/index.html')])
+
+            elif path in PAGES:
+                most_recent_page = path
+                await self.send(writer, *conditional_response(*render_page(path), 'text/html',
+                                                              headers.get('if-none-match')))
+
+            elif urlsplit(path).path in API_DOCUMENTS:
+                await self.send(writer, *conditional_response(*API_DOCUMENTS[urlsplit(path).path](),
+                                                              'application/json', headers.get('if-none-match')))
+
+            elif path in DATA_PAGES:
+                page, content_type = DATA_PAGES[path]
+                content = page().encode('utf-8')
+                await self.send(writer, 200, [('Content-type', content_type),
+                                              ('Content-Length', len(content))], content)
+
+            elif urlsplit(path).path == '/recordings.html':
+                content = recordings_page(path).encode('utf-8')
+                await self.send(writer, 200, [('Content-type', 'text/html'),
+                                              ('Content-Length', len(content))], content)
+
+            elif urlsplit(path).path in ('/heatmap.png', '/heatmap.json') and HEATMAP:
+                content, content_type = heatmap_page(path)
+                await self.send(writer, 200, [('Content-type', content_type),
+                                              ('Content-Length', len(content))], content)
+
+            elif urlsplit(path).path == '/events.json' and DVR:
+                content, content_type = events_page(path)
+                await self.send(writer, 200, [('Content-type', content_type),
+                                              ('Content-Length', len(content))], content)
+
+            elif path.startswith('/Videos/') and (found := recording_file(path)):
+                await self.send_file(writer, headers, *found)
+
+            elif path.startswith('/live/') and (found := live_file(path)):
+                await self.send_file(writer, headers, *found, rate = 0)
+
+            elif urlsplit(path).path == '/hls.min.js' and (found := hls_js_file()):
+                await self.send_file(writer, headers, *found, rate = 0)
+
+            elif urlsplit(path).path in stream_cameras:
+                await self.stream(writer, address, stream_variant(path), stream_cameras[urlsplit(path).path])
+
+            else:
+                await self.send(writer, 404, [('Content-Length', 0)])
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send_file(self, writer, headers, file_path, stat, rate=DOWNLOAD_RATE):
+        # loop.sendfile() uses os.sendfile(), so file bytes are never copied through Python
+        status, response, byte_range = file_response(file_path, stat, headers)
+        await self.send(writer, status, response)
+        if byte_range is None:
+            return
+        offset, length = byte_range
+        start = time()
+        sent = 0
+        with open(file_path, 'rb') as f:
+            while sent < length:
+                count = await asyncio.get_running_loop().sendfile(
+                    writer.transport, f, offset + sent, min(DOWNLOAD_CHUNK, length - sent))
+                if count == 0:
+                    break
+                sent += count
+                delay = download_delay(sent, start, rate)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+    async def stream(self, writer, address, variant, camera):
+        await self.send(writer, 200, [('Age', 0),
+                                      ('Cache-Control', 'no-cache, private'),
+                                      ('Pragma', 'no-cache'),
+                                      ('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')])
+        broadcaster = camera.mjpeg_broadcaster
+        subscriber = broadcaster.subscribe(address, variant)
+        event = asyncio.Event()
+        self.waiting[camera.name].add(event)
+        try:
+            while True:
+                # Clear before polling so a publish in between still wakes us
+                event.clear()
+                chunk = broadcaster.poll(subscriber)
+                if chunk is None:
+                    await event.wait()
+                    continue
+                writer.write(chunk)
+                await writer.drain()
+                broadcaster.written(subscriber)
+        finally:
+            self.waiting[camera.name].discard(event)
+            broadcaster.unsubscribe(subscriber)
+
+
+async def stream_load_client(host, port, seconds, results):
+    """ One simulated viewer for the load test, counting frames received """
+    frames = received = 0
+    tail = b''
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b'GET /stream.mjpg HTTP/1.0\r\n\r\n')
+        await writer.drain()
+        end = asyncio.get_running_loop().time() + seconds
+        while asyncio.get_running_loop().time() < end:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+            frames += (tail + data).count(b'--FRAME')
+            tail = data[-6:]
+        writer.close()
+    except OSError:
+        pass
+    results.append((frames / seconds, received * 8 / seconds / 1e6))
+
+
+async def stream_load_test(host, port, clients, seconds):
+    results = []
+    await asyncio.gather(*(stream_load_client(host, port, seconds, results)
+                           for _ in range(clients)))
+    return results
+
+
+def run_stream_load_test(target, clients, seconds=30):
+    """ Connects a number of simulated viewers to a running Ropey-Cam's stream
+        and prints the frame rate each one received
+        """
+    host, _, port = target.partition(':')
+    results = asyncio.run(stream_load_test(host, int(port or 8000), clients, seconds))
+    rates = sorted(fps for fps, _ in results)
+    print(f"{clients} viewers for {seconds} s : fps per viewer min {rates[0]:.1f},"
+          f" median {rates[len(rates) // 2]:.1f}, max {rates[-1]:.1f},"
+          f" total {sum(mbits for _, mbits in results):.1f} Mbit/s")
+
+
 def update_ini_file():
     with open('ropey.ini', 'w') as configfile:
         config.write(configfile)
 
 
-def apply_timestamp(request):
+class TextAtlas:
+    """
+    Outlined overlay text in one font, scale and thickness, drawn as pieces.
+    Each piece is rendered once with cv2.putText() into a band with the
+    frame's own edges, so strokes are clipped just as they would be on the
+    frame, and kept as outline and fill masks over the region it covers.
+    The text that changes every frame is passed one character per piece, so
+    after the first few frames every digit at every position is cached and a
+    frame costs one masked copy per piece instead of rasterising the text.
+    All outlines are copied before any fill, the order putText() of the whole
+    string with the outline and then the fill thickness draws them in, which
+    gives the same pixels when pen positions are whole pixels, as at scale 1
+    with a binary font renderer. A self check at startup falls back to
+    putText() of the whole string when it does not, e.g. antialiased fonts.
+    """
+
+    CACHE_SIZE = 512
+
+    def __init__(self, font, scale, thickness, outline):
+        self.font = font
+        self.scale = scale
+        self.thickness = thickness
+        self.outline = outline
+        (_, height), _ = cv2.getTextSize('0', font, scale, outline)
+        self.reach = 3 * height  # Rows below the origin that glyphs never reach
+        self.masks_cache = {}
+        self.solids = {}
+        self.exact = True
+        self.exact = self.self_check()
+
+    def masks(self, text, origin, shape):
+        """ (rows, columns, outline mask, fill mask) of text put on a frame of
+            shape, or None when it puts nothing there
+            """
+        key = (text, origin, shape[:2])
+        if key not in self.masks_cache:
+            if len(self.masks_cache) >= self.CACHE_SIZE:
+                del self.masks_cache[next(iter(self.masks_cache))]  # Oldest first
+            band = zeros((min(shape[0], max(origin[1] + self.reach, 0)), shape[1]), dtype = uint8)
+            cv2.putText(band, text, origin, self.font, self.scale, 1, self.outline)
+            cv2.putText(band, text, origin, self.font, self.scale, 2, self.thickness)
+            rows, columns = band.nonzero()
+            if rows.size:
+                region = (slice(rows.min(), rows.max() + 1), slice(columns.min(), columns.max() + 1))
+                band = band[region]
+                self.masks_cache[key] = region + ((band == 1).view(uint8), (band == 2).view(uint8))
+            else:
+                self.masks_cache[key] = None
+        return self.masks_cache[key]
+
+    def solid(self, value, shape):
+        """ An array of shape filled with pixel value, kept for reuse """
+        key = (value, shape)
+        if key not in self.solids:
+            if len(self.solids) >= self.CACHE_SIZE:
+                del self.solids[next(iter(self.solids))]
+            self.solids[key] = full(shape, value, dtype = uint8)
+        return self.solids[key]
+
+    @staticmethod
+    def pixel(colour, frame):
+        """ A putText() colour as a pixel value of frame """
+        colour = colour if isinstance(colour, tuple) else (colour,)
+        if frame.ndim == 2:
+            return colour[0]
+        return (colour + (0,) * 4)[:frame.shape[2]]
+
+    def stamp(self, frame, pieces, origin, colour, outline_colour):
+        """ Draws the pieces of text one after another from origin, as putText()
+            of the joined text in outline_colour with the outline thickness and
+            then in colour with the fill thickness would
+            """
+        if not self.exact:
+            text = ''.join(pieces)
+            cv2.putText(frame, text, origin, self.font, self.scale, outline_colour, self.outline)
+            cv2.putText(frame, text, origin, self.font, self.scale, colour, self.thickness)
+            return
+        placed = []
+        x, y = origin
+        for text in pieces:
+            masks = self.masks(text, (x, y), frame.shape)
+            if masks:
+                placed.append(masks)
+            x += cv2.getTextSize(text, self.font, self.scale, 0)[0][0]
+        # A piece's outline mask leaves out its own fill, so copying it after
+        # an earlier piece's fill only covers what putText() would cover
+        for paint, index in ((outline_colour, 2), (colour, 3)):
+            value = self.pixel(paint, frame)
+            for masks in placed:
+                region = frame[masks[0], masks[1]]
+                cv2.copyTo(self.solid(value, region.shape), masks[index], region)
+
+    def self_check(self):
+        """ Whether stamp() gives the same pixels as putText() of the whole string """
+        pieces = ("Cam-1 18/", *"0123456789", "/|jW.")
+        text = ''.join(pieces)
+        for origin in ((4, 26), (-7, 3)):
+            reference = full((64, 320, 3), 128, dtype = uint8)
+            stamped = reference.copy()
+            cv2.putText(reference, text, origin, self.font, self.scale, BLACK, self.outline)
+            cv2.putText(reference, text, origin, self.font, self.scale, colour, self.thickness)
+            self.stamp(stamped, pieces, origin, colour, BLACK)
+            if not array_equal(reference, stamped):
+                return False
+        return True
+
+
+overlay_atlas = TextAtlas(font, scale, thickness, thickness + 4)
+
+
+def timestamp_pieces(title, score):
+    """ The recorded frame timestamp, with its fixed part, which changes once
+        a second, as one piece and the rest one character per piece
+        """
     clock_time = datetime.now()
     milliseconds = clock_time.microsecond // 1000
-    timestamp = f"""{camera_title}   {clock_time:%d/%m/%Y      %H:%M:%S}.{milliseconds:03d}     {total_motion:06d}"""
+    return (f"{title}   {clock_time:%d/%m/%Y      %H:%M:%S}.",
+            *f"{milliseconds:03d}     {score:06d}")
+
+
+def stamp_frame(frame, title, score):
+    overlay_atlas.stamp(frame, timestamp_pieces(title, score), origin_offset, colour, BLACK)
+
+
+def apply_timestamp(camera, request):
+    start = perf_counter()
     with MappedArray(request, "main") as m:
-        cv2.putText(m.array, timestamp, origin_offset, font, scale, BLACK, thickness + 4)
-        cv2.putText(m.array, timestamp, origin_offset, font, scale, colour, thickness)
+        stamp_frame(m.array, camera.title, camera.total_motion)
+    camera.pre_callback_latency.observe(perf_counter() - start)
+
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class LatencyHistogram:
+    """
+    Prometheus histogram of durations in seconds, of one camera's stage.
+    Each camera has its own histograms, and each is only observed from the
+    one thread that runs its stage for that camera, so observe() needs no
+    lock and costs a bisect and three additions per frame.
+    A scrape can catch an observation half added, which is one count out
+    until the next scrape.
+    """
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+    def samples(self, label):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum{{{label}}} {self.sum:.6f}")
+        lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+def metrics_page():
+    """ The /metrics page, Prometheus text format. Read without locks, from the
+        running totals the threads keep anyway, so scraping costs the hot path nothing.
+        Every figure, the stage latency histograms included, is per camera
+        """
+    lines = []
+    for stage, histogram in enumerate(cameras[0].latency_histograms):
+        lines += histogram.header()
+        for camera in cameras:
+            lines += camera.latency_histograms[stage].samples(f'camera="{camera.name}"')
+
+    def metric(name, kind, help, sample):
+        lines.extend((f"# HELP {name} {help}", f"# TYPE {name} {kind}"))
+        for camera in cameras:
+            label = f'camera="{camera.name}"'
+            lines.extend(f"{name}{{{label}{',' if labels else ''}{labels}}} {value}"
+                         for labels, value in sample(camera))
+
+    metric('ropey_frames_captured_total', 'counter', 'Lo-res frames captured.',
+           lambda camera: [('', camera.lores_pool.sequence)])
+    metric('ropey_frames_missed_total', 'counter', 'Lo-res frames lost, by stage.',
+           lambda camera: [('stage="pool"', camera.lores_pool.dropped),
+                           ('stage="motion"', camera.motion_frames_missed),
+                           ('stage="mjpeg"', camera.mjpeg_frames_missed)])
+    metric('ropey_jpeg_bytes_total', 'counter', 'Bytes of jpeg encoded for the stream.',
+           lambda camera: [('', camera.jpeg_bytes_encoded)])
+    metric('ropey_stream_clients', 'gauge', 'Connected stream clients.',
+           lambda camera: [('', len(camera.mjpeg_broadcaster.subscribers))])
+    metric('ropey_recordings_opened_total', 'counter', 'Recordings opened.',
+           lambda camera: [('', camera.recordings_opened)])
+    metric('ropey_recordings_closed_total', 'counter', 'Recordings closed.',
+           lambda camera: [('', camera.recordings_closed)])
+    metric('ropey_recording', 'gauge', '1 while a recording is open.',
+           lambda camera: [('', int(camera.is_recording))])
+    metric('ropey_motion_frame_max_seconds', 'gauge', 'Longest time spent on one analysed motion frame.',
+           lambda camera: [('', f"{camera.motion_max_stall:.6f}")])
+    metric('ropey_motion_detection_stride', 'gauge', 'Motion analysis runs every Nth frame.',
+           lambda camera: [('', camera.detection_stride)])
+    metric('ropey_startup_seconds', 'gauge', 'Time from start to each startup stage.',
+           lambda camera: [(f'stage="{stage}"', f"{seconds:.3f}") for stage, seconds in camera.startup.items()])
+    return "\n".join(lines) + "\n"
+
+
+# Start to end timestamp indexes, into the (sequence, sensor, capture, encode,
+# socket write) times of latency mode frames, of each stage on /latency.html
+LATENCY_STAGES = (('sensor to capturebuffer', 1, 2),
+                  ('capturebuffer to encoded', 2, 3),
+                  ('encoded to socket write', 3, 4),
+                  ('sensor to socket write', 1, 4))
+
+
+def latency_data():
+    """ The /latency.json figures, the camera's clock and the mean and worst
+        time of each stage over the last frames written to the first camera's
+        stream clients
+        """
+    samples = list(cameras[0].mjpeg_broadcaster.latency)
+    stages = []
+    for name, start, end in LATENCY_STAGES:
+        times = [1000 * (sample[end] - sample[start]) for sample in samples]
+        if times:
+            stages.append({'name': name, 'mean_ms': round(sum(times) / len(times), 1),
+                           'max_ms': round(max(times), 1)})
+    return json.dumps({'now': monotonic(), 'latency_mode': LATENCY_MODE, 'frames': len(samples),
+                       'stages': stages,
+                       'settings': {'stream': f"{STREAM_WIDTH}x{STREAM_HEIGHT}", 'fps': FRAMES_PER_SECOND,
+                                    'low_q': LOW_Q, 'buffer_count': BUFFER_COUNT,
+                                    'stream_queue_frames': STREAM_QUEUE_FRAMES}})
+
+
+# Pages of data rather than HTML, with their content types
+DATA_PAGES = {'/metrics': (metrics_page, METRICS_CONTENT_TYPE),
+              '/latency.json': (latency_data, 'application/json')}
+
+
+class StreamSubscriber:
+    """ Per-client queue of multipart chunks and its lag / drop counters """
+
+    def __init__(self, address, queue_frames, variant):
+        self.address = address
+        self.variant = variant
+        self.queue = deque(maxlen = queue_frames)
+        self.sequence = 0  # Sequence number of the last chunk handed to the client
+        self.stamps = None  # Latency mode times of the last chunk handed to the client
+        self.sent = 0
+        self.dropped = 0
+        self.max_lag = 0
+
+
+class MjpegBroadcaster:
+    """
+    Encode-once fan-out of the mjpeg stream.
+    Each jpeg is wrapped in its multipart boundary and headers once, and the
+    finished chunk is appended to the bounded queue of every subscriber to
+    that stream variant. A full queue drops its oldest chunk, so publish()
+    never waits on a client and a slow client only ever falls behind on its own.
+    """
+
+    def __init__(self, queue_frames):
+        self.queue_frames = max(1, queue_frames)
+        self.subscribers = []
+        self.listeners = []
+        self.sequences = {}  # Chunks published so far, per variant
+        self.latency = deque(maxlen = LATENCY_SAMPLES)  # Latency mode times of chunks written
+        self.condition = Condition()
+
+    def publish(self, jpeg, variant=DEFAULT_STREAM_VARIANT, stamps=None):
+        """ stamps, in latency mode, are the frame's (sequence, sensor, capture,
+            encode) times, sent along with it as multipart headers
+            """
+        headers = b''
+        if stamps is not None:
+            headers = ("X-Frame-Sequence: {}\r\nX-Sensor-Time: {:.6f}\r\n"
+                       "X-Capture-Time: {:.6f}\r\nX-Encode-Time: {:.6f}\r\n").format(*stamps).encode()
+        chunk = b''.join((b'--FRAME\r\nContent-Type: image/jpeg\r\n', headers, b'Content-Length: ',
+                          str(len(jpeg)).encode(), b'\r\n\r\n', jpeg, b'\r\n'))
+        with self.condition:
+            sequence = self.sequences[variant] = self.sequences.get(variant, 0) + 1
+            for subscriber in self.subscribers:
+                if subscriber.variant != variant:
+                    continue
+                if len(subscriber.queue) == subscriber.queue.maxlen:
+                    subscriber.dropped += 1
+                subscriber.queue.append((sequence, chunk, stamps))
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def add_listener(self, callback):
+        """ callback() is called, on the encoder thread, after every publish """
+        self.listeners.append(callback)
+
+    def subscribe(self, address, variant=DEFAULT_STREAM_VARIANT):
+        subscriber = StreamSubscriber(address, self.queue_frames, variant)
+        with self.condition:
+            self.subscribers.append(subscriber)
+            self.condition.notify_all()
+        return subscriber
+
+    def variants(self):
+        """ The stream variants that currently have subscribers """
+        with self.condition:
+            return {subscriber.variant for subscriber in self.subscribers}
+
+    def wait_for_subscribers(self, timeout=None):
+        """ Wait until at least one client is subscribed. Returns False on timeout """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.subscribers, timeout)
+
+    def unsubscribe(self, subscriber):
+        with self.condition:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        print(f"Stream client {subscriber.address} disconnected after {subscriber.sent} frames,"
+              f" {subscriber.dropped} dropped, max lag {subscriber.max_lag} frames")
+        print()
+
+    def get(self, subscriber):
+        """ Wait for the subscriber's next chunk """
+        with self.condition:
+            while not subscriber.queue:
+                self.condition.wait()
+            return self._next(subscriber)
+
+    def poll(self, subscriber):
+        """ The subscriber's next chunk, or None if there isn't one yet """
+        with self.condition:
+            return self._next(subscriber) if subscriber.queue else None
+
+    def written(self, subscriber):
+        """ The servers call this once the subscriber's last chunk is written to its socket """
+        if subscriber.stamps is not None:
+            self.latency.append(subscriber.stamps + (monotonic(),))
+
+    def _next(self, subscriber):
+        sequence, chunk, subscriber.stamps = subscriber.queue.popleft()
+        subscriber.max_lag = max(subscriber.max_lag, self.sequences[subscriber.variant] - sequence)
+        subscriber.sequence = sequence
+        subscriber.sent += 1
+        return chunk
+
+    def stats(self):
+        """ Snapshot of per-client lag and drop counts """
+        with self.condition:
+            return [{'address': subscriber.address,
+                     'variant': subscriber.variant,
+                     'lag': self.sequences.get(subscriber.variant, 0) - subscriber.sequence,
+                     'max_lag': subscriber.max_lag,
+                     'sent': subscriber.sent,
+                     'dropped': subscriber.dropped} for subscriber in self.subscribers]
+
+
+class FramePool:
+    """
+    Fixed ring of preallocated lo-res YUV420 frame buffers.
+    The capture thread copies each new frame into a free buffer and stamps it
+    with a monotonically increasing sequence number. Consumers borrow a
+    read-only view of the newest frame, and release it when done with it.
+    A buffer is never overwritten while borrowed, and a gap in the sequence
+    numbers a consumer receives tells it how many frames it has fallen behind.
+    If shared, the buffers are in anonymous shared memory, so a process forked
+    afterwards sees the same frames, e.g. through the views of its copy of the pool.
+    """
+
+    def __init__(self, shape, count, shared=False):
+        if shared:
+            size = shape[0] * shape[1]
+            self.memory = mmap.mmap(-1, size * count)
+            self.frames = [ndarray(shape, dtype = uint8, buffer = self.memory, offset = i * size)
+                           for i in range(count)]
+        else:
+            self.frames = [zeros(shape, dtype = uint8) for _ in range(count)]
+        self.views = []
+        for frame in self.frames:
+            view = frame.view()
+            view.flags.writeable = False
+            self.views.append(view)
+        self.sequences = [0] * count
+        self.times = [(0.0, 0.0)] * count  # (sensor, capture) monotonic times
+        self.borrowed = [0] * count
+        self.latest = 0
+        self.sequence = 0
+        self.dropped = 0  # Frames lost because every buffer was borrowed
+        self.condition = Condition()
+
+    def put(self, array, sensor_time=None):
+        """ Copy a captured frame into a free buffer and publish it. The sensor
+            time is that of the frame's exposure, if the source knows it
+            """
+        with self.condition:
+            count = len(self.frames)
+            for step in range(1, count):
+                slot = (self.latest + step) % count
+                if not self.borrowed[slot]:
+                    break
+            else:
+                self.dropped += 1
+                return
+
+        # Safe outside the lock, unpublished buffers are never borrowed
+        copyto(self.frames[slot], array)
+        capture_time = monotonic()
+
+        with self.condition:
+            self.times[slot] = (sensor_time or capture_time, capture_time)
+            self.sequence += 1
+            self.sequences[slot] = self.sequence
+            self.latest = slot
+            self.condition.notify_all()
+
+    def borrow(self, after_sequence=0):
+        """ Wait for a frame newer than after_sequence.
+            Returns the frame's sequence number, a read-only view of it and
+            the slot to hand back to release()
+            """
+        with self.condition:
+            while self.sequence <= after_sequence:
+                self.condition.wait()
+            slot = self.latest
+            self.borrowed[slot] += 1
+            return self.sequences[slot], self.views[slot], slot
+
+    def release(self, slot):
+        with self.condition:
+            self.borrowed[slot] -= 1
+
+
+class EncodedFrame:
+    """ One encoded frame in the pre-roll buffer, its bytes in RAM, or its
+        offset in the spill file once spilled
+        """
+    __slots__ = ('timestamp', 'keyframe', 'data', 'offset', 'length')
+
+    def __init__(self, data, keyframe, timestamp):
+        self.timestamp = timestamp
+        self.keyframe = keyframe
+        self.data = data
+        self.offset = None
+        self.length = len(data)
+
 
+class PreRollOutput(Output):
+    """
+    The recordings' pre-roll buffer of H.264 frames, in place of Picamera2's
+    CircularOutput2, bounded in bytes as well as in time.
+    Frames are kept in RAM up to ram_bytes, and older frames spill to a
+    memory mapped ring file of spill_bytes, on tmpfs or disk, so a long
+    pre-roll at a high bit rate needs little RAM. Without a spill file, or
+    when it is full, the oldest frames are dropped instead. Frames are always
+    dropped a whole key frame interval at a time, so the buffer, and so every
+    recording, starts on a key frame.
+    open_output() hands the buffer to a writer thread, which writes it out,
+    spilled part first, then every new frame until close_output(). The same
+    RAM budget holds for the frames waiting to be written, so a writer held
+    up by a slow SD card fills the spill file rather than RAM. Frames can't
+    be dropped from a recording, so when there is no room left to spill they
+    are kept in RAM regardless, and close_output() reports by how much the
+    budget was exceeded. The encoder's callback, outputframe(), only ever
+    adds a frame, and copies one to the spill file while RAM is over budget,
+    it never writes to the recording or reads the spill file.
+    """
+
+    def __init__(self, duration_ms, ram_bytes=0, spill_path=None, spill_bytes=0):
+        super().__init__()
+        self.duration = duration_ms * 1000  # Encoder timestamps are in us
+        self.ram_limit = ram_bytes  # 0 for no limit
+        self.spill = None
+        if spill_path and spill_bytes > 0:
+            with open(spill_path, 'w+b') as f:
+                f.truncate(spill_bytes)
+                self.spill = mmap.mmap(f.fileno(), spill_bytes)
+        self.frames = deque()  # The buffer, oldest first
+        self.ram_bytes = 0  # Bytes of the buffer's frames held in RAM
+        self.keyframes = 0  # Key frames in the buffer
+        self.buffer_spilled = 0  # The buffer's oldest frames, that are spilled
+        # Spilled frames, of the buffer and those still to be written, in the
+        # order they were spilled. The ring is in use from the offset of the
+        # first to spill_end
+        self.spilled = deque()
+        self.spill_end = 0
+        self.writing = deque()  # Frames for the writer thread
+        self.writing_ram = 0  # Bytes of them held in RAM
+        self.writing_peak = 0  # Most bytes held in RAM, since the recording opened
+        self.output = None
+        self.writer = None
+        self.streams = []
+        self.condition = Condition()
+
+    def _add_stream(self, encoder_stream, codec_name, **kwargs):
+        # Passed on to each recording's PyavOutput
+        self.streams.append((encoder_stream, codec_name, kwargs))
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if audio or not self.recording:
+            return
+        with self.condition:
+            if self.output is not None:
+                entry = EncodedFrame(frame, keyframe, timestamp)
+                if not (self.ram_limit and self.writing_ram + entry.length > self.ram_limit
+                        and self.spill_frame(entry)):
+                    self.writing_ram += entry.length
+                    self.writing_peak = max(self.writing_peak, self.writing_ram)
+                self.writing.append(entry)
+                self.condition.notify_all()
+                return
+            if not keyframe and not self.frames:
+                return  # The buffer starts on a key frame
+            self.frames.append(EncodedFrame(frame, keyframe, timestamp))
+            self.ram_bytes += len(frame)
+            self.keyframes += keyframe
+
+            # Drop whole key frame intervals that are out of time, then keep
+            # to the RAM budget, spilling the oldest frames still in RAM
+            while timestamp - self.frames[0].timestamp > self.duration and self.drop_interval():
+                pass
+            while self.ram_limit and self.ram_bytes > self.ram_limit:
+                if not (self.spill_oldest() or self.drop_interval()):
+                    break
+
+    def drop_interval(self):
+        """ Drops the buffer's oldest key frame interval, if there is another one """
+        if self.keyframes - self.frames[0].keyframe < 1:
+            return False
+        while True:
+            entry = self.frames.popleft()
+            self.keyframes -= entry.keyframe
+            self.release(entry)
+            if self.frames[0].keyframe:
+                return True
+
+    def release(self, entry):
+        """ Frees a buffered frame's RAM, or its space in the spill file """
+        if entry.data is not None:
+            self.ram_bytes -= entry.length
+            return
+        self.buffer_spilled -= 1
+        self.free_spilled(entry)
+
+    def free_spilled(self, entry):
+        entry.offset = None
+        while self.spilled and self.spilled[0].offset is None:
+            self.spilled.popleft()
+
+    def spill_position(self, length):
+        """ Where a frame of length bytes fits in the spill ring, or None """
+        if not self.spilled:
+            self.spill_end = 0
+            return 0 if length <= len(self.spill) else None
+        start = self.spilled[0].offset
+        if self.spill_end > start:
+            if self.spill_end + length <= len(self.spill):
+                return self.spill_end
+            return 0 if length < start else None
+        return self.spill_end if self.spill_end + length < start else None
+
+    def spill_frame(self, entry):
+        """ Moves a frame's bytes to the spill file, if there is room """
+        if self.spill is None:
+            return False
+        position = self.spill_position(entry.length)
+        if position is None:
+            return False
+        self.spill[position:position + entry.length] = entry.data
+        entry.offset = position
+        entry.data = None
+        self.spilled.append(entry)
+        self.spill_end = position + entry.length
+        return True
+
+    def spill_oldest(self):
+        """ Moves the buffer's oldest frame still in RAM to the spill file """
+        if self.buffer_spilled == len(self.frames) or not self.spill_frame(self.frames[self.buffer_spilled]):
+            return False
+        self.ram_bytes -= self.frames[self.buffer_spilled].length
+        self.buffer_spilled += 1
+        return True
+
+    def open_output(self, output):
+        """ Starts writing the buffer and then every new frame to output. Returns
+            the seconds of pre-roll, and the bytes of it in RAM and spilled
+            """
+        if self.output is not None:
+            raise RuntimeError("Underlying output must be closed first")
+        output.start()
+        for encoder_stream, codec_name, kwargs in self.streams:
+            output._add_stream(encoder_stream, codec_name, **kwargs)
+        with self.condition:
+            seconds = (self.frames[-1].timestamp - self.frames[0].timestamp) / 1e6 if self.frames else 0.0
+            pre_roll = (seconds, self.ram_bytes, sum(entry.length for entry in self.frames) - self.ram_bytes)
+            self.writing.extend(self.frames)
+            self.writing_ram += self.ram_bytes
+            self.writing_peak = self.writing_ram
+            self.frames.clear()
+            self.ram_bytes = 0
+            self.keyframes = 0
+            self.buffer_spilled = 0
+            self.output = output
+        self.writer = Thread(target = self.write, args = (output,), daemon = True)
+        self.writer.start()
+        return pre_roll
+
+    def close_output(self):
+        """ Ends the recording once the writer has written every frame before now.
+            Returns the most bytes of the recording's frames held in RAM at once
+            """
+        if self.output is None:
+            raise RuntimeError("No underlying output has been opened")
+        with self.condition:
+            self.output = None
+            self.condition.notify_all()
+        self.writer.join()
+        return self.writing_peak
+
+    def write(self, output):
+        """ Writer thread, the recording's frames from the key frame it starts
+            on, with timestamps from there
+            """
+        start = None
+        while True:
+            with self.condition:
+                while not self.writing and self.output is output:
+                    self.condition.wait()
+                if not self.writing:
+                    break
+                # Left in the queue, so its spill space isn't reused, until written
+                entry = self.writing[0]
+            data = entry.data if entry.data is not None else self.spill[entry.offset:entry.offset + entry.length]
+            if start is None and entry.keyframe:
+                start = entry.timestamp
+            if start is not None:
+                try:
+                    output.outputframe(data, entry.keyframe, entry.timestamp - start)
+                except Exception as e:
+                    print(f"Recording write failed: {e}")
+            with self.condition:
+                self.writing.popleft()
+                if entry.data is None:
+                    self.free_spilled(entry)
+                else:
+                    self.writing_ram -= entry.length
+        output.stop()
+
+    def stop(self):
+        if self.output is not None:
+            self.close_output()
+        super().stop()
+
+
+class SegmentedOutput(Output):
+    """
+    The DVR mode's recording, the whole H.264 stream written to consecutive
+    .mp4 segments of DVR_SEGMENT_SECONDS, each starting on a key frame, with
+    no frames lost between them.
+    As with the pre-roll, the encoder's callback only queues each frame, with
+    the time it arrived, and a writer thread does all the file work. It starts
+    a new segment at the first key frame due, and posts 'segment' and
+    'segment_end' commands to the camera's recorder as segments open and close.
+    """
+
+    def __init__(self, camera, seconds):
+        super().__init__()
+        self.camera = camera
+        self.duration = seconds * 1e6  # Encoder timestamps are in us
+        self.frames = deque()  # (frame, keyframe, timestamp, time) for the writer
+        self.streams = []
+        self.writer = None
+        self.condition = Condition()
+
+    def _add_stream(self, encoder_stream, codec_name, **kwargs):
+        # Passed on to each segment's PyavOutput
+        self.streams.append((encoder_stream, codec_name, kwargs))
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if audio or not self.recording:
+            return
+        with self.condition:
+            self.frames.append((frame, keyframe, timestamp, time()))
+            self.condition.notify_all()
+
+    def start(self):
+        super().start()
+        self.writer = Thread(target = self.write, daemon = True)
+        self.writer.start()
+
+    def stop(self):
+        """ Ends the last segment once the writer has written every frame before now """
+        with self.condition:
+            super().stop()
+            self.condition.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def open_segment(self, wall_time):
+        """ A new segment's PyavOutput and title, the recording title of wall_time """
+        title = recording_title(self.camera, datetime.fromtimestamp(wall_time))
+        output = PyavOutput(os.path.join(self.camera.directory, title + ".mp4"))
+        output.start()
+        for encoder_stream, codec_name, kwargs in self.streams:
+            output._add_stream(encoder_stream, codec_name, **kwargs)
+        return output, title
+
+    def write(self):
+        """ Writer thread, each segment's frames with timestamps from its first """
+        output = title = start = None
+        while True:
+            with self.condition:
+                while not self.frames and self.recording:
+                    self.condition.wait()
+                if not self.frames:
+                    break
+                frame, keyframe, timestamp, wall_time = self.frames.popleft()
+            if keyframe and (start is None or timestamp - start >= self.duration):
+                if output is not None:
+                    output.stop()
+                    self.camera.recorder_commands.put(('segment_end', title, wall_time))
+                    output = None
+                try:
+                    output, title = self.open_segment(wall_time)
+                except Exception as e:
+                    print(f"{self.camera.name}: opening a DVR segment failed: {e}")
+                    continue  # Tried again at the next key frame
+                start = timestamp
+                self.camera.recorder_commands.put(('segment', title, wall_time))
+            if output is not None:
+                try:
+                    output.outputframe(frame, keyframe, timestamp - start)
+                except Exception as e:
+                    print(f"{self.camera.name}: DVR segment write failed: {e}")
+        if output is not None:
+            output.stop()
+            self.camera.recorder_commands.put(('segment_end', title, time()))
+
+
+class CameraSource:
+    """
+    Frame source for an attached camera, via Picamera2. The normal mode.
+    Lo-res frames go to the camera's frame pool, while the full size main
+    frames are timestamped and H.264 encoded into the circular pre-roll
+    buffer, from which recordings are saved, or in DVR mode are all written
+    to the recording's segments.
+    """
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.picam2 = None
+        self.pre_roll = None
+        self.segments = None
+        self.max_mode = 0
+        self.autofocus = False
+
+    @staticmethod
+    def probe(picam2, sensor, number):
+        """ The sensor's modes and autofocus support, from SENSOR_CACHE if it was
+            written for this sensor as camera number, otherwise read from the
+            camera, (listing the modes configures every one of them in turn),
+            and cached
+            """
+        try:
+            with open(SENSOR_CACHE) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        if not isinstance(cache, dict):
+            cache = {}
+        cached = cache.get(str(number))
+        if (isinstance(cached, dict) and cached.get('model') == sensor['Model']
+                and cached.get('id') == sensor['Id']):
+            return cached
+        probe_start = monotonic()
+        probed = {'model': sensor['Model'], 'id': sensor['Id'],
+                  'modes': [{'size': list(mode['size']), 'bit_depth': mode['bit_depth']}
+                            for mode in picam2.sensor_modes],
+                  'autofocus': 'AfMode' in picam2.camera_controls}
+        print(f"Probed the {sensor['Model']} sensor in {monotonic() - probe_start:.1f} s,"
+              f" saved to {SENSOR_CACHE}")
+        cache[str(number)] = probed
+        with open(SENSOR_CACHE, 'w') as f:
+            json.dump(cache, f, indent = 1)
+        return probed
+
+    def settle(self, timeout):
+        """ Waits for the auto exposure and white balance to settle, or timeout
+            seconds, and returns the latest metadata and whether they settled.
+            Where the camera reports AeLocked, exposure must also be locked,
+            unless it stays steady long enough, as with a manual exposure
+            """
+        deadline = monotonic() + timeout
+        previous = None
+        steady = 0
+        while True:
+            metadata = self.picam2.capture_metadata()
+            levels = (metadata.get('ExposureTime', 0) * metadata.get('AnalogueGain', 1.0),
+                      *metadata.get('ColourGains', ()))
+            if previous is not None and len(levels) == len(previous) and max(
+                    abs(level - last) / max(abs(last), 1e-6) for level, last in zip(levels, previous)) <= SETTLE_TOLERANCE:
+                steady += 1
+            else:
+                steady = 0
+            previous = levels
+            locked = metadata.get('AeLocked', True)
+            if steady >= SETTLE_FRAMES and (locked or steady >= 3 * SETTLE_FRAMES):
+                return metadata, True
+            if monotonic() > deadline:
+                return metadata, False
+
+    def start(self):
+        """ Configure and start the camera, returning its current metadata """
+        os.environ["LIBCAMERA_LOG_LEVELS"] = "4"  # reduce libcamera messsages
+
+        # The sensor model, for selecting the tuning file, is listed without
+        # opening the camera, so it is only opened once, with its tuning
+        number = self.camera.camera_num
+        sensors = Picamera2.global_camera_info()
+        if number >= len(sensors):
+            print(f"No camera {number} found for {self.camera.name}. Use --replay to run without a camera.")
+            sys.exit(1)
+        sensor_model = sensors[number]['Model']
+
+        # Define tuning file name based on model and on boolean state of is_noir
+        noir = "_noir" if is_noir else ""
+        tuning_file_name  = sensor_model + noir + ".json"
+
+        # Instantiate camera with appropriate tuning file
+        tuning = Picamera2.load_tuning_file(tuning_file_name)
+        picam2 = Picamera2(number, tuning = tuning)
+
+        # The supported modes, from the cache after the first run
+        sensor = self.probe(picam2, sensors[number], number)
+        modes = sensor['modes']
+        self.max_mode = len(modes) -1
+        self.autofocus = sensor['autofocus']
+
+        # And select the mode to configure
+        mode = modes[SENSOR_MODE]
+
+        # Create the stored configuration
+        picam2.configure(picam2.create_video_configuration(sensor = {"output_size":tuple(mode['size']),'bit_depth':mode['bit_depth']},
+                                                           controls = {'FrameRate' : FRAMES_PER_SECOND},
+                                                           transform = Transform(hflip=HFLIP, vflip=VFLIP),
+                                                           main = {"size" : (VIDEO_WIDTH, VIDEO_HEIGHT),'format' : "BGR888"},
+                                                           lores = {"size" : (STREAM_WIDTH, STREAM_HEIGHT),'format' : "YUV420"}, buffer_count = BUFFER_COUNT))
+        # Define the encoder properties
+        encoder = H264Encoder(repeat = True, iperiod = FRAMES_PER_SECOND)
+
+        # Set the timestamp callback
+        picam2.pre_callback = lambda request: apply_timestamp(self.camera, request)
+
+        # Apply the stored set of camera controls
+        picam2.set_controls(controls)
 
-def capturebuffer():
-    global cb_frame
+        # Circular Buffer properties enabled and started, or in DVR mode
+        # every frame recorded, segment after segment
+        if DVR:
+            self.segments = SegmentedOutput(self.camera, DVR_SEGMENT_SECONDS)
+            outputs = [self.segments]
+        else:
+            spill_file = PREROLL_SPILL_FILE
+            if spill_file and self.camera.index:
+                spill_file = f"{spill_file}.{self.camera.name}"
+            self.pre_roll = PreRollOutput(BUFFER_SECONDS * 1000, int(PREROLL_RAM_MB * 1e6),
+                                          spill_file, int(PREROLL_SPILL_MB * 1e6))
+            outputs = [self.pre_roll]
+
+        # The same H.264 stream, copied into HLS segments for the live view,
+        # of the first camera only
+        if LIVE_HLS and self.camera.index == 0:
+            outputs.append(live_hls_output())
+        encoder.output = outputs
+        picam2.start_recording(encoder, outputs, quality = Quality.VERY_HIGH)
+
+        self.picam2 = picam2
+
+        # Allow the camera auto algorithms to settle, and use their settings
+        # as the current camera parameters
+        metadata, settled = self.settle(CAMERA_SETTLE_TIMEOUT)
+        self.camera.startup['settled'] = monotonic() - STARTED
+        if settled:
+            print(f"{self.camera.name}: exposure and white balance settled {self.camera.startup['settled']:.2f} s after start")
+        else:
+            print(f"{self.camera.name}: exposure and white balance still changing after {CAMERA_SETTLE_TIMEOUT:g} s, starting anyway")
+        return metadata
+
+    def capture_lores(self, pool):
+        """ Copy the next lo-res frame straight from the camera buffer into the pool """
+        request = self.picam2.capture_request()
+        try:
+            # libcamera's SensorTimestamp is in ns on the same clock as monotonic()
+            sensor_time = request.get_metadata()['SensorTimestamp'] / 1e9 if LATENCY_MODE else None
+            with MappedArray(request, "lores") as m:
+                pool.put(m.array[:, :STREAM_WIDTH], sensor_time)
+        finally:
+            request.release()
+
+    def set_controls(self, controls):
+        self.picam2.set_controls(controls)
+
+    def autofocus_cycle(self):
+        return self.picam2.autofocus_cycle()
+
+    def open_recording(self, path):
+        """ Starts a recording with the pre-roll, returning its seconds """
+        seconds, ram, spilled = self.pre_roll.open_output(PyavOutput(path))
+        print(f"{self.camera.name}: {seconds:.1f} s of pre-roll, {ram / 1e6:.1f} MB from RAM"
+              f"{f', {spilled / 1e6:.1f} MB spilled' if spilled else ''}")
+        return seconds
+
+    def close_recording(self):
+        peak = self.pre_roll.close_output()
+        if self.pre_roll.ram_limit and peak > self.pre_roll.ram_limit:
+            print(f"{self.camera.name}: the recording's writer fell behind, holding {peak / 1e6:.1f} MB"
+                  f" in RAM, over preroll_ram_mb with the spill file full or not set")
+
+    def close_segments(self):
+        """ DVR mode, ends the segment being written """
+        self.segments.stop()
+
+
+def synthetic_scene(width, height):
+    """ A noisy static scene, with a square crossing it for 4 seconds in every 20.
+        Yields (YUV420, BGR) frame pairs of the given size
+        """
+    rng = default_rng(0)
+    scene = rng.integers(60, 120, (height, width, 3), dtype = uint8)
+    scene = cv2.GaussianBlur(scene, (0, 0), 3)
+    side = height // 5
+    for frame_number in range(20 * FRAMES_PER_SECOND):
+        bgr = cv2.add(scene, rng.integers(0, 4, scene.shape, dtype = uint8))
+        if frame_number < 4 * FRAMES_PER_SECOND:
+            x = frame_number * (width - side) // (4 * FRAMES_PER_SECOND)
+            y = (height - side) // 2
+            cv2.rectangle(bgr, (x, y), (x + side, y + side), (230, 230, 230), -1)
+        yield cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420), bgr
+
+
+class ReplaySource:
+    """
+    Frame source that replaces the camera, so the whole pipeline can be run,
+    measured and regression tested on any Linux box.
+    Lo-res YUV420 frames come from a raw .yuv dump of lo-res frames, from any
+    video file OpenCV can read, or from a synthetic scene ('synthetic'), and
+    are looped at FRAMES_PER_SECOND or as fast as possible.
+    Full size BGR main frames are made while a recording is open, (written
+    timestamped to an .mp4 without a pre-roll), or every frame if main is set
+    or in DVR mode, where they are written to segments of DVR_SEGMENT_SECONDS.
+    """
+
+    def __init__(self, source, camera, paced=True, main=False):
+        self.source = source
+        self.camera = camera
+        self.paced = paced
+        self.main = main
+        self.max_mode = 0
+        self.autofocus = False
+        self.writer = None
+        self.dvr = DVR
+        self.segment = None  # DVR mode, (title, start time) of the open segment
+        self.lock = Lock()
+
+    def start(self):
+        self.frames = self.generate()
+        self.next_time = time()
+        print(f"{self.camera.name}: replaying {self.source} in place of the camera"
+              f"{'' if self.paced else ', as fast as possible'}")
+        if LIVE_HLS and self.camera.index == 0:
+            print("No HLS live view in replays, it needs the camera's H.264 encoder.")
+        print()
+        return {}
+
+    def generate(self):
+        """ Endless (lo-res YUV420, BGR source frame or None) pairs """
+        frame_bytes = STREAM_WIDTH * STREAM_HEIGHT * 3 // 2
+        while True:
+            if self.source == 'synthetic':
+                yield from synthetic_scene(STREAM_WIDTH, STREAM_HEIGHT)
+            elif self.source.endswith('.yuv'):
+                with open(self.source, 'rb') as f:
+                    while len(data := f.read(frame_bytes)) == frame_bytes:
+                        yield frombuffer(data, dtype = uint8).reshape(STREAM_HEIGHT * 3 // 2, STREAM_WIDTH), None
+            else:
+                video = cv2.VideoCapture(self.source)
+                while True:
+                    ok, bgr = video.read()
+                    if not ok:
+                        break
+                    lores = cv2.resize(bgr, (STREAM_WIDTH, STREAM_HEIGHT), interpolation = cv2.INTER_AREA)
+                    yield cv2.cvtColor(lores, cv2.COLOR_BGR2YUV_I420), bgr
+                video.release()
+
+    def capture_lores(self, pool):
+        yuv, bgr = next(self.frames)
+        if self.paced:
+            self.next_time += 1 / FRAMES_PER_SECOND
+            delay = self.next_time - time()
+            if delay > 0:
+                sleep(delay)
+            else:
+                self.next_time = time()
+        sensor_time = monotonic()
+
+        with self.lock:
+            if self.dvr:
+                self.next_segment(time())
+            if self.writer is not None or self.main:
+                if bgr is None:
+                    bgr = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+                main = cv2.resize(bgr, (VIDEO_WIDTH, VIDEO_HEIGHT))
+                start = perf_counter()
+                stamp_frame(main, self.camera.title, self.camera.total_motion)
+                self.camera.pre_callback_latency.observe(perf_counter() - start)
+                if self.writer is not None:
+                    self.writer.write(main)
+
+        pool.put(yuv, sensor_time)
+
+    def set_controls(self, controls):
+        pass
+
+    def autofocus_cycle(self):
+        return False
+
+    @staticmethod
+    def video_writer(path):
+        return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'),
+                               FRAMES_PER_SECOND, (VIDEO_WIDTH, VIDEO_HEIGHT))
+
+    def open_recording(self, path):
+        with self.lock:
+            self.writer = self.video_writer(path)
+        return 0
+
+    def close_recording(self):
+        with self.lock:
+            self.writer.release()
+            self.writer = None
+
+    def next_segment(self, wall_time):
+        """ DVR mode, starts the next segment if it is due. Call with the lock held """
+        if self.segment is not None and wall_time - self.segment[1] < DVR_SEGMENT_SECONDS:
+            return
+        self.end_segment(wall_time)
+        title = recording_title(self.camera, datetime.fromtimestamp(wall_time))
+        self.writer = self.video_writer(os.path.join(self.camera.directory, title + ".mp4"))
+        self.segment = (title, wall_time)
+        self.camera.recorder_commands.put(('segment', title, wall_time))
+
+    def end_segment(self, wall_time):
+        if self.segment is not None:
+            self.writer.release()
+            self.writer = None
+            self.camera.recorder_commands.put(('segment_end', self.segment[0], wall_time))
+            self.segment = None
+
+    def close_segments(self):
+        """ DVR mode, ends the segment being written """
+        with self.lock:
+            self.dvr = False
+            self.end_segment(time())
+
+
+def capturebuffer(camera):
+    frame_period = 1 / FRAMES_PER_SECOND
+    last_capture = None
+    camera.frame_source.capture_lores(camera.lores_pool)
+    camera.startup['first_frame'] = monotonic() - STARTED
+    print(f"{camera.name}: first frame {camera.startup['first_frame']:.2f} s after start")
     while True:
-        buf2 = picam2.capture_array("lores")
-        with cb_condition:
-            cb_frame = buf2
-            cb_condition.notify_all()
+        camera.frame_source.capture_lores(camera.lores_pool)
+        now = perf_counter()
+        if last_capture is not None:
+            camera.capture_interval.observe(now - last_capture)
+            camera.capture_jitter.observe(abs(now - last_capture - frame_period))
+        last_capture = now
 
 
 def yuv420_jpeg(yuvframe, height, width, quality):
@@ -894,91 +3093,653 @@ def yuv420_jpeg(yuvframe, height, width, quality):
 
 
 def cleanup():
-    global trigger_level, set_manual_recording,video_count
-    set_manual_recording = False
-    trigger_level = INF_TRIGGER_LEVEL
-    config.set('ropey','video_count',str(video_count))
+    """ Closes any recordings and writes ropey.ini, once, however many of the
+        exit buttons and stream()'s last resort call it. A second caller waits
+        for the first to finish
+        """
+    global cleaned_up
+    with cleanup_lock:
+        if cleaned_up:
+            return
+        cleaned_up = True
+        close_recordings()
+
+
+def close_recordings():
+    for camera in cameras:
+        camera.set_manual_recording = False
+        camera.trigger_level = INF_TRIGGER_LEVEL
+        if DVR:
+            camera.frame_source.close_segments()
+        config.set(camera.section,'video_count',str(camera.video_count))
     update_ini_file()
     print("Closing any active recordings, writing ropey.ini file and waiting to", post_data)
     print()
     sleep(BUFFER_SECONDS + POST_ROLL + 2)
 
 
-def mjpeg_encode():  # Superimpose data on YUV420 frames then encode them as jpegs.
-    global mjpeg_frame
+cleanup_lock = Lock()
+cleaned_up = False
+
+
+def exit_ropey(action):
+    """ Carries out an exit action from apply_post(), once its redirect has been
+        sent. Recordings are closed first, then the Pi reboots or shuts down,
+        or the mjpeg threads stop, which lets the main thread exit
+        """
+    global mjpeg_abort
+    cleanup()
+    if action == 'reboot':
+        os.system("sudo reboot now")
+    elif action == 'shutdown':
+        os.system("sudo shutdown now")
+    else:
+        mjpeg_abort = True
+
+
+def stream_variant(path):
+    """ The (fps, quality, scale) stream variant asked for in a stream.mjpg
+        query string e.g. stream.mjpg?fps=5&q=40&scale=2 , limited to what the
+        camera provides. Anything not given is taken from the default stream.
+        """
+    query = parse_qs(urlsplit(path).query)
+    fps, quality, scale = DEFAULT_STREAM_VARIANT
+    try:
+        fps = min(max(int(query.get('fps', [fps])[0]), 1), FRAMES_PER_SECOND)
+        quality = min(max(int(query.get('q', [quality])[0]), 10), 95)
+        scale = int(query.get('scale', [scale])[0])
+    except ValueError:
+        return DEFAULT_STREAM_VARIANT
+    if scale not in (1, 2, 4):
+        scale = 1
+    return (fps, quality, scale)
+
+
+def encode_stream_variant(yuv, variant):
+    """ Encode the overlaid YUV420 stream frame as a jpeg for one stream variant """
+    _, quality, scale = variant
+    if scale == 1:
+        return yuv420_jpeg(yuv, STREAM_HEIGHT, STREAM_WIDTH, quality)
+
+    # Scale the Y, U and V planes separately, keeping even dimensions for 4:2:0
+    width = 2 * (STREAM_WIDTH // (2 * scale))
+    height = 2 * (STREAM_HEIGHT // (2 * scale))
+    planes = yuv.reshape(STREAM_HEIGHT * 3, STREAM_WIDTH // 2)
+    u_start = STREAM_HEIGHT * 2
+    v_start = u_start + STREAM_HEIGHT // 2
+    return encode_jpeg_yuv_planes(
+        cv2.resize(yuv[:STREAM_HEIGHT], (width, height), interpolation = cv2.INTER_AREA),
+        cv2.resize(planes[u_start : v_start], (width // 2, height // 2), interpolation = cv2.INTER_AREA),
+        cv2.resize(planes[v_start :], (width // 2, height // 2), interpolation = cv2.INTER_AREA),
+        quality=quality)
+
+
+def overlay_stream_frame(yuv, width, height, recording, score, trigger):
+    """ Superimposes the motion score and, when recording, the REC stamp on a
+        YUV420 stream frame in place
+        """
+    # embed result of frame to frame difference calculation,
+    #  versus current trigger level, in top left of frame.
+    # With black background for improved contrast 
+    overlay_atlas.stamp(yuv, (*f"{score:06d}", f"/{trigger:06d}"),
+                        origin_offset, STREAM_STAMP, BLACK)
+
+    if recording:
+        # put a red REC stamp in top right of frame
+        overlay_atlas.stamp(yuv, ("REC",), (width - 62, VERT_OFFSET), Y, BLACK)
+        yuv[height : height + BOX_HEIGHT, width - BOX_WIDTH:] = u
+        yuv[height + height // 4 : height + height // 4 + BOX_HEIGHT, width - BOX_WIDTH :] = v
+        yuv[height : height + BOX_HEIGHT, width // 2 - BOX_WIDTH : width // 2] = u
+        yuv[height + height // 4 : height + height // 4 + BOX_HEIGHT, width // 2 - BOX_WIDTH : width // 2] = v
+
+
+def mjpeg_encode(camera):  # Superimpose data on YUV420 frames then encode them as jpegs.
+    broadcaster = camera.mjpeg_broadcaster
+    pool = camera.lores_pool
+    yuv = zeros((STREAM_HEIGHT * 3 // 2, STREAM_WIDTH), dtype = uint8)
+    sequence = 0
+    # When each variant's next frame is due, kept to its own frame rate by the
+    # clock, whichever frames the pool hands over. Frames may arrive up to half
+    # a frame early and still count, so full rate variants get every frame
+    next_due = {}
+    slack = 0.5 / FRAMES_PER_SECOND
     while not mjpeg_abort:
-        with cb_condition:
-            cb_condition.wait()
-            yuv = copy(cb_frame)
-
-            # embed result of frame to frame difference calculation,
-            #  versus current trigger level, in top left of frame.
-            # With black background for improved contrast 
-            motion_stamp = f"{total_motion:06d}/{trigger_level:06d}"
-
-            cv2.putText(yuv, motion_stamp, origin_offset, font, scale ,
-                        BLACK, thickness + 4)
-
-            cv2.putText(yuv, motion_stamp, origin_offset, font, scale ,
-                        STREAM_STAMP , thickness)
-
-            if is_recording:
-                # put a red REC stamp in top right of frame
-                cv2.putText(yuv,"REC",(STREAM_WIDTH - 62, VERT_OFFSET), font, scale, BLACK, thickness + 4)
-                cv2.putText(yuv,"REC",(STREAM_WIDTH - 62, VERT_OFFSET), font, scale, Y, thickness)
-                yuv[STREAM_HEIGHT : STREAM_HEIGHT + BOX_HEIGHT, STREAM_WIDTH - BOX_WIDTH:] = u
-                yuv[STREAM_HEIGHT + STREAM_HEIGHT // 4 : STREAM_HEIGHT + STREAM_HEIGHT // 4 + BOX_HEIGHT, STREAM_WIDTH - BOX_WIDTH :] = v
-                yuv[STREAM_HEIGHT : STREAM_HEIGHT + BOX_HEIGHT, STREAM_WIDTH // 2 - BOX_WIDTH : STREAM_WIDTH // 2] = u
-                yuv[STREAM_HEIGHT + STREAM_HEIGHT // 4 : STREAM_HEIGHT + STREAM_HEIGHT // 4 + BOX_HEIGHT, STREAM_WIDTH // 2 - BOX_WIDTH : STREAM_WIDTH // 2] = v
-
-            # Convert frame from yuv to jpeg
-            buf = yuv420_jpeg(yuv, STREAM_HEIGHT, STREAM_WIDTH,LOW_Q)
-            with mjpeg_condition:
-                mjpeg_frame = buf
-                mjpeg_condition.notify_all()
-
-
-def open_files(frame):
-    global video_count, file_title, video_file_title
-    current_frame = frame
-    video_count += 1
+        # No jpeg work at all while nobody is watching
+        if not broadcaster.wait_for_subscribers(timeout = 1):
+            sequence = 0
+            next_due = {}
+            continue
+
+        last_sequence = sequence
+        sequence, frame, slot = pool.borrow(last_sequence)
+        start = perf_counter()
+
+        # Only the variants due at their own frame rate are encoded this frame
+        now = monotonic()
+        next_due = {variant: next_due.get(variant, now) for variant in broadcaster.variants()}
+        due = [variant for variant, due_time in next_due.items() if now >= due_time - slack]
+        for variant in due:
+            # On schedule from the last due time, or from now after a stall
+            next_due[variant] += 1 / variant[0]
+            if next_due[variant] < now:
+                next_due[variant] = now + 1 / variant[0]
+        if due:
+            copyto(yuv, frame)
+            sensor_time, capture_time = pool.times[slot]
+        pool.release(slot)
+        if last_sequence:
+            camera.mjpeg_frames_missed += sequence - last_sequence - 1
+        if not due:
+            continue
+
+        overlay_stream_frame(yuv, STREAM_WIDTH, STREAM_HEIGHT, camera.is_recording,
+                             camera.total_motion, camera.trigger_level)
+
+        # Convert frame from yuv to jpeg, once per variant, shared by its clients
+        for variant in due:
+            buf = encode_stream_variant(yuv, variant)
+            stamps = (sequence, sensor_time, capture_time, monotonic()) if LATENCY_MODE else None
+            broadcaster.publish(buf, variant, stamps)
+            camera.jpeg_bytes_encoded += len(buf)
+        camera.frames_encoded += 1
+        camera.mjpeg_latency.observe(perf_counter() - start)
+
+
+class RecordingCatalog:
+    """
+    Index of the recordings in the Videos directory, oldest first, so storage
+    control never has to list and stat the whole directory.
+    Entries are added and updated as recordings open and close, and journalled
+    to catalog.jsonl in the same directory, as the start and end times and
+    peak motion score of a recording are not kept in its files.
+    The catalog is rebuilt from the directory at startup, so recordings that
+    were added or deleted by hand are picked up.
+    """
 
-    # Prepare file names based on date and time
-    now = datetime.now()
-    date_time = now.strftime("%Y%m%d_%H%M%S")
-    file_title = "Videos/{:05d}_{}".format(video_count, date_time)
-    video_file_title = file_title + ".mp4"
+    def __init__(self, directory, journal='catalog.jsonl'):
+        self.directory = directory
+        self.journal = os.path.join(directory, journal)
+        self.entries = OrderedDict()  # title : entry dict, oldest first
+        self.lock = Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        """ One directory scan, merged with what the journal knows about each
+            recording, then the journal is rewritten with one line per recording
+            """
+        known = {}
+        if os.path.exists(self.journal):
+            with open(self.journal) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short by a power failure
+                    if record.get('deleted'):
+                        known.pop(record['title'], None)
+                    else:
+                        known.setdefault(record['title'], {}).update(record)
+
+        sizes, modified = {}, {}
+        with os.scandir(self.directory) as files:
+            for file in files:
+                title, extension = os.path.splitext(file.name)
+                if extension in RECORDING_EXTENSIONS:
+                    stat = file.stat()
+                    sizes[title] = sizes.get(title, 0) + stat.st_size
+                    modified[title] = max(modified.get(title, 0), stat.st_mtime)
+
+        entries = []
+        for title, size in sizes.items():
+            record = known.get(title, {})
+            entries.append({'title': title,
+                            'start': record.get('start') or self.title_time(title, modified[title]),
+                            'end': record.get('end') or modified[title],
+                            'size': size,
+                            'peak': record.get('peak', 0),
+                            'peak_offset': record.get('peak_offset')})
+        entries.sort(key = lambda entry: (entry['start'], entry['title']))
+        with self.lock:
+            self.entries = OrderedDict((entry['title'], entry) for entry in entries)
+            self.compact()
+
+    @staticmethod
+    def title_time(title, fallback):
+        """ Start time from a NNNNN_YYYYmmdd_HHMMSS recording title """
+        try:
+            return datetime.strptime(title[-15:], "%Y%m%d_%H%M%S").timestamp()
+        except ValueError:
+            return fallback
+
+    def compact(self):
+        temporary = self.journal + '.tmp'
+        with open(temporary, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(temporary, self.journal)
+
+    def _append(self, record):
+        with open(self.journal, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def opened(self, title, start):
+        entry = {'title': title, 'start': start, 'end': None, 'size': 0, 'peak': 0,
+                 'peak_offset': None}
+        with self.lock:
+            self.entries[title] = entry
+            self._append(entry)
+
+    def closed(self, title, end, peak, peak_offset=None):
+        size = 0
+        for extension in RECORDING_EXTENSIONS:
+            try:
+                size += os.path.getsize(os.path.join(self.directory, title + extension))
+            except OSError:
+                pass
+        with self.lock:
+            if title not in self.entries:
+                return  # Deleted while recording
+            entry = self.entries[title]
+            entry.update(end = end, size = size, peak = peak, peak_offset = peak_offset)
+            self._append({'title': title, 'end': end, 'size': size, 'peak': peak,
+                          'peak_offset': peak_offset})
+
+    def oldest(self):
+        with self.lock:
+            return next(iter(self.entries.values()), None)
+
+    def evict(self, bytes_to_free):
+        """ Deletes the oldest closed recordings until at least bytes_to_free
+            bytes are freed. Returns the titles deleted
+            """
+        deleted = []
+        freed = 0
+        with self.lock:
+            while freed < bytes_to_free and self.entries:
+                entry = next(iter(self.entries.values()))
+                if entry['end'] is None:
+                    break  # Never the recording still being written
+                self.entries.popitem(last = False)
+                for extension in RECORDING_EXTENSIONS:
+                    try:
+                        os.remove(os.path.join(self.directory, entry['title'] + extension))
+                    except FileNotFoundError:
+                        pass
+                self._append({'title': entry['title'], 'deleted': True})
+                freed += entry['size']
+                deleted.append(entry['title'])
+        return deleted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.compact()
+
+    def list(self):
+        """ Snapshot of the entries, oldest first """
+        with self.lock:
+            return [dict(entry) for entry in self.entries.values()]
+
+    def newest(self, offset, count):
+        """ count finished recordings, newest first, after skipping offset of
+            them, and the number of finished recordings
+            """
+        with self.lock:
+            finished = (entry for entry in reversed(self.entries.values()) if entry['end'] is not None)
+            page = [dict(entry) for entry in islice(finished, offset, offset + count)]
+            total = len(self.entries) - (self.recording_title() is not None)
+        return page, total
+
+    def recording_title(self):
+        """ The title of the recording being written, if any. Call with the lock held """
+        newest = next(reversed(self.entries.values()), None)
+        return newest['title'] if newest and newest['end'] is None else None
+
+    def finished(self, title):
+        with self.lock:
+            entry = self.entries.get(title)
+            return entry is not None and entry['end'] is not None
+
+    def has(self, title):
+        with self.lock:
+            return title in self.entries
+
+
+class MotionTrack:
+    """
+    Streaming writer of a recording's motion track, Videos/<title>.motion, the
+    time, motion score and detection boxes of every analysed frame, so the
+    peak of a clip can be found, or clips searched for motion in part of the
+    frame, without decoding any video.
+    The file is a HEADER, then for each frame a RECORD followed by its boxes
+    as little endian uint16 x1, y1, x2, y2 in stream frame pixels. Times are
+    seconds since the epoch, and the header's video start is the time of the
+    first frame of video, so a frame is at (time - video start) into the clip.
+    The track of an open recording, or one cut short by a power failure, can
+    be read up to its last whole record.
+    """
+
+    MAGIC = b'RMT1'
+    HEADER = struct.Struct('<4sHHd')   # magic, stream width, stream height, video start
+    RECORD = struct.Struct('<dIH')     # time, motion score, box count
+
+    def __init__(self, path, video_start):
+        self.file = open(path, 'wb')
+        self.file.write(self.HEADER.pack(self.MAGIC, STREAM_WIDTH, STREAM_HEIGHT, video_start))
+        self.video_start = video_start
+        self.peak = (-1, video_start)  # score, time
+        self.flushed = video_start
+
+    def write(self, frame_time, score, detections):
+        boxes = detections[:, :4].clip(0, 0xFFFF).astype('<u2') if detections.size > 0 else b''
+        self.file.write(self.RECORD.pack(frame_time, min(score, 0xFFFFFFFF), len(boxes)))
+        self.file.write(boxes.tobytes() if len(boxes) else b'')
+        self.peak = max(self.peak, (score, frame_time))
+        # Readable while the recording is open, at most a second behind
+        if frame_time - self.flushed >= 1:
+            self.file.flush()
+            self.flushed = frame_time
+
+    def close(self):
+        """ Closes the file, returns the offset of the peak score into the video """
+        self.file.close()
+        return round(max(self.peak[1] - self.video_start, 0), 1)
+
+    @classmethod
+    def read(cls, path):
+        """ (stream width, height, video start) and a list of (time, score,
+            boxes array) of a motion track file
+            """
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, width, height, video_start = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path} is not a motion track")
+        records = []
+        offset = cls.HEADER.size
+        while offset + cls.RECORD.size <= len(data):
+            frame_time, score, count = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            if offset + 8 * count > len(data):
+                break
+            boxes = frombuffer(data, dtype = '<u2', count = 4 * count, offset = offset).reshape(count, 4)
+            offset += 8 * count
+            records.append((frame_time, score, boxes))
+        return (width, height, video_start), records
+
+
+class EventIndex:
+    """
+    Index of a camera's motion events in DVR mode, with an entry for each
+    event as it ends: its start and end times, peak motion score, and the
+    segments it is in, each with the event's start and end offsets into it,
+    so an event is found, and played from its start, without opening any
+    video. Events go from the index with the last of their segments, when
+    storage control deletes them.
+    The events are held in memory, oldest first, and journalled to
+    Videos/events.jsonl. The journal is read once at startup, dropping the
+    events whose segments have gone, and only rewritten once it holds more
+    dropped events than current ones.
+    """
 
-    # save jpeg of trigger moment
-    snapshot = yuv420_jpeg(current_frame, STREAM_HEIGHT, STREAM_WIDTH, HIGH_Q)
-    icon = Image.open(BytesIO(snapshot))
-    icon.save(file_title + ".jpg")
+    def __init__(self, directory, catalog, index=DVR_EVENTS):
+        self.path = os.path.join(directory, index)
+        self.catalog = catalog
+        self.lock = Lock()
+        self.events = deque()
+        self.dropped = 0  # Events still in the journal but not in the index
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short by a power failure
+                    if self.kept(event):
+                        self.events.append(event)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.compact()
+
+    def kept(self, event):
+        return any(self.catalog.has(segment[0]) for segment in event['segments'])
+
+    def compact(self):
+        """ Call with the lock held """
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + '\n')
+        os.replace(temporary, self.path)
+        self.dropped = 0
+
+    def append(self, start, end, peak, segments):
+        event = {'start': round(start, 1), 'end': round(end, 1), 'peak': int(peak), 'segments': segments}
+        with self.lock:
+            self.events.append(event)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+
+    def newest(self, count):
+        """ count events, newest first, each with the segments that are finished """
+        page = []
+        with self.lock:
+            for event in reversed(self.events):
+                segments = [segment for segment in event['segments'] if self.catalog.finished(segment[0])]
+                if segments:
+                    page.append(dict(event, segments = segments))
+                    if len(page) == count:
+                        break
+        return page
+
+    def prune(self):
+        """ Drops the events whose segments have all been deleted. Recordings
+            are deleted oldest first, so these are the oldest events
+            """
+        with self.lock:
+            while self.events and not self.kept(self.events[0]):
+                self.events.popleft()
+                self.dropped += 1
+            if self.dropped > len(self.events):
+                self.compact()
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.compact()
+
+
+def recording_title(camera, now):
+    """ The next recording's NNNNN_YYYYmmdd_HHMMSS title, numbered on from the last """
+    camera.video_count += 1
+    return "{:05d}_{}".format(camera.video_count, now.strftime("%Y%m%d_%H%M%S"))
+
+
+def open_files(camera, now, trigger_value, track):
+    # Prepare file names based on date and time
+    camera.file_title = "{}/{}".format(camera.directory, recording_title(camera, now))
+    camera.video_file_title = camera.file_title + ".mp4"
 
     # Open output video file
-    circ.open_output(PyavOutput(video_file_title))
-    print(f'New recording starting after "trigger value" of  {total_motion:.0f}')
+    pre_roll = camera.frame_source.open_recording(camera.video_file_title)
+    camera.recording_catalog.opened(os.path.basename(camera.file_title), now.timestamp())
+
+    # Start the motion track with the frames already in the pre-roll
+    video_start = now.timestamp() - pre_roll
+    camera.motion_track = MotionTrack(camera.file_title + ".motion", video_start)
+    for record in track:
+        if record[0] >= video_start:
+            camera.motion_track.write(*record)
+    camera.recordings_opened += 1
+    print(f'{camera.name}: new recording starting after "trigger value" of  {trigger_value:.0f}')
     print()
 
 
-def close_files(start_time, close_time):
-    circ.close_output()
-    print("Closing and saving file",video_file_title, end=", ")
+def save_snapshot(camera, frame):
+    """ Saves the jpeg of the trigger moment, alongside the open recording """
+    with open(camera.file_title + ".jpg", 'wb') as f:
+        f.write(yuv420_jpeg(frame, STREAM_HEIGHT, STREAM_WIDTH, HIGH_Q))
+
+
+def write_track(camera, frame_time, score, detections):
+    camera.motion_track.write(frame_time, score, detections)
+
+
+def close_files(camera, start_time, close_time, peak_motion):
+    camera.frame_source.close_recording()
+    peak_offset = camera.motion_track.close()
+    camera.recording_catalog.closed(os.path.basename(camera.file_title), close_time, peak_motion, peak_offset)
+    camera.recordings_closed += 1
+    print("Closing and saving file",camera.video_file_title, end=", ")
     print(f'which holds approx { (close_time - start_time):.0f} seconds worth of video')
     print()
     print("Waiting for next trigger or button initiated command.")
     print()
 
 
-def control_storage():
-    """ If running low on disk space delete oldest file pair
+def recorder(camera):
+    """ Recording lifecycle worker, one per camera. The motion thread only posts
+        commands to the camera's recorder_commands queue, and all the file work
+        is done here, in order, so motion analysis never waits on the SD card
+        or the video output.
+            ('open', datetime, trigger value, track)
+                                                open a new recording, with the
+                                                motion track of its pre-roll
+            ('snapshot', frame)                 save the jpeg of the trigger moment
+            ('track', time, score, detections)  add a frame to the motion track
+            ('close', start, close time, peak)  close the recording
+            ('evict',)                          check disk usage, delete the oldest
+        In DVR mode the motion thread's commands start, track and end a motion
+        event in the segments, (DVR_COMMANDS), and the frame source posts
+            ('segment', title, start time)      a segment has been opened
+            ('segment_end', title, end time)    and closed
         """
-    total, used, _ = disk_usage("Videos")
+    commands = DVR_COMMANDS if DVR else RECORDER_COMMANDS
+    while True:
+        command, *arguments = camera.recorder_commands.get()
+        try:
+            commands[command](camera, *arguments)
+        except Exception as e:
+            print(f"{camera.name}: recorder {command} failed: {e}")
+            print()
+
+
+def control_storage(camera):
+    """ If running low on disk space delete the camera's oldest file pairs, in
+        one batch, down to STORAGE_HYSTERESIS below the limit
+        """
+    start = perf_counter()
+    total, used, _ = disk_usage(camera.directory)
     used_space = used / total
     if used_space > MAX_DISK_USAGE:
-        oldest_snapshot = sorted(glob("Videos/*.jpg"), key = os.path.getctime)[0]
-        oldest_video_file=sorted(glob("Videos/*.mp4"), key = os.path.getctime)[0]
-        os.remove(oldest_snapshot)
-        os.remove(oldest_video_file)
+        low_water = (MAX_DISK_USAGE - STORAGE_HYSTERESIS) * total
+        deleted = camera.recording_catalog.evict(used - low_water)
+        if deleted and camera.event_index is not None:
+            camera.event_index.prune()
+        if deleted:
+            print(f"{camera.name}: disk usage {used_space:.0%}, deleted {len(deleted)} oldest recording(s),"
+                  f" {deleted[0]} to {deleted[-1]}")
+            print()
+    camera.control_storage_latency.observe(perf_counter() - start)
+
+
+RECORDER_COMMANDS = {'open': open_files,
+                     'snapshot': save_snapshot,
+                     'track': write_track,
+                     'close': close_files,
+                     'evict': control_storage}
+
+
+def open_segment(camera, title, start):
+    """ DVR mode, a segment the frame source has started. Its thumbnail is
+        the frame it starts on, until an event in it replaces it, and an event
+        in progress carries on into it
+        """
+    camera.file_title = os.path.join(camera.directory, title)
+    camera.video_file_title = camera.file_title + ".mp4"
+    camera.recording_catalog.opened(title, start)
+    camera.motion_track = MotionTrack(camera.file_title + ".motion", start)
+    camera.segments.append({'title': title, 'start': start, 'end': None, 'peak': 0, 'snapshot': False})
+    camera.recordings_opened += 1
+    _, frame, slot = camera.lores_pool.borrow()
+    try:
+        save_snapshot(camera, frame)
+    finally:
+        camera.lores_pool.release(slot)
+    if camera.event is not None:
+        camera.event['segments'].append([title, 0.0, None])
+
+
+def close_segment(camera, title, end):
+    segment = camera.segments[-1]
+    peak_offset = camera.motion_track.close()
+    camera.motion_track = None
+    segment['end'] = end
+    camera.recording_catalog.closed(title, end, segment['peak'], peak_offset if segment['peak'] else None)
+    camera.recordings_closed += 1
+    if camera.event is not None:
+        camera.event['segments'][-1][2] = round(end - segment['start'], 1)
+    control_storage(camera)
+
+
+def start_event(camera, now, trigger_value, track):
+    """ DVR mode, a motion event starting, like a recording, BUFFER_SECONDS
+        before the trigger, in whichever of the segments hold that time
+        """
+    start = now.timestamp() - BUFFER_SECONDS
+    camera.event = {'start': start, 'segments': []}
+    for segment in camera.segments:
+        if segment['end'] is None or segment['end'] > start:
+            camera.event['segments'].append(
+                [segment['title'], max(round(start - segment['start'], 1), 0.0),
+                 None if segment['end'] is None else round(segment['end'] - segment['start'], 1)])
+    if camera.motion_track is not None:
+        video_start = max(start, camera.segments[-1]['start'])
+        for record in track:
+            if record[0] >= video_start:
+                track_event(camera, *record)
+    print(f'{camera.name}: motion event starting after "trigger value" of  {trigger_value:.0f}')
+    print()
+
+
+def save_event_snapshot(camera, frame):
+    """ DVR mode, the trigger moment of a segment's first event is its thumbnail """
+    if camera.motion_track is not None and not camera.segments[-1]['snapshot']:
+        save_snapshot(camera, frame)
+        camera.segments[-1]['snapshot'] = True
+
+
+def track_event(camera, frame_time, score, detections):
+    if camera.motion_track is not None:
+        camera.motion_track.write(frame_time, score, detections)
+        camera.segments[-1]['peak'] = max(camera.segments[-1]['peak'], score)
+
+
+def end_event(camera, start_time, close_time, peak_motion):
+    """ DVR mode, adds the event that has ended to the camera's event index """
+    event, camera.event = camera.event, None
+    if event is None or not event['segments']:
+        return
+    last = event['segments'][-1]
+    if last[2] is None:
+        last[2] = round(close_time - camera.segments[-1]['start'], 1)
+    camera.event_index.append(event['start'], close_time, peak_motion, event['segments'])
+    print(f"{camera.name}: motion event of approx {close_time - start_time:.0f} seconds indexed, in",
+          ", ".join(segment[0] for segment in event['segments']))
+    print()
+
+
+DVR_COMMANDS = {'open': start_event,
+                'snapshot': save_event_snapshot,
+                'track': track_event,
+                'close': end_event,
+                'evict': control_storage,
+                'segment': open_segment,
+                'segment_end': close_segment}
 
 
 def get_mask(frame1, frame2, kernel=array((9,9), dtype=uint8)):
@@ -1007,6 +3768,55 @@ def get_mask(frame1, frame2, kernel=array((9,9), dtype=uint8)):
     return mask
 
 
+class BackgroundModel:
+    """
+    Running average background for the 'background' motion detector.
+    The background is held in a compact int16 fixed point accumulator,
+    (luma << 7), and is updated in place with integer shifts into
+    preallocated buffers, so there are no per frame allocations beyond
+    OpenCV's own.
+    """
+
+    def __init__(self, shape, motion_mask=None):
+        self.accumulator = None
+        self.scratch = zeros(shape, dtype = int16)
+        self.background = zeros(shape, dtype = uint8)
+        self.empty_mask = zeros(shape, dtype = uint8)
+        self.motion_mask = motion_mask
+
+    def update(self, frame):
+        """ Learn from a frame, background += (frame - background) >> BACKGROUND_SHIFT """
+        copyto(self.scratch, frame)
+        left_shift(self.scratch, 7, out = self.scratch)
+        if self.accumulator is None:
+            self.accumulator = self.scratch.copy()
+            return
+        subtract(self.scratch, self.accumulator, out = self.scratch)
+        right_shift(self.scratch, BACKGROUND_SHIFT, out = self.scratch)
+        add(self.accumulator, self.scratch, out = self.accumulator)
+
+    def apply(self, frame):
+        """ Obtains the mask of pixels that differ from the background, then
+            learns from the frame. Same output as get_mask().
+            """
+        if self.accumulator is None:
+            self.update(frame)
+            return self.empty_mask
+
+        right_shift(self.accumulator, 7, out = self.scratch)
+        copyto(self.background, self.scratch, casting = 'unsafe')
+
+        frame_diff = cv2.absdiff(frame, self.background)
+        _, mask = cv2.threshold(frame_diff, BACKGROUND_THRESHOLD, 255, cv2.THRESH_BINARY)
+        mask = cv2.medianBlur(mask, 3)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=1)
+        if self.motion_mask is not None:
+            mask = bitwise_and(mask, self.motion_mask)
+
+        self.update(frame)
+        return mask
+
+
 def get_contour_detections(mask, thresh=20):
     """ Obtains initial proposed detections from contours discovered on the mask.
         Scores are taken as the bbox area, larger is higher.
@@ -1030,160 +3840,1019 @@ def get_contour_detections(mask, thresh=20):
     return array(detections)
 
 
-def motion():
-    """ This thread obtains a lo-res frame from the CaptureBuffer thread, takes a copy
-        and if required applies a motion mask.Then calculates a motion score for the frame
-        relative to the previous frame and if motion is present releases the circular buffer
-        to start saving a video file. Also looks for the end of motion to trigger the closure
-        of the file.
-
+def get_component_detections(mask, thresh=20):
+    """ Obtains proposed detections from a single connected components pass
+        over the mask. All per-component statistics come from the one OpenCV
+        call, and the size filter is a NumPy mask rather than a Python loop.
         Inputs:
-            cb_frame - lo-res frame
-            trigger_level - area of changed pixels considered to be motion
-            AFTER_FRAMES - Number of consecutive motion frames to trigger recording
+            mask - thresholded image mask
+            thresh - threshold for bounding box size
         Outputs:
-            is_recording - Boolean flag to signal other threads that recording is happening
-            open_files() - called to open video file and to save jpg file of trigger moment
-            close_files() - called to close the video file after motion has ceased
+            detections - array of proposed detection bounding boxes and scores [[x1,y1,x2,y2,s]]
         """
-    global  is_recording, total_motion, video_count
-    previous_frame = None
-    motion_frames = 0
-    previous_motion_score = 0
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity = 8)
 
-    while True:
-        with cb_condition:
-            cb_condition.wait()
-            current_frame = copy(cb_frame)
-            grey_frame=current_frame[:STREAM_HEIGHT, :]
+    # Row 0 is the background label
+    x, y, w, h = stats[1:, cv2.CC_STAT_LEFT], stats[1:, cv2.CC_STAT_TOP],\
+                 stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+    area = w * h
+    keep = area > thresh
 
-        if previous_frame is not None:
-            total_motion = 0
+    return column_stack((x, y, x + w, y + h, area))[keep]
+
+
+def union_area(boxes):
+    """ Area covered by a set of [x1,y1,x2,y2] boxes, with overlaps counted once.
+        The boxes are filled into a canvas the size of their combined extent
+        and the set pixels are counted.
+        """
+    if len(boxes) == 0:
+        return 0
+
+    left, top = int(boxes[:, 0].min()), int(boxes[:, 1].min())
+    canvas = zeros((int(boxes[:, 3].max()) - top, int(boxes[:, 2].max()) - left), dtype = uint8)
+    for x1, y1, x2, y2 in (boxes - (left, top, left, top)).tolist():
+        canvas[y1:y2, x1:x2] = 1
+
+    return cv2.countNonZero(canvas)
 
-            # Apply motion mask if specified
-            if apply_motion_mask:
-                grey_frame = bitwise_and(grey_frame,mask_array)
 
-            # get image mask for moving pixels
+def contour_engine(mask, thresh=20):
+    """ Original scoring, the sum of the contour bounding box areas """
+    detections = get_contour_detections(mask, thresh)
+    score = detections[:, -1].sum() if detections.size > 0 else 0
+    return detections, score
+
+
+def component_engine(mask, thresh=20):
+    """ Connected components scoring, the union area of the bounding boxes """
+    detections = get_component_detections(mask, thresh)
+    score = union_area(detections[:, :4]) if detections.size > 0 else 0
+    return detections, score
+
+
+# Selectable motion scoring engines. Each takes the motion mask and a size
+# threshold, and returns the detections array and the frame's motion score.
+MOTION_ENGINES = {'contours': contour_engine,
+                  'components': component_engine}
+
+if MOTION_ENGINE not in MOTION_ENGINES:
+    print(f"Unknown motion_engine '{MOTION_ENGINE}' in {config_file}, using 'contours'.")
+    MOTION_ENGINE = 'contours'
+    config.set('ropey', 'motion_engine', MOTION_ENGINE)
+
+
+def read_recorded_frames(paths, max_frames, width=STREAM_WIDTH, height=STREAM_HEIGHT):
+    """ Yields greyscale frames, STREAM sized unless another size is given, for
+        the off-line benchmarks, from recorded .mp4 clips or from raw YUV420
+        lores frame dumps (.yuv)
+        """
+    frame_bytes = STREAM_WIDTH * STREAM_HEIGHT * 3 // 2
+    count = 0
+    for path in paths:
+        if path.endswith('.yuv'):
+            with open(path, 'rb') as f:
+                while count < max_frames:
+                    data = f.read(frame_bytes)
+                    if len(data) < frame_bytes:
+                        break
+                    count += 1
+                    grey = frombuffer(data, dtype = uint8)[:STREAM_WIDTH * STREAM_HEIGHT]\
+                           .reshape(STREAM_HEIGHT, STREAM_WIDTH)
+                    if (width, height) != (STREAM_WIDTH, STREAM_HEIGHT):
+                        grey = cv2.resize(grey, (width, height), interpolation = cv2.INTER_AREA)
+                    yield grey
+        else:
+            video = cv2.VideoCapture(path)
+            while count < max_frames:
+                ok, frame = video.read()
+                if not ok:
+                    break
+                count += 1
+                grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                yield cv2.resize(grey, (width, height), interpolation = cv2.INTER_AREA)
+            video.release()
+
+
+def benchmark_motion_engines(paths, max_frames=500):
+    """ Runs every motion scoring engine over the same masks from recorded
+        frames and prints the per-frame cost of each, alongside get_mask()
+        """
+    mask_times = []
+    timings = {name: [] for name in MOTION_ENGINES}
+    scores = {name: [] for name in MOTION_ENGINES}
+    previous_grey_frame = None
+
+    for grey_frame in read_recorded_frames(paths, max_frames):
+        if apply_motion_mask:
+            grey_frame = bitwise_and(grey_frame, mask_array)
+        if previous_grey_frame is not None:
+            start = perf_counter()
+            mask = get_mask(previous_grey_frame, grey_frame, kernel)
+            mask_times.append(perf_counter() - start)
+            for name, engine in MOTION_ENGINES.items():
+                start = perf_counter()
+                _, score = engine(mask, thresh = 20)
+                timings[name].append(perf_counter() - start)
+                scores[name].append(score)
+        previous_grey_frame = grey_frame
+
+    if not mask_times:
+        print("No frames could be read from", " ".join(paths))
+        return
+
+    print(f"{len(mask_times)} frames at {STREAM_WIDTH}x{STREAM_HEIGHT},"
+          f" get_mask mean {1000 * sum(mask_times) / len(mask_times):.2f} ms")
+    for name in MOTION_ENGINES:
+        times = sorted(timings[name])
+        over = len([s for s in scores[name] if s > TRIGGER_LEVEL])
+        print(f"{name:>10} : mean {1000 * sum(times) / len(times):.3f} ms,"
+              f" p95 {1000 * times[int(0.95 * (len(times) - 1))]:.3f} ms,"
+              f" max {1000 * times[-1]:.3f} ms,"
+              f" mean score {sum(scores[name]) / len(times):.0f},"
+              f" frames over trigger {over}")
+
+
+def count_triggers(frame_scores):
+    """ Number of recordings motion() would start for a run of frame scores,
+        using the same score averaging, AFTER_FRAMES and post roll rules
+        """
+    triggers = motion_frames = previous_motion_score = 0
+    recording_until = -1
+    for frame_number, frame_score in enumerate(frame_scores):
+        total = (frame_score + previous_motion_score) // 2 if frame_score else 0
+        motion_frames = motion_frames + 1 if total > TRIGGER_LEVEL else 0
+        if motion_frames > AFTER_FRAMES:
+            if frame_number > recording_until:
+                triggers += 1
+            recording_until = frame_number + POST_ROLL * FRAMES_PER_SECOND
+        previous_motion_score = total
+    return triggers
+
+
+def benchmark_motion_detectors(paths, max_frames=500):
+    """ Compares the frame difference and running average background detectors
+        on recorded frames, the CPU time to produce each mask and how many
+        recordings each would have triggered. On footage with no real motion
+        every trigger is a false trigger.
+        """
+    background = BackgroundModel((STREAM_HEIGHT, STREAM_WIDTH))
+    score_detections = MOTION_ENGINES[MOTION_ENGINE]
+    cpu = {'difference': 0.0, 'background': 0.0}
+    scores = {'difference': [], 'background': []}
+    previous_grey_frame = None
+
+    for grey_frame in read_recorded_frames(paths, max_frames):
+        if apply_motion_mask:
+            grey_frame = bitwise_and(grey_frame, mask_array)
+        if previous_grey_frame is not None:
+            start = thread_time()
             mask = get_mask(previous_grey_frame, grey_frame, kernel)
+            cpu['difference'] += thread_time() - start
+            scores['difference'].append(score_detections(mask, thresh = 20)[1])
 
-            # get initially proposed detections from contours
-            detections = get_contour_detections(mask, thresh = 20)
+            start = thread_time()
+            mask = background.apply(grey_frame)
+            cpu['background'] += thread_time() - start
+            scores['background'].append(score_detections(mask, thresh = 20)[1])
+        previous_grey_frame = grey_frame
+
+    frames = len(scores['difference'])
+    if not frames:
+        print("No frames could be read from", " ".join(paths))
+        return
+
+    hours = frames / FRAMES_PER_SECOND / 3600
+    for name in ('difference', 'background'):
+        triggers = count_triggers(scores[name])
+        print(f"{name:>10} : mask CPU {1000 * cpu[name] / frames:.2f} ms per frame,"
+              f" peak score {max(scores[name]):.0f},"
+              f" {triggers} triggers, {triggers / hours:.1f} per hour of footage")
+
+
+# The stream sizes the per-stage benchmark runs at, every selectable width at
+# each of the configuration page's aspect ratios.
+STAGE_WIDTHS = range(384, 1281, 128)
+STAGE_ASPECT_RATIOS = (1.333, 1.777, 2.221)
+BENCHMARK_HISTORY = 'benchmark_history.jsonl'
+REGRESSION_FACTOR = 1.15  # flag a stage this much slower than the last run
+REGRESSION_FLOOR_MS = 0.05  # and by at least this much, ignoring timer noise
+
+
+def time_stage(stage, count):
+    """ Times stage(i) for each of count frames, returns milliseconds statistics """
+    times = []
+    for i in range(count):
+        start = perf_counter()
+        stage(i)
+        times.append(perf_counter() - start)
+    times.sort()
+    return {'mean_ms': round(1000 * sum(times) / count, 4),
+            'median_ms': round(1000 * times[count // 2], 4),
+            'p95_ms': round(1000 * times[int(0.95 * (count - 1))], 4)}
+
+
+def benchmark_frames(paths, width, height, count):
+    """ count YUV420 stream frames of the given size, synthetic or from recordings.
+        Recorded frames only have luma, their chroma planes are left neutral
+        """
+    if not paths:
+        scene = synthetic_scene(width, height)
+        return [next(scene)[0] for _ in range(count)]
+    frames = []
+    for grey in read_recorded_frames(paths, count, width, height):
+        yuv = zeros((height * 3 // 2, width), dtype = uint8)
+        yuv[:height] = grey
+        yuv[height:] = 128
+        frames.append(yuv)
+    return frames
+
+
+def release_name():
+    """ The git revision of this script, to compare benchmark runs across releases """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output = True,
+                              text = True, timeout = 5).stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+def benchmark_stages(paths, count=30):
+    """ Times each processing stage at every stream size and the timestamp at the
+        configured video size, prints them, flags any stage slower than in the
+        previous run on this machine and appends the run to the history file
+        """
+    score_detections = MOTION_ENGINES[MOTION_ENGINE]
+    results = []
+
+    for aspect_ratio in STAGE_ASPECT_RATIOS:
+        for width in STAGE_WIDTHS:
+            height = int(2 * ((width / aspect_ratio) // 2))
+            frames = benchmark_frames(paths, width, height, count + 1)
+            if len(frames) < count + 1:
+                print("Not enough frames could be read from", " ".join(paths))
+                return
+            greys = [frame[:height] for frame in frames]
+            full_mask = zeros((height, width), dtype = uint8) + 255
+            masks = [get_mask(greys[i], greys[i + 1], kernel) for i in range(count)]
+            scratch = zeros((height * 3 // 2, width), dtype = uint8)
+
+            def end_to_end(i):
+                # One frame through the motion and the stream paths
+                grey = bitwise_and(greys[i + 1], full_mask)
+                score_detections(get_mask(greys[i], grey, kernel), thresh = 20)
+                copyto(scratch, frames[i + 1])
+                overlay_stream_frame(scratch, width, height, True, 0, TRIGGER_LEVEL)
+                yuv420_jpeg(scratch, height, width, LOW_Q)
+
+            stages = {
+                'get_mask': lambda i: get_mask(greys[i], greys[i + 1], kernel),
+                'get_contour_detections': lambda i: get_contour_detections(masks[i], 20),
+                'motion_mask_and': lambda i: bitwise_and(greys[i], full_mask),
+                'jpeg_low_q': lambda i: yuv420_jpeg(frames[i], height, width, LOW_Q),
+                'jpeg_high_q': lambda i: yuv420_jpeg(frames[i], height, width, HIGH_Q),
+                'stream_overlay': lambda i: overlay_stream_frame(scratch, width, height, True, 0, TRIGGER_LEVEL),
+                'end_to_end': end_to_end,
+            }
+            line = f"{width:>5}x{height:<4}"
+            for stage, function in stages.items():
+                timing = time_stage(function, count)
+                results.append({'stage': stage, 'width': width, 'height': height,
+                                 'aspect_ratio': aspect_ratio, **timing})
+                line += f" {stage} {timing['median_ms']:.2f}"
+            print(line, "ms median")
+
+    # The timestamp is drawn on the full size video frame, not the stream
+    main_frame = cv2.resize(cv2.cvtColor(benchmark_frames(paths, STREAM_WIDTH, STREAM_HEIGHT, 1)[0],
+                                         cv2.COLOR_YUV2BGR_I420), (VIDEO_WIDTH, VIDEO_HEIGHT))
+    def put_text_stamp(i):
+        # The two putText() calls the atlas replaces, for comparison
+        text = ''.join(timestamp_pieces(camera_title, 0))
+        cv2.putText(main_frame, text, origin_offset, font, scale, BLACK, thickness + 4)
+        cv2.putText(main_frame, text, origin_offset, font, scale, colour, thickness)
+
+    line = f"{VIDEO_WIDTH:>5}x{VIDEO_HEIGHT:<4}"
+    for stage, function in (('stamp_frame', lambda i: stamp_frame(main_frame, camera_title, 0)),
+                            ('stamp_frame_put_text', put_text_stamp)):
+        timing = time_stage(function, count)
+        results.append({'stage': stage, 'width': VIDEO_WIDTH, 'height': VIDEO_HEIGHT,
+                        'aspect_ratio': ASPECT_RATIO, **timing})
+        line += f" {stage} {timing['median_ms']:.2f}"
+    print(line, "ms median,", "text atlas" if overlay_atlas.exact else "putText fallback")
+
+    # Compare with the last run on this machine
+    previous = None
+    if os.path.exists(BENCHMARK_HISTORY):
+        with open(BENCHMARK_HISTORY) as f:
+            for line in f:
+                run = json.loads(line)
+                if run['host'] == platform.node() and run['source'] == (paths or 'synthetic'):
+                    previous = run
+    if previous:
+        before = {(r['stage'], r['width'], r['height']): r['median_ms'] for r in previous['results']}
+        slower = [(r, before[key]) for r in results
+                  if (key := (r['stage'], r['width'], r['height'])) in before
+                  and r['median_ms'] > max(REGRESSION_FACTOR * before[key], before[key] + REGRESSION_FLOOR_MS)]
+        print()
+        print(f"Compared with {previous['release']} of {previous['time']}:"
+              f" {len(slower)} of {len(results)} stage timings more than"
+              f" {round(100 * (REGRESSION_FACTOR - 1))}% slower")
+        for result, median in slower:
+            print(f"  {result['stage']} at {result['width']}x{result['height']}:"
+                  f" {median:.2f} -> {result['median_ms']:.2f} ms")
+
+    run = {'time': datetime.now().isoformat(timespec = 'seconds'), 'release': release_name(),
+           'host': platform.node(), 'machine': platform.machine(), 'python': platform.python_version(),
+           'opencv': cv2.__version__, 'source': paths or 'synthetic', 'frames': count,
+           'motion_engine': MOTION_ENGINE, 'results': results}
+    with open(BENCHMARK_HISTORY, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f"Results added to {os.path.abspath(BENCHMARK_HISTORY)}")
+
+
+def find_motion(region, directory="Videos"):
+    """ Prints the recordings, of every camera, whose motion tracks have detection
+        boxes overlapping region, (x1, y1, x2, y2) as fractions of the frame, with
+        the number of such frames, their peak score and how far into the video
+        the first is
+        """
+    x1, y1, x2, y2 = region
+    found = 0
+    paths = []
+    directories = [directory]
+    while directories:
+        with os.scandir(directories.pop(0)) as files:
+            for file in files:
+                if file.name.endswith('.motion'):
+                    paths.append(file.path)
+                elif file.is_dir() and re.fullmatch(r'cam[0-9]+', file.name):
+                    directories.append(file.path)
+    paths.sort()
+    for path in paths:
+        try:
+            (width, height, video_start), records = MotionTrack.read(path)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        left, top, right, bottom = x1 * width, y1 * height, x2 * width, y2 * height
+        hits = [(frame_time, score) for frame_time, score, boxes in records
+                if ((boxes[:, 0] < right) & (boxes[:, 2] > left)
+                    & (boxes[:, 1] < bottom) & (boxes[:, 3] > top)).any()]
+        if hits:
+            found += 1
+            print(f"{os.path.relpath(path, directory)[:-len('.motion')]}: {len(hits)} frames,"
+                  f" peak score {max(score for _, score in hits)},"
+                  f" first at {max(hits[0][0] - video_start, 0):.1f} s")
+    print(f"{found} of {len(paths)} recordings with motion in {x1:g},{y1:g} to {x2:g},{y2:g}")
+
+
+class ActivityHeatmap:
+    """
+    Motion activity per tile of the stream frame over time, in a fixed size
+    memory mapped file, so it survives restarts and never grows.
+    The file holds two rings of rows of tile activities, one row a second for
+    the last hour and one an hour for the last 90 days, each row with the
+    time it starts. A tile's activity is the fraction of its pixels in the
+    motion mask, averaged over the analysed frames of the second or hour.
+    add() sums the mask per tile from its integral image, exactly for any
+    frame size, and writes a second's row when the next second starts, and
+    an hour's row, the mean of its seconds, when the next hour starts.
+    """
+
+    MAGIC = 0x524F50455948  # Marks a heatmap file
+
+    def __init__(self, path, grid, seconds, hours):
+        self.columns, self.rows = grid
+        tiles = self.columns * self.rows
+        self.layout = dtype([('header', int64, 4),
+                             ('second_times', int64, seconds), ('seconds', float32, (seconds, tiles)),
+                             ('hour_times', int64, hours), ('hours', float32, (hours, tiles))])
+        header = (self.MAGIC, self.columns, self.rows, seconds)
+        try:
+            self.store = memmap(path, dtype = self.layout, mode = 'r+', shape = ())
+            if tuple(self.store['header']) != header or len(self.store['hour_times']) != hours:
+                raise ValueError
+        except (OSError, ValueError):
+            print(f"Starting a new activity heatmap in {path}")
+            self.store = memmap(path, dtype = self.layout, mode = 'w+', shape = ())
+            self.store['header'] = header
+        self.second = None
+        self.hour = None
+        self.sums = zeros(tiles, dtype = float32)
+        self.frames = 0
+        self.edges = {}  # Mask shape : tile edge rows, columns and tile areas
+
+    def tile_edges(self, shape):
+        if shape not in self.edges:
+            rows = linspace(0, shape[0], self.rows + 1).astype(int)
+            columns = linspace(0, shape[1], self.columns + 1).astype(int)
+            areas = outer(diff(rows), diff(columns)).ravel() * 255.0
+            self.edges[shape] = (rows, columns, areas)
+        return self.edges[shape]
+
+    def add(self, mask, now):
+        """ Adds a motion mask, 255 for motion, of any size """
+        second = int(now)
+        if second != self.second:
+            self.write_second()
+            self.second = second
+        rows, columns, areas = self.tile_edges(mask.shape)
+        corners = cv2.integral(mask)[rows][:, columns]
+        self.sums += diff(diff(corners, axis = 0), axis = 1).ravel() / areas
+        self.frames += 1
+
+    def write_second(self):
+        if not self.frames:
+            return
+        times = self.store['second_times']
+        # The first second of an hour completes the hours before it, before
+        # its row replaces the first second of the hour before
+        hour = self.second - self.second % 3600
+        if hour != self.hour:
+            for earlier in unique(times[(times > 0) & (times < hour)] // 3600):
+                self.write_hour(int(earlier) * 3600)
+            self.hour = hour
+        index = self.second % len(times)
+        self.store['seconds'][index] = self.sums / self.frames
+        times[index] = self.second
+        self.sums[:] = 0
+        self.frames = 0
+
+    def write_hour(self, hour):
+        """ The mean of the hour's seconds, if it has any and is not written yet """
+        hour_times = self.store['hour_times']
+        index = (hour // 3600) % len(hour_times)
+        if hour_times[index] == hour:
+            return
+        times = self.store['second_times']
+        in_hour = (times >= hour) & (times < hour + 3600)
+        if in_hour.any():
+            self.store['hours'][index] = self.store['seconds'][in_hour].mean(axis = 0)
+            hour_times[index] = hour
+
+    def activity(self, span, count, now):
+        """ Mean activity per tile, rows x columns, over the last count seconds
+            or hours, the times and mean activity of the rows it is from
+            """
+        if span == 'hours':
+            times, rows, start = self.store['hour_times'], self.store['hours'], now - 3600 * count
+        else:
+            times, rows, start = self.store['second_times'], self.store['seconds'], now - count
+        selected = (times >= start) & (times > 0)
+        order = argsort(times[selected])
+        rows = rows[selected][order]
+        grid = rows.mean(axis = 0) if len(rows) else zeros(self.columns * self.rows, dtype = float32)
+        return grid.reshape(self.rows, self.columns), times[selected][order], rows.mean(axis = 1)
+
+
+def heatmap_page(path):
+    """ /heatmap.png or /heatmap.json over the last ?seconds=N, (3600 at most,
+        the default), or ?hours=N, of the first camera or ?camera=camN, and the
+        content type
+        """
+    query = parse_qs(urlsplit(path).query)
+    try:
+        if 'hours' in query:
+            span, count = 'hours', min(max(1, int(query['hours'][0])), HEATMAP_HOURS)
+        else:
+            span, count = 'seconds', min(max(1, int(query.get('seconds', [HEATMAP_SECONDS])[0])), HEATMAP_SECONDS)
+    except ValueError:
+        span, count = 'seconds', HEATMAP_SECONDS
+    grid, times, totals = query_camera(path).activity_heatmap.activity(span, count, time())
+
+    if urlsplit(path).path == '/heatmap.json':
+        return json.dumps({'columns': HEATMAP_GRID[0], 'rows': HEATMAP_GRID[1],
+                           'tile_width': STREAM_WIDTH / HEATMAP_GRID[0],
+                           'tile_height': STREAM_HEIGHT / HEATMAP_GRID[1],
+                           'span': span, 'count': count, 'rows_used': len(times),
+                           'activity': grid.round(5).tolist(),
+                           'series': [[int(t), round(float(total), 5)] for t, total in zip(times, totals)]
+                           }).encode('utf-8'), 'application/json'
+
+    # Scaled to the busiest tile, blue for none to red, at the stream size
+    peak = grid.max()
+    levels = (255 * grid / peak).astype(uint8) if peak > 0 else grid.astype(uint8)
+    image = cv2.resize(cv2.applyColorMap(levels, cv2.COLORMAP_JET), (STREAM_WIDTH, STREAM_HEIGHT),
+                       interpolation = cv2.INTER_NEAREST)
+    return cv2.imencode('.png', image)[1].tobytes(), 'image/png'
+
+
+def next_detection_stride(quiet_time, frame_cpu):
+    """ Adaptive detection rate scheduler.
+        Full rate until the scene has been quiet for QUIET_SECONDS, then every
+        MAX_DETECTION_STRIDE'th frame, or if a CPU budget is set the smallest
+        stride that keeps the motion thread within it.
+        Inputs:
+            quiet_time - seconds since motion last approached the trigger level,
+                         or since the last recording
+            frame_cpu - thread CPU seconds used per analysed frame
+        """
+    if not ADAPTIVE_DETECTION or quiet_time < QUIET_SECONDS:
+        return 1
+
+    if MOTION_CPU_BUDGET > 0:
+        budget_stride = ceil(frame_cpu * FRAMES_PER_SECOND / MOTION_CPU_BUDGET)
+        return max(1, min(MAX_DETECTION_STRIDE, budget_stride))
+
+    return MAX_DETECTION_STRIDE
+
+
+class MotionAnalyser:
+    """
+    The frame by frame part of motion detection. Each lo-res frame is read
+    from its frame pool slot, and if it is to be analysed its motion mask,
+    against the previous frame or the background model, is scored by the
+    motion engine and added to the activity heatmap. Frames that are not
+    analysed are only kept as the reference for the next frame.
+    Runs in the camera's motion thread, or in a MotionWorker process.
+    """
+
+    def __init__(self, pool, heatmap):
+        self.pool = pool
+        self.heatmap = heatmap
+        self.score_detections = MOTION_ENGINES[MOTION_ENGINE]
+        self.total_motion = 0
+        self.previous_motion_score = 0
+        self.previous_grey_frame = None
+        self.previous_small_frame = None
+        if MOTION_DETECTOR == 'background':
+            self.full_background = BackgroundModel((STREAM_HEIGHT, STREAM_WIDTH),
+                                                   mask_array if apply_motion_mask else None)
+            # Coarse frames are already masked
+            self.coarse_background = BackgroundModel(COARSE_SIZE[::-1])
+
+    def analyse(self, slot, analyse, detection_stride, trigger_level):
+        """ Takes the frame in a pool slot, which must not change until the next
+            call. Returns (total motion, detections, get_mask() times, heatmap time,
+            thread CPU time) if the frame was analysed, otherwise None
+            """
+        cpu_start = thread_time()
+        # Read-only view of the pooled frame, held until it is the previous frame
+        grey_frame = self.pool.views[slot][:STREAM_HEIGHT, :]
+
+        if MOTION_SCALE > 1:
+            # Decimated copy of the luma plane for the coarse detection pass
+            small_frame = cv2.resize(grey_frame, COARSE_SIZE, interpolation = cv2.INTER_AREA)
+            if apply_motion_mask:
+                small_frame = bitwise_and(small_frame, small_mask_array)
+
+        result = None
+        if self.previous_grey_frame is not None and analyse:
+            previous_grey_frame = self.previous_grey_frame
+            self.total_motion = 0
+            full_pass = True
+            mask_times = []
+            heatmap_time = 0.0
+
+            if MOTION_SCALE > 1:
+                if MOTION_DETECTOR == 'background':
+                    mask = self.coarse_background.apply(small_frame)
+                else:
+                    mask_start = perf_counter()
+                    mask = get_mask(self.previous_small_frame, small_frame, kernel)
+                    mask_times.append(perf_counter() - mask_start)
+                detections, frame_score = self.score_detections(mask, thresh = COARSE_THRESH)
+
+                # Back to full resolution units
+                if detections.size > 0:
+                    detections = detections * COARSE_UNITS
+                frame_score *= MOTION_SCALE * MOTION_SCALE
+
+                # Only escalate to full resolution when close to the trigger level
+                full_pass = ((frame_score + self.previous_motion_score) // 2
+                             >= trigger_level * (1 - MOTION_ESCALATION_BAND))
+
+            if full_pass and MOTION_DETECTOR == 'background':
+                # The background model applies the motion mask to its output
+                mask = self.full_background.apply(grey_frame)
+                detections, frame_score = self.score_detections(mask, thresh = 20)
+
+            elif full_pass:
+                # Apply motion mask if specified
+                if apply_motion_mask:
+                    grey_frame = bitwise_and(grey_frame,mask_array)
+                    if MOTION_SCALE > 1 or detection_stride > 1:
+                        # The previous frame is unmasked if it only had a coarse pass
+                        # or was only kept as the reference for this frame
+                        previous_grey_frame = bitwise_and(previous_grey_frame, mask_array)
+
+                # get image mask for moving pixels
+                mask_start = perf_counter()
+                mask = get_mask(previous_grey_frame, grey_frame, kernel)
+                mask_times.append(perf_counter() - mask_start)
+
+                # get initially proposed detections and the frame score from the engine
+                detections, frame_score = self.score_detections(mask, thresh = 20)
+
+            elif MOTION_DETECTOR == 'background':
+                # Keep the full resolution background current between escalations
+                self.full_background.update(grey_frame)
 
             # if there are any detections use the areas to give 'motion scores'
             if detections.size > 0:
-                scores = detections[:, -1]
-                total_motion = (scores.sum() + previous_motion_score) // 2
+                self.total_motion = (frame_score + self.previous_motion_score) // 2
+
+            if self.heatmap is not None:
+                heatmap_start = perf_counter()
+                self.heatmap.add(mask, time())
+                heatmap_time = perf_counter() - heatmap_start
+
+            result = (self.total_motion, detections, mask_times, heatmap_time, thread_time() - cpu_start)
 
-            motion_frames = motion_frames + 1 if total_motion > trigger_level else 0
+        self.previous_grey_frame = grey_frame
+        self.previous_motion_score = self.total_motion
+        if MOTION_SCALE > 1:
+            self.previous_small_frame = small_frame
+        return result
 
-            if motion_frames > AFTER_FRAMES or set_manual_recording:
-                if not is_recording:
-                    is_recording = True
+
+class MotionWorker:
+    """
+    A camera's MotionAnalyser in a worker process, so the Python work of
+    motion analysis never waits for the GIL behind the capture, mjpeg and web
+    server threads, or holds them up. The process is forked before any
+    thread starts, and reads the frames straight from the camera's frame pool,
+    in shared memory, so no frame is ever copied or pickled. Only the slot
+    goes to the worker and the result comes back, over a pipe. The motion
+    thread keeps the slots the worker is using borrowed, as it does for itself.
+    """
+
+    def __init__(self, name, pool, heatmap):
+        context = multiprocessing.get_context('fork')
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target = self.run, args = (worker_connection, pool, heatmap),
+                                       name = f"{name}-motion", daemon = True)
+        self.process.start()
+        worker_connection.close()
+
+    def run(self, connection, pool, heatmap):
+        # In the worker. The parent's end is closed so the worker sees EOF,
+        # and exits, when the parent does
+        self.connection.close()
+        analyser = MotionAnalyser(pool, heatmap)
+        try:
+            while True:
+                connection.send(analyser.analyse(*connection.recv()))
+        except (EOFError, BrokenPipeError, KeyboardInterrupt):
+            pass
+
+    def analyse(self, slot, analyse, detection_stride, trigger_level):
+        self.connection.send((slot, analyse, detection_stride, trigger_level))
+        return self.connection.recv()
+
+
+def motion(camera):
+    """ This thread borrows a lo-res frame from the CaptureBuffer thread's frame pool
+        and has the camera's motion analyser, in this thread or a worker process,
+        apply any motion mask and calculate a motion score for the frame relative
+        to the previous frame. If motion is present it releases the circular buffer
+        to start saving a video file. Also looks for the end of motion to trigger the
+        closure of the file.
+
+        One thread per camera. Inputs and outputs are the camera's:
+        Inputs:
+            lores_pool - pool of lo-res frames, borrowed as read-only views
+            trigger_level - area of changed pixels considered to be motion
+            AFTER_FRAMES - Number of consecutive motion frames to trigger recording
+        Outputs:
+            is_recording - Boolean flag to signal other threads that recording is happening
+            recorder_commands - 'open' and 'snapshot' commands to open the video file and save
+                a jpg file of the trigger moment, 'close' and 'evict' to close the video file
+                after motion has ceased and check the disk usage
+        """
+    analyser = camera.motion_analyser
+    previous_slot = None
+    motion_frames = 0
+    peak_motion = 0
+    sequence = 0
+    frame_cpu = 0.0
+    quiet_start = time()
+    analysed_frames = 0
+    rate_start = time()
+    # Motion track of the frames in the pre-roll, for when a recording opens
+    recent_track = deque(maxlen = (BUFFER_SECONDS + 1) * FRAMES_PER_SECOND)
+
+    while True:
+        last_sequence = sequence
+        sequence, current_frame, slot = camera.lores_pool.borrow(last_sequence)
+        frame_start = perf_counter()
+
+        # At reduced rates skip frames entirely, except for the one before an
+        # analysed frame, so scores still come from consecutive frames
+        analyse = sequence % camera.detection_stride == 0
+        if not analyse and (sequence + 1) % camera.detection_stride != 0:
+            camera.lores_pool.release(slot)
+            continue
+
+        # A gap in the sequence means frames were lost while analysing
+        if camera.detection_stride == 1 and last_sequence:
+            camera.motion_frames_missed += sequence - last_sequence - 1
+
+        result = analyser.analyse(slot, analyse, camera.detection_stride, camera.trigger_level)
+
+        if result is not None:
+            camera.total_motion, detections, mask_times, heatmap_time, analysis_cpu = result
+            for mask_time in mask_times:
+                camera.get_mask_latency.observe(mask_time)
+            if camera.activity_heatmap is not None:
+                camera.heatmap_latency.observe(heatmap_time)
+
+            motion_frames = motion_frames + 1 if camera.total_motion > camera.trigger_level else 0
+            if camera.is_recording:
+                peak_motion = max(peak_motion, camera.total_motion)
+
+            if motion_frames > AFTER_FRAMES or camera.set_manual_recording:
+                if not camera.is_recording:
+                    camera.is_recording = True
                     start_time = time()
-                    open_files(current_frame)
+                    peak_motion = camera.total_motion
+                    # The pooled frame is only borrowed, the snapshot needs its own copy
+                    camera.recorder_commands.put(('open', datetime.now(), camera.total_motion, list(recent_track)))
+                    camera.recorder_commands.put(('snapshot', current_frame.copy()))
                 last_motion_time = time()
             else:
-                # Wait for POST_ROLL + BUFFER_SECONDS seconds after motion stops
+                # Wait for POST_ROLL seconds after motion stops, (recordings are
+                # written as they happen, after their pre-roll, not time shifted)
                 # Then close the video recording file and check the disk usage
-                if (is_recording and ((time() - last_motion_time) > (BUFFER_SECONDS + POST_ROLL))):
-                    is_recording = False
+                if (camera.is_recording and ((time() - last_motion_time) > POST_ROLL)):
+                    camera.is_recording = False
                     close_time = time()
-                    close_files(start_time, close_time)
-                    control_storage()
-
-        previous_frame = current_frame
-        previous_grey_frame = grey_frame
-        previous_motion_score = total_motion
-
-
-def stream():
-    global trigger_level, set_manual_recording, mjpeg_abort
-    try:
-        address = ('', 8000)
-        server = StreamingServer(address, StreamingHandler)
-        server.serve_forever()
-    finally:
-        # Shouldn't ever reach this but....
-        cleanup()
-        mjpeg_abort = True
-        sys.exit(0)
-
+                    camera.recorder_commands.put(('close', start_time, close_time, peak_motion))
+                    camera.recorder_commands.put(('evict',))
+
+            # The recorder writes the detections, they are never changed in place
+            track_record = (time(), int(camera.total_motion), detections)
+            if camera.is_recording:
+                camera.recorder_commands.put(('track', *track_record))
+            recent_track.append(track_record)
+
+            # Schedule the next analysis. The scene is not quiet while the score
+            # is near the trigger level or a recording is active
+            if (camera.total_motion > camera.trigger_level * QUIET_FRACTION
+                    or camera.is_recording or camera.set_manual_recording):
+                quiet_start = time()
+            frame_cpu = 0.9 * frame_cpu + 0.1 * analysis_cpu
+            new_stride = next_detection_stride(time() - quiet_start, frame_cpu)
+            if new_stride != camera.detection_stride:
+                camera.detection_stride = new_stride
+                print(f"{camera.name}: motion analysis now every {camera.detection_stride} frame(s),"
+                      f" ~{FRAMES_PER_SECOND / camera.detection_stride:.1f} per second"
+                      f" (measured {camera.analysis_rate:.1f} per second)")
+                print()
+
+            if not camera.frames_analysed:
+                camera.startup['armed'] = monotonic() - STARTED
+                print(f"{camera.name}: motion detection armed {camera.startup['armed']:.2f} s after start")
+                print()
+            analysed_frames += 1
+            camera.frames_analysed += 1
+            if time() - rate_start >= 10:
+                camera.analysis_rate = analysed_frames / (time() - rate_start)
+                analysed_frames = 0
+                rate_start = time()
+            frame_time = perf_counter() - frame_start
+            camera.motion_latency.observe(frame_time)
+            camera.motion_max_stall = max(camera.motion_max_stall, frame_time)
+
+        # Hand back the pooled frame that is no longer needed
+        if previous_slot is not None:
+            camera.lores_pool.release(previous_slot)
+        previous_slot = slot
+
+
+class Camera:
+    """
+    One camera's pipeline and its state. The first camera is set up by the
+    [ropey] section and any others by [ropey.cam1], [ropey.cam2] ... sections,
+    whose settings default to those in [ropey]. Frame sizes, frame rate,
+    motion mask and camera controls are shared by every camera.
+    Each camera has its own frame source, lo-res frame pool, capture, mjpeg,
+    motion and recorder threads, stream, recordings directory and heatmap,
+    so a camera that falls behind only drops its own frames.
+    """
 
-os.environ["LIBCAMERA_LOG_LEVELS"] = "4"  # reduce libcamera messsages
+    def __init__(self, index, section):
+        self.index = index
+        self.name = f"cam{index}"
+        self.section = section
+        first = index == 0
+        self.title = config.get(section, 'camera_title',
+                                fallback = camera_title if first else f"{camera_title}-{self.name}")
+        self.camera_num = config.getint(section, 'camera_num', fallback = index)
+        # Replay in place of this camera, the --replay source is used otherwise
+        self.replay = None if first else config.get(section, 'replay', fallback = None)
+
+        # Frame to frame change limit, and a copy to re-enable motion detection
+        self.trigger_level = config.getint(section, 'trigger_level', fallback = TRIGGER_LEVEL)
+        self.reset_trigger = self.trigger_level
+        # Video file counter, to retain consecutive file numbering after restarts
+        self.video_count = config.getint(section, 'video_count', fallback = 0)
+
+        # The first camera keeps the single camera paths
+        self.directory = "Videos" if first else os.path.join("Videos", self.name)
+        self.stream_path = "/stream.mjpg" if first else f"/{self.name}/stream.mjpg"
+        os.makedirs(self.directory, exist_ok = True)
+
+        # State shared by the camera's threads
+        self.set_manual_recording = False
+        self.is_recording = False
+        self.total_motion = 0  # Total area of motion detected via frame differencing
+        self.detection_stride = 1  # Motion thread analyses every Nth frame
+        self.analysis_rate = 0.0  # Measured motion analyses per second
+        self.file_title = None
+        self.video_file_title = None
+        self.motion_track = None
+        # DVR mode, enough of the latest segments to hold an event's start,
+        # BUFFER_SECONDS before its trigger, and the event in progress
+        self.segments = deque(maxlen = ceil(BUFFER_SECONDS / DVR_SEGMENT_SECONDS) + 1)
+        self.event = None
+
+        # Running totals for /metrics and the stage throughput figures
+        self.frames_analysed = 0
+        self.frames_encoded = 0
+        self.jpeg_bytes_encoded = 0
+        self.recordings_opened = 0
+        self.recordings_closed = 0
+        self.mjpeg_frames_missed = 0
+        self.motion_frames_missed = 0
+        self.motion_max_stall = 0.0  # Longest time the motion thread has spent on one frame
+        self.startup = {}  # Seconds from start to each startup stage
+
+        # Stage latency histograms for /metrics
+        self.capture_interval = LatencyHistogram('ropey_capture_interval_seconds',
+                                                 'Time between lo-res frames arriving from the camera.')
+        self.capture_jitter = LatencyHistogram('ropey_capture_jitter_seconds',
+                                               'Difference of each capture interval from 1 / FPS.')
+        self.pre_callback_latency = LatencyHistogram('ropey_pre_callback_seconds',
+                                                     'Time to timestamp each main frame.')
+        self.motion_latency = LatencyHistogram('ropey_motion_frame_seconds',
+                                               'Time the motion thread spends on each analysed frame.')
+        self.get_mask_latency = LatencyHistogram('ropey_get_mask_seconds',
+                                                 'Time of each get_mask() frame difference.')
+        self.mjpeg_latency = LatencyHistogram('ropey_mjpeg_encode_frame_seconds',
+                                              'Time to overlay, encode and publish each stream frame.')
+        self.control_storage_latency = LatencyHistogram('ropey_control_storage_seconds',
+                                                        'Time of each disk space check after a recording.')
+        self.heatmap_latency = LatencyHistogram('ropey_heatmap_update_seconds',
+                                                'Time to add each motion mask to the activity heatmap.')
+        self.latency_histograms = (self.capture_interval, self.capture_jitter, self.pre_callback_latency,
+                                   self.motion_latency, self.get_mask_latency, self.mjpeg_latency,
+                                   self.control_storage_latency, self.heatmap_latency)
+
+        self.frame_source = None
+        self.lores_pool = FramePool((STREAM_HEIGHT * 3 // 2, STREAM_WIDTH), LORES_POOL_SIZE,
+                                    shared = MOTION_PROCESS)
+        self.mjpeg_broadcaster = MjpegBroadcaster(STREAM_QUEUE_FRAMES)
+        self.recorder_commands = Queue()
+        # Index of the recordings, for storage control, and DVR mode's motion events
+        self.recording_catalog = RecordingCatalog(self.directory)
+        self.event_index = EventIndex(self.directory, self.recording_catalog) if DVR else None
+        heatmap_file = HEATMAP_FILE if first else os.path.join(self.directory, os.path.basename(HEATMAP_FILE))
+        self.activity_heatmap = (ActivityHeatmap(heatmap_file, HEATMAP_GRID, HEATMAP_SECONDS, HEATMAP_HOURS)
+                                 if HEATMAP else None)
+        # A worker process is forked here, as every camera is set up before any
+        # thread starts or any camera is opened. It writes the heatmap, through
+        # the same file mapping the web server reads
+        if MOTION_PROCESS:
+            self.motion_analyser = MotionWorker(self.name, self.lores_pool, self.activity_heatmap)
+        else:
+            self.motion_analyser = MotionAnalyser(self.lores_pool, self.activity_heatmap)
+        self.mjpeg_thread = None
+
+    def start(self, replay=None, paced=True, main=False):
+        """ Starts the frame source, the camera or a replay in its place, and
+            the camera's threads, and returns the source's current metadata
+            """
+        replay = self.replay or replay
+        if replay:
+            self.frame_source = ReplaySource(replay, self, paced = paced, main = main)
+        elif Picamera2 is None:
+            print("Picamera2 is not available. Use --replay to run without a camera.")
+            sys.exit(1)
+        else:
+            self.frame_source = CameraSource(self)
+        metadata = self.frame_source.start()
 
+        Thread(target=capturebuffer, args = (self,), daemon = True).start()
+        self.mjpeg_thread = Thread(target=mjpeg_encode, args = (self,), daemon = False)
+        self.mjpeg_thread.start()
+        Thread(target=recorder, args = (self,), daemon = True).start()
+        Thread(target=motion, args = (self,), daemon = True).start()
+        return metadata
 
-# Instantiate camera and find sensor_model for use in selecting tuning file
-picam2 = Picamera2()
-properties = picam2.camera_properties
-sensor_model = properties['Model']
-picam2.close()
 
-# Define tuning file name based on model and on boolean state of is_noir
-noir = "_noir" if is_noir else ""
-tuning_file_name  = sensor_model + noir + ".json"
+def camera_sections():
+    """ The [ropey] section then any [ropey.camN] sections, as (index, section) """
+    sections = [(0, 'ropey')]
+    for section in config.sections():
+        match = re.fullmatch(r'ropey\.cam([1-9][0-9]*)', section)
+        if match:
+            sections.append((int(match.group(1)), section))
+    return sorted(sections)
 
-# Instantiate camera with appropriate tuning file 
-tuning = Picamera2.load_tuning_file(tuning_file_name)
-picam2 = Picamera2(tuning = tuning)
 
-# Interrogate the sensor to find the supported modes
-modes = picam2.sensor_modes
-max_mode = len(modes) -1
+def query_camera(path):
+    """ The camera named by a ?camera=camN query, the first camera otherwise """
+    name = parse_qs(urlsplit(path).query).get('camera', [''])[0]
+    return next((camera for camera in cameras if camera.name == name), cameras[0])
 
-# And select the mode to configure
-mode = modes[SENSOR_MODE]
 
-# Create the stored configuration
-picam2.configure(picam2.create_video_configuration(sensor = {"output_size":mode['size'],'bit_depth':mode['bit_depth']},
-                                                   controls = {'FrameRate' : FRAMES_PER_SECOND},
-                                                   transform = Transform(hflip=HFLIP, vflip=VFLIP),
-                                                   main = {"size" : (VIDEO_WIDTH, VIDEO_HEIGHT),'format' : "BGR888"},
-                                                   lores = {"size" : (STREAM_WIDTH, STREAM_HEIGHT),'format' : "YUV420"}, buffer_count = 10))
-# Define the encoder properties
-encoder = H264Encoder(repeat = True, iperiod = FRAMES_PER_SECOND)
+def report_stage_throughput(seconds):
+    """ Runs the pipeline for a number of seconds with one simulated stream
+        viewer per camera, then prints the frames per second handled by each
+        camera's stages
+        """
+    def viewer(broadcaster, subscriber):
+        while True:
+            broadcaster.get(subscriber)
+
+    for camera in cameras:
+        subscriber = camera.mjpeg_broadcaster.subscribe('throughput')
+        Thread(target = viewer, args = (camera.mjpeg_broadcaster, subscriber), daemon = True).start()
+    start = time()
+    counts = [(camera.lores_pool.sequence, camera.frames_analysed, camera.frames_encoded)
+              for camera in cameras]
+    sleep(seconds)
+    elapsed = time() - start
+    for camera, (captured, analysed, encoded) in zip(cameras, counts):
+        print(f"Stage throughput of {camera.name} over {elapsed:.0f} s at {STREAM_WIDTH}x{STREAM_HEIGHT} :"
+              f" capture {(camera.lores_pool.sequence - captured) / elapsed:.1f} fps,"
+              f" motion {(camera.frames_analysed - analysed) / elapsed:.1f} fps,"
+              f" mjpeg {(camera.frames_encoded - encoded) / elapsed:.1f} fps")
 
-# Set the timestamp callback
-picam2.pre_callback = apply_timestamp
 
-# Apply the stored set of camera controls
-picam2.set_controls(controls)
+def stream():
+    global mjpeg_abort
+    try:
+        address = ('', 8000)
+        if SERVER_MODE == 'asyncio':
+            asyncio.run(AsyncStreamingServer(address).serve())
+        else:
+            server = StreamingServer(address, StreamingHandler)
+            server.serve_forever()
+    finally:
+        # Shouldn't ever reach this but.... cleanup() is a no-op after an exit action's
+        cleanup()
+        mjpeg_abort = True
+        sys.exit(0)
 
-# Circular Buffer properties enabled and started
-circ = CircularOutput2(buffer_duration_ms = BUFFER_SECONDS * 1000)
-encoder.output = [circ]
-picam2.start_recording(encoder, circ, quality = Quality.VERY_HIGH)
 
-# Short delay to allow camera auto algorithms to settle
-sleep(1)
+# Off-line comparison of the motion scoring engines on recorded clips, e.g.
+# ./Ropey-Cam.py --benchmark-motion Videos/*.mp4
+if args.benchmark_motion:
+    benchmark_motion_engines(args.benchmark_motion)
+    benchmark_motion_detectors(args.benchmark_motion)
+    sys.exit(0)
+
+# Search the motion tracks of the recordings, e.g. for the top left quarter
+# ./Ropey-Cam.py --find-motion 0 0 0.5 0.5
+if args.find_motion:
+    find_motion(args.find_motion)
+    sys.exit(0)
+
+# Per-stage timings at every stream size, tracked run to run, e.g.
+# ./Ropey-Cam.py --benchmark-stages              (synthetic frames)
+# ./Ropey-Cam.py --benchmark-stages Videos/*.mp4
+if args.benchmark_stages is not None:
+    benchmark_stages(args.benchmark_stages)
+    sys.exit(0)
+
+# Load test of a running Ropey-Cam's stream, e.g. 20 viewers for 30 seconds
+# ./Ropey-Cam.py --load-test 192.168.1.20:8000 20 30
+if args.load_test:
+    run_stream_load_test(args.load_test[0], *[int(arg) for arg in args.load_test[1:3]])
+    sys.exit(0)
+
+# The cameras, each with its own pipeline, and the stream path of each
+cameras = [Camera(index, section) for index, section in camera_sections()]
+stream_cameras = {camera.stream_path: camera for camera in cameras}
+
+# Start up the various 'infinite' threads, each camera's then the server's.
+# The first camera's metadata sets the current camera parameters
+mjpeg_abort = False
+metadata = cameras[0].start(args.replay, paced = not args.fast, main = args.main)
+for camera in cameras[1:]:
+    camera.start(args.replay, paced = not args.fast, main = args.main)
+max_mode = cameras[0].frame_source.max_mode
 
-# Capture the current metadata for use in finding some current camera parameters
-metadata = picam2.capture_metadata()
-exposuretime = metadata["ExposureTime"]
-analoguegain = metadata["AnalogueGain"]
+# Use the current metadata to find some current camera parameters
+exposuretime = metadata.get("ExposureTime", exposuretime)
+analoguegain = metadata.get("AnalogueGain", analoguegain)
 
 # Check if this sensor supports AutoFocus
-if "AfState" in metadata:
+if cameras[0].frame_source.autofocus or "AfState" in metadata:
     config.set('ropey','hasautofocus', 'True')
 
-# Start up the various 'infinite' threads.
-cb_frame = None
-buf2 = None
-cb_condition = Condition()
-cb_thread = Thread(target=capturebuffer, daemon = True)
-cb_thread.start()
-
-mjpeg_abort = False
-mjpeg_frame = None
-mjpeg_condition = Condition()
-mjpeg_thread = Thread(target=mjpeg_encode, daemon = False)
-mjpeg_thread.start()
-
 stream_thread = Thread(target=stream, daemon = True)
 stream_thread.start()
 
-motion_thread = Thread(target=motion, daemon = True)
-motion_thread.start()
+# Optionally measure each stage's throughput, e.g. on a replay as fast as possible
+# ./Ropey-Cam.py --replay synthetic --fast --throughput 30
+if args.throughput:
+    report_stage_throughput(args.throughput)
+    sys.stdout.flush()
+    os._exit(0)
 
-# Join an 'infinite' thread to keep main thread alive 'til ready to exit by 'aborting' mjpeg thread
-mjpeg_thread.join()
+# Join the 'infinite' mjpeg threads to keep main thread alive 'til ready to exit by 'aborting' them
+for camera in cameras:
+    camera.mjpeg_thread.join()